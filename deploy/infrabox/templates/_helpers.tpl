@@ -265,6 +265,20 @@
 {{ end }}
 {{ end }}
 
+{{ define "env_git_mirror" }}
+-
+    name: INFRABOX_GIT_MIRROR_ENABLED
+    value: {{ .Values.git_mirror.enabled | quote }}
+{{ if .Values.git_mirror.enabled }}
+-
+    name: INFRABOX_GIT_MIRROR_HOST_PATH
+    value: {{ default "/tmp/infrabox/git_mirror" .Values.git_mirror.host_path }}
+-
+    name: INFRABOX_GIT_MIRROR_MAX_AGE
+    value: {{ default 7 .Values.git_mirror.max_age | quote }}
+{{ end }}
+{{ end }}
+
 {{ define "env_job" }}
 -
     name: INFRABOX_JOB_MAX_OUTPUT_SIZE
@@ -280,6 +294,24 @@
     value: {{ default "false" .Values.job.security_context.capabilities.enabled | quote }}
 {{ end }}
 
+{{ define "env_job_creation" }}
+-
+    name: INFRABOX_API_CLUSTER_PLACEMENT
+    value: {{ default "first" .Values.api.cluster_placement | quote }}
+-
+    name: INFRABOX_API_RIGHTSIZING_ENABLED
+    value: {{ default "false" .Values.api.rightsizing.enabled | quote }}
+-
+    name: INFRABOX_API_RIGHTSIZING_HEADROOM
+    value: {{ default "1.5" .Values.api.rightsizing.headroom | quote }}
+-
+    name: INFRABOX_API_RIGHTSIZING_MIN_MEMORY
+    value: {{ default "512" .Values.api.rightsizing.min_memory | quote }}
+-
+    name: INFRABOX_API_FAST_JOB_CREATION_ENABLED
+    value: {{ .Values.api.fast_job_creation.enabled | quote }}
+{{ end }}
+
 {{ define "env_kubernetes" }}
 -
     name: INFRABOX_KUBERNETES_MASTER_HOST
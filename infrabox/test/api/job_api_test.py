@@ -1,9 +1,15 @@
+import os
 from os import getcwd, stat, remove
 
+import gzip
+import hashlib
 import json
+import zlib
+from StringIO import StringIO
 
 from pyinfraboxutils.token import encode_job_token
 from pyinfraboxutils.storage import storage
+from pyinfraboxutils.jobgraph import compute_priorities
 from temp_tools import TestClient, TestUtils
 from test_template import ApiTestTemplate
 
@@ -66,6 +72,74 @@ class JobApiTest(ApiTestTemplate):
         # Ensure downloaded and uploaded file sizes are equal
         self.assertEqual(received_cache_size, actual_cache_size)
 
+    def test_cache_chunks(self):
+        data = zlib.compress('cached')
+        chunk = hashlib.sha256('cached').hexdigest()
+
+        r = TestClient.post(self.url_ns + '/cache/chunks/missing', {'chunks': [chunk]}, self.job_headers)
+        self.assertEqual(r['chunks'], [chunk])
+
+        # a manifest must not reference chunks the api doesn't know
+        manifest = StringIO()
+        with gzip.GzipFile(fileobj=manifest, mode='wb') as f:
+            json.dump({'version': 1, 'entries': [], 'chunks': {chunk: 6}}, f)
+
+        r = TestClient.post(self.url_ns + '/cache/manifest',
+                            data={'manifest.json.gz': (StringIO(manifest.getvalue()), 'manifest.json.gz')},
+                            headers=self.job_headers, content_type='multipart/form-data')
+        self.assertEqual(r['message'], 'Manifest references unknown chunks')
+
+        # the content has to match the name
+        r = TestClient.post(self.url_ns + '/cache/chunks/%s' % chunk,
+                            data={'chunk': (StringIO(zlib.compress('garbage')), 'chunk')},
+                            headers=self.job_headers, content_type='multipart/form-data')
+        self.assertEqual(r['message'], 'Chunk content does not match its hash')
+
+        r = TestClient.post(self.url_ns + '/cache/chunks/%s' % chunk,
+                            data={'chunk': (StringIO(data), 'chunk')},
+                            headers=self.job_headers, content_type='multipart/form-data')
+        self.assertEqual(r, {})
+
+        r = TestClient.post(self.url_ns + '/cache/chunks/missing', {'chunks': [chunk]}, self.job_headers)
+        self.assertEqual(r['chunks'], [])
+
+        # an existing chunk is never replaced
+        r = TestClient.post(self.url_ns + '/cache/chunks/%s' % chunk,
+                            data={'chunk': (StringIO('\x00cached'), 'chunk')},
+                            headers=self.job_headers, content_type='multipart/form-data')
+        self.assertEqual(r, {})
+
+        r = TestClient.post(self.url_ns + '/cache/manifest',
+                            data={'manifest.json.gz': (StringIO(manifest.getvalue()), 'manifest.json.gz')},
+                            headers=self.job_headers, content_type='multipart/form-data')
+        self.assertEqual(r, {})
+
+        r = TestClient.get(self.url_ns + '/cache/chunks/%s' % chunk, self.job_headers)
+        self.assertEqual(r.data, data)
+
+    def test_cache_definitions(self):
+        key = hashlib.sha256('definitions').hexdigest()
+
+        definitions = StringIO()
+        with gzip.GzipFile(fileobj=definitions, mode='wb') as f:
+            json.dump({'infrabox.json': {'version': 1, 'jobs': []}}, f)
+
+        # only the job creating the jobs may write them
+        r = TestClient.post(self.url_ns + '/cache/definitions/%s' % key,
+                            data={'definitions.json.gz': (StringIO(definitions.getvalue()), 'definitions.json.gz')},
+                            headers=self.job_headers, content_type='multipart/form-data')
+        self.assertEqual(r['message'], 'Only the job creating the jobs may cache definitions')
+
+        TestClient.execute("UPDATE job SET type = 'create_job_matrix' WHERE id = %s", [self.job_id])
+
+        r = TestClient.post(self.url_ns + '/cache/definitions/%s' % key,
+                            data={'definitions.json.gz': (StringIO(definitions.getvalue()), 'definitions.json.gz')},
+                            headers=self.job_headers, content_type='multipart/form-data')
+        self.assertEqual(r, {})
+
+        r = TestClient.get(self.url_ns + '/cache/definitions/%s' % key, self.job_headers)
+        self.assertEqual(r.data, definitions.getvalue())
+
     def test_output(self):
         filename = 'output.tar.gz'
 
@@ -87,6 +161,23 @@ class JobApiTest(ApiTestTemplate):
         job_state = r["state"]
         self.assertEqual(job_state, 'running')
 
+    def test_heartbeat(self):
+        r = TestClient.post(self.url_ns + '/heartbeat', {}, self.job_headers)
+        self.assertEqual(r, {})
+
+        r = TestClient.execute_one("""SELECT count(*) FROM job_heartbeat
+                                       WHERE job_id = %s AND last_seen > now() - interval '1 minute'
+                                   """, [self.job_id])
+        self.assertEqual(r[0], 1)
+
+        # updated in place
+        r = TestClient.post(self.url_ns + '/heartbeat', {}, self.job_headers)
+        self.assertEqual(r, {})
+
+        r = TestClient.execute_one("""SELECT count(*) FROM job_heartbeat
+                                       WHERE job_id = %s""", [self.job_id])
+        self.assertEqual(r[0], 1)
+
     def test_create_jobs(self):
         job_id = "6544af82-1c4f-5bb5-b1da-a54a0ced5e6f"
         data = { "jobs": [{
@@ -110,6 +201,140 @@ class JobApiTest(ApiTestTemplate):
         num_jobs = len(jobs)
         self.assertEqual(num_jobs, 1)
 
+    def test_create_jobs_nested(self):
+        # a job of the build which waits for the job creating the jobs
+        child_id = "7544af82-1c4f-5bb5-b1da-a54a0ced5e6f"
+        TestClient.execute("""INSERT INTO job (id, state, build_id, type, name, project_id,
+                                               build_only, dockerfile, cpu, memory, dependencies)
+                              VALUES (%s, 'queued', %s, 'run_project_container', 'test_job_child',
+                                      %s, false, '', 1, 512, %s)
+                           """, [child_id, self.build_id, self.project_id,
+                                 json.dumps([{"job": self.job_name, "job-id": self.job_id, "on": ["finished"]}])])
+
+        first_id = "8544af82-1c4f-5bb5-b1da-a54a0ced5e6f"
+        leaf_id = "9544af82-1c4f-5bb5-b1da-a54a0ced5e6f"
+        data = { "jobs": [{
+            "id": first_id,
+            "type": "docker",
+            "name": "test_job1",
+            "docker_file": "",
+            "build_only": False
+        }, {
+            "id": leaf_id,
+            "type": "docker",
+            "name": "test_job2",
+            "docker_file": "",
+            "build_only": False,
+            "depends_on": [{"job": "test_job1", "on": ["finished"]}]
+        }]}
+        r = TestClient.post(self.url_ns + '/create_jobs', data, self.job_headers)
+        self.assertEqual(r, 'Successfully create jobs')
+
+        # it now also waits for the last of the created jobs
+        r = TestClient.execute_one("""SELECT dependencies FROM job
+                                      WHERE id = %s""", [child_id])
+        self.assertEqual([d['job-id'] for d in r[0]], [self.job_id, leaf_id])
+        self.assertEqual(r[0][1]['job'], self.job_name + '/test_job2')
+
+    def test_create_jobs_priority(self):
+        # test_job1 took 100 seconds in the last build
+        TestClient.execute("""INSERT INTO job (id, state, build_id, type, name, project_id,
+                                               build_only, dockerfile, cpu, memory, start_date, end_date)
+                              VALUES ('7544af82-1c4f-5bb5-b1da-a54a0ced5e6f', 'finished', %s,
+                                      'run_project_container', 'test_job1', %s, false, '', 1, 512,
+                                      now() - interval '100 seconds', now())
+                           """, [self.build_id, self.project_id])
+
+        parent_id = "6544af82-1c4f-5bb5-b1da-a54a0ced5e6f"
+        child_id = "8544af82-1c4f-5bb5-b1da-a54a0ced5e6f"
+        other_id = "9544af82-1c4f-5bb5-b1da-a54a0ced5e6f"
+        data = { "jobs": [{
+            "id": other_id,
+            "type": "docker",
+            "name": "test_job3",
+            "docker_file": "",
+            "build_only": False
+        }, {
+            "id": parent_id,
+            "type": "docker",
+            "name": "test_job1",
+            "docker_file": "",
+            "build_only": False
+        }, {
+            "id": child_id,
+            "type": "docker",
+            "name": "test_job2",
+            "docker_file": "",
+            "build_only": False,
+            "depends_on": [{"job": "test_job1", "on": ["finished"]}]
+        }]}
+        r = TestClient.post(self.url_ns + '/create_jobs', data, self.job_headers)
+        self.assertEqual(r, 'Successfully create jobs')
+
+        jobs = TestClient.execute_many("""SELECT id, priority FROM job
+                                          WHERE id IN (%s, %s, %s)""", [parent_id, child_id, other_id])
+        priorities = dict((j[0], j[1]) for j in jobs)
+
+        # the parent is on the critical path
+        self.assertEqual(priorities[parent_id], 1000)
+        self.assertEqual(priorities[child_id], 0)
+        self.assertEqual(priorities[other_id], 0)
+
+    def test_compute_priorities_critical_path(self):
+        jobs = [
+            {'id': 'a', 'name': 'a', 'avg_duration': 10},
+            {'id': 'b', 'name': 'b', 'avg_duration': 5, 'depends_on': [{'job': 'a', 'on': ['finished']}]},
+            {'id': 'c', 'name': 'c', 'avg_duration': 1, 'depends_on': [{'job': 'a', 'on': ['finished']}]},
+            {'id': 'd', 'name': 'd', 'avg_duration': 5, 'depends_on': [{'job': 'b', 'on': ['finished']},
+                                                                       {'job': 'c', 'on': ['finished']}]}
+        ]
+
+        compute_priorities(jobs, dict((j['name'], j['id']) for j in jobs))
+
+        # relative to the longest path to the end of the build
+        self.assertEqual([j['priority'] for j in jobs], [1000, 500, 300, 250])
+
+    def test_compute_priorities(self):
+        # a chain longer than the recursion limit
+        jobs = [{'id': str(i), 'name': 'job%s' % i, 'avg_duration': 1} for i in range(5000)]
+        for i in range(1, len(jobs)):
+            jobs[i]['depends_on'] = [{'job': 'job%s' % (i - 1), 'on': ['finished']}]
+
+        compute_priorities(jobs, dict((j['name'], j['id']) for j in jobs))
+
+        self.assertEqual(jobs[0]['priority'], 1000)
+        self.assertEqual(jobs[2500]['priority'], 500)
+        self.assertEqual(jobs[-1]['priority'], 0)
+
+    def test_create_jobs_placement(self):
+        # master is too small for the job, cluster2 has room
+        TestClient.execute("""
+                INSERT INTO cluster (name, active, labels, root_url, nodes, cpu_capacity, memory_capacity)
+                VALUES ('cluster2', true, '{}', 'http://localhost:8080', 1, 10, 10485760);
+            """)
+
+        job_id = "6544af82-1c4f-5bb5-b1da-a54a0ced5e6f"
+        data = { "jobs": [{
+            "id": job_id,
+            "type": "docker",
+            "name": "test_job1",
+            "docker_file": "",
+            "build_only": False,
+            "resources": { "limits": { "cpu": 1, "memory": 1024 }}
+            }]}
+
+        os.environ['INFRABOX_API_CLUSTER_PLACEMENT'] = 'load'
+        try:
+            r = TestClient.post(self.url_ns + '/create_jobs', data, self.job_headers)
+        finally:
+            del os.environ['INFRABOX_API_CLUSTER_PLACEMENT']
+
+        self.assertEqual(r, 'Successfully create jobs')
+
+        r = TestClient.execute_one("""SELECT cluster_name FROM job
+                                      WHERE id = %s""", [job_id])
+        self.assertEqual(r[0], 'cluster2')
+
     def test_consoleupdate(self):
         data = { "output": "some test output" }
         r = TestClient.post(self.url_ns + '/consoleupdate', data=data, headers=self.job_headers)
@@ -16,3 +16,23 @@ class JobTest(ApiTestTemplate):
         r = TestClient.get('/api/v1/projects/%s/jobs/%s/manifest' % (self.project_id, self.job_id),
                            TestClient.get_project_authorization(self.user_id, self.project_id))
         self.assertEqual(r['id'], self.job_id)
+
+    def test_get_job_resources(self):
+        stats = json.dumps({"c": [{"cpu": 150, "mem": 300, "date": 1},
+                                  {"cpu": 50, "mem": 200, "date": 2}]})
+
+        for i in range(3):
+            TestClient.execute("""INSERT INTO job (id, state, build_id, type, name, project_id,
+                                                   build_only, dockerfile, cpu, memory, stats, end_date)
+                                  VALUES (gen_random_uuid(), 'finished', %s, 'run_project_container',
+                                          'rightsize', %s, false, '', 4, 4096, %s, now())
+                               """, [self.build_id, self.project_id, stats])
+
+        r = TestClient.get('/api/v1/projects/%s/jobs/resources' % self.project_id,
+                           TestClient.get_project_authorization(self.user_id, self.project_id))
+        self.assertEqual(len(r), 1)
+        self.assertEqual(r[0]['name'], 'rightsize')
+        self.assertEqual(r[0]['jobs'], 3)
+        self.assertEqual(r[0]['cpu_peak'], 1.5)
+        self.assertEqual(r[0]['memory_peak'], 300)
+        self.assertEqual(r[0]['recommendation'], {'cpu': 3, 'memory': 512})
@@ -1,3 +1,8 @@
+import os
+import json
+import zipfile
+from StringIO import StringIO
+
 from temp_tools import TestClient
 from test_template import ApiTestTemplate
 
@@ -13,3 +18,71 @@ class ProjectTest(ApiTestTemplate):
     def test_get_project(self):
         r = TestClient.get('/api/v1/projects/%s' % self.project_id, TestClient.get_user_authorization(self.user_id))
         self.assertEqual(r['id'], self.project_id)
+
+    def test_project_settings(self):
+        headers = TestClient.get_user_authorization(self.user_id)
+
+        r = TestClient.get('/api/v1/projects/%s/settings' % self.project_id, headers)
+        self.assertEqual(r['cancel_superseded_builds'], False)
+
+        r = TestClient.post('/api/v1/projects/%s/settings' % self.project_id,
+                            {'cancel_superseded_builds': True}, headers)
+        self.assertEqual(r['message'], 'Successfully updated settings')
+
+        r = TestClient.get('/api/v1/projects/%s/settings' % self.project_id, headers)
+        self.assertEqual(r['cancel_superseded_builds'], True)
+
+    def upload(self, definition):
+        buf = StringIO()
+        z = zipfile.ZipFile(buf, 'w')
+        z.writestr('infrabox.json', json.dumps(definition))
+        z.close()
+
+        os.environ['INFRABOX_API_FAST_JOB_CREATION_ENABLED'] = 'true'
+        try:
+            r = TestClient.post('/api/v1/projects/%s/upload/' % self.project_id,
+                                {'project.zip': (StringIO(buf.getvalue()), 'project.zip')},
+                                TestClient.get_project_authorization(self.user_id, self.project_id),
+                                content_type='multipart/form-data')
+        finally:
+            del os.environ['INFRABOX_API_FAST_JOB_CREATION_ENABLED']
+
+        self.assertEqual(r['message'], 'successfully started build')
+        return TestClient.execute_many("""SELECT id, name, state, dependencies FROM job
+                                          WHERE build_id = %s
+                                          ORDER BY type = 'create_job_matrix' DESC, name""",
+                                       [r['data']['build']['id']])
+
+    def test_upload_creates_jobs(self):
+        jobs = self.upload({
+            'version': 1,
+            'jobs': [{
+                'type': 'docker',
+                'name': 'build',
+                'docker_file': 'Dockerfile',
+                'build_only': False,
+                'resources': {'limits': {'cpu': 1, 'memory': 1024}}
+            }]
+        })
+
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(jobs[0]['name'], 'Create Jobs')
+        self.assertEqual(jobs[0]['state'], 'finished')
+        self.assertEqual(jobs[1]['name'], 'build')
+        self.assertEqual(jobs[1]['state'], 'queued')
+        self.assertEqual(jobs[1]['dependencies'][0]['job-id'], jobs[0]['id'])
+
+    def test_upload_with_includes(self):
+        # the "Create Jobs" job has to read the workflow
+        jobs = self.upload({
+            'version': 1,
+            'jobs': [{
+                'type': 'workflow',
+                'name': 'flow',
+                'infrabox_file': 'flow/infrabox.json'
+            }]
+        })
+
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]['name'], 'Create Jobs')
+        self.assertEqual(jobs[0]['state'], 'queued')
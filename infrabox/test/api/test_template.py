@@ -15,6 +15,9 @@ class ApiTestTemplate(unittest.TestCase):
         TestClient.execute('TRUNCATE build')
         TestClient.execute('TRUNCATE console')
         TestClient.execute('TRUNCATE job')
+        TestClient.execute('TRUNCATE job_heartbeat')
+        TestClient.execute('TRUNCATE cache_chunk')
+        TestClient.execute('TRUNCATE cache_manifest')
         TestClient.execute('TRUNCATE job_stat')
         TestClient.execute('TRUNCATE job_markup')
         TestClient.execute('TRUNCATE job_badge')
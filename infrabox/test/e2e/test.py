@@ -223,6 +223,11 @@ class Test(unittest.TestCase):
         self.expect_job('flow', parents=['flow/test-sub'])
         self.expect_job('flow/test-sub', parents=['Create Jobs'])
 
+    def test_git_with_dot_infrabox_file(self):
+        self.run_it('/infrabox/context/infrabox/test/e2e/tests/git_with_dot_infrabox_file')
+        self.expect_job('Create Jobs')
+        self.expect_job('examples-cpp')
+
     def test_image_input_output(self):
         self.run_it('/infrabox/context/infrabox/test/e2e/tests/docker_image_input_output')
         self.expect_job('consumer')
@@ -0,0 +1,371 @@
+""" Benchmark of the kubernetes scheduler.
+
+Runs the Scheduler against a local Postgres and an in-process fake
+kubernetes API server, generates a synthetic workload and reports the
+scheduling throughput, queue latency percentiles and the number of SQL
+queries and kubernetes calls per scheduler pass.
+
+    python3 benchmark.py --workload fanout --builds 20 --width 50
+    python3 benchmark.py --workload all
+
+Scheduled jobs are "run" by the benchmark: they are set to running and
+finished after --duration seconds, so their children get scheduled.
+"""
+import argparse
+import datetime
+import heapq
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import json
+
+import psycopg2
+import psycopg2.extensions
+
+from pyinfraboxutils.db import connect_db
+
+from fake_kube import FakeKube
+
+WORKLOADS = ('fanout', 'chain', 'aborts', 'timeouts')
+
+PROJECT_ID = '1514af82-3c4f-4bb5-b1da-a89a0ced5e6f'
+
+class CountingCursor(psycopg2.extensions.cursor):
+    queries = 0
+
+    def execute(self, query, args=None):
+        CountingCursor.queries += 1
+        return super(CountingCursor, self).execute(query, args)
+
+def percentile(values, p):
+    if not values:
+        return 0
+
+    values = sorted(values)
+    k = int(round((len(values) - 1) * p / 100.0))
+    return values[k]
+
+def execute(conn, stmt, args=None):
+    cursor = conn.cursor()
+    cursor.execute(stmt, args)
+    cursor.close()
+
+def reset_db(conn):
+    for table in ('job', 'build', 'project', 'abort', 'console', 'cluster', 'leader_election',
+                  'job_heartbeat'):
+        execute(conn, 'TRUNCATE "%s"' % table)
+
+    execute(conn, """
+        INSERT INTO cluster (name, active, labels, root_url, nodes, cpu_capacity, memory_capacity)
+        VALUES (%s, true, '{}', 'http://localhost', 0, 0, 0)
+    """, [os.environ['INFRABOX_CLUSTER_NAME']])
+
+    execute(conn, """
+        INSERT INTO project (id, name, type) VALUES (%s, 'benchmark', 'upload')
+    """, [PROJECT_ID])
+
+class Workload(object):
+    """ Creates builds and jobs and keeps track of when each job became runnable """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.build_number = 0
+        self.parents = {}
+        self.children = {}
+        self.runnable_at = {}
+        self.job_ids = []
+
+    def create_build(self):
+        self.build_number += 1
+        build_id = str(uuid.uuid4())
+        execute(self.conn, """
+            INSERT INTO build (id, project_id, build_number, commit_id)
+            VALUES (%s, %s, %s, 'sha')
+        """, [build_id, PROJECT_ID, self.build_number])
+        return build_id
+
+    def create_job(self, build_id, name, parent=None, state='queued', start_date=None, timeout=3600):
+        job_id = str(uuid.uuid4())
+        dependencies = []
+
+        if parent:
+            dependencies.append({'job': parent[1], 'job-id': parent[0], 'on': ['finished']})
+            self.parents[job_id] = parent[0]
+            self.children.setdefault(parent[0], []).append(job_id)
+        else:
+            self.runnable_at[job_id] = time.time()
+
+        execute(self.conn, """
+            INSERT INTO job (id, state, build_id, type, name, project_id, build_only,
+                             dockerfile, cpu, memory, dependencies, start_date, timeout)
+            VALUES (%s, %s, %s, 'run_project_container', %s, %s, false, '', 1, 1024, %s, %s, %s)
+        """, [job_id, state, build_id, name, PROJECT_ID, json.dumps(dependencies),
+              start_date, timeout])
+
+        self.job_ids.append(job_id)
+        return (job_id, name)
+
+    def finished(self, job_id, at):
+        for child in self.children.get(job_id, []):
+            self.runnable_at[child] = at
+
+class JobRunner(object):
+    """ Plays the part of the job pods: scheduled jobs finish after a while """
+
+    def __init__(self, workload, duration):
+        self.workload = workload
+        self.duration = duration
+        self.conn = connect_db()
+        self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.lock = threading.Condition()
+        self.heap = []
+
+    def job_created(self, job_id):
+        with self.lock:
+            heapq.heappush(self.heap, (time.time() + self.duration, job_id))
+            self.lock.notify()
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.lock.wait(0.05)
+
+                _, job_id = heapq.heappop(self.heap)
+
+            now = time.time()
+            self.workload.finished(job_id, now)
+            execute(self.conn, """
+                UPDATE job SET state = 'finished', start_date = now(), end_date = now()
+                WHERE id = %s AND state IN ('scheduled', 'running')
+            """, [job_id])
+
+def count_pending(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT count(*) FROM job WHERE state IN ('queued', 'scheduled', 'running')
+    """)
+    r = cursor.fetchone()[0]
+    cursor.close()
+    return r
+
+def instrument(scheduler, kube, passes):
+    """ Records duration, SQL queries and kubernetes calls of every pass """
+
+    def measured(name, fn):
+        def wrapper(*args):
+            queries = CountingCursor.queries
+            calls = kube.total_calls()
+            start = time.time()
+            fn(*args)
+
+            # idle wake-ups of the event loop are not interesting
+            if name == 'event' and not args[0] and not args[1]:
+                return
+
+            passes.append({
+                'name': name,
+                'duration': time.time() - start,
+                'queries': CountingCursor.queries - queries,
+                'calls': kube.total_calls() - calls
+            })
+
+        return wrapper
+
+    scheduler.handle = measured('sweep', scheduler.handle)
+    scheduler.handle_events = measured('event', scheduler.handle_events)
+
+def make_scheduler(api_server, args):
+    from scheduler import Scheduler
+
+    scheduler_args = argparse.Namespace(
+        docker_registry='localhost',
+        tag='latest',
+        loglevel='warning',
+        reconcile_interval=args.reconcile_interval,
+        overcommit_ratio=1.0,
+        namespace_pool_size=0,
+        kubernetes_workers=args.kubernetes_workers,
+        kubernetes_retries=3,
+        partitions=16,
+        heartbeat_timeout=120,
+        heartbeat_requeue=0,
+        token='token',
+        api_server=api_server
+    )
+
+    conn = connect_db()
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    conn.cursor_factory = CountingCursor
+
+    scheduler = Scheduler(conn, scheduler_args)
+    scheduler.logger.setLevel(logging.WARNING)
+    return scheduler
+
+def setup_fanout(workload, args):
+    for b in range(args.builds):
+        build_id = workload.create_build()
+        root = workload.create_job(build_id, 'root')
+
+        for i in range(args.width):
+            workload.create_job(build_id, 'child-%s' % i, parent=root)
+
+def setup_chain(workload, args):
+    for b in range(args.builds):
+        build_id = workload.create_build()
+        parent = None
+
+        for i in range(args.depth):
+            parent = workload.create_job(build_id, 'step-%s' % i, parent=parent)
+
+def setup_running(workload, kube, args, start_date, timeout):
+    # jobs which are already on the cluster, with some console output each
+    for b in range(args.builds):
+        build_id = workload.create_build()
+
+        for i in range(args.jobs // args.builds):
+            job_id, _ = workload.create_job(build_id, 'job-%s' % i, state='running',
+                                            start_date=start_date, timeout=timeout)
+            kube.add_ibjob(job_id)
+
+    execute(workload.conn, """
+        INSERT INTO console (job_id, output)
+        SELECT j.id, repeat('console output line\n', 50)
+        FROM job j, generate_series(1, %s)
+    """, [args.console_lines])
+
+def report(name, workload, kube, passes, elapsed, args):
+    print('')
+    print('workload: %s' % name)
+
+    latencies = []
+    for job_id in workload.job_ids:
+        created = kube.ibjob_created_at.get(job_id, None)
+        runnable = workload.runnable_at.get(job_id, None)
+        if created and runnable:
+            latencies.append(created - runnable)
+
+    if latencies:
+        print('scheduled jobs: %s in %.2fs (%.1f jobs/s)' % (len(latencies), elapsed,
+                                                           len(latencies) / elapsed))
+        print('queue latency: p50 %.3fs, p90 %.3fs, p99 %.3fs, max %.3fs' % (
+            percentile(latencies, 50), percentile(latencies, 90),
+            percentile(latencies, 99), max(latencies)))
+    else:
+        print('done: %s jobs in %.2fs' % (len(workload.job_ids), elapsed))
+
+    sweeps = [p for p in passes if p['name'] == 'sweep']
+    events = [p for p in passes if p['name'] == 'event']
+    for label, ps in (('sweep', sweeps), ('event', events)):
+        if not ps:
+            continue
+
+        print('%s passes: %s, duration avg %.3fs max %.3fs, SQL queries avg %.1f max %s, '
+              'kubernetes calls avg %.1f max %s' % (
+                  label, len(ps),
+                  sum(p['duration'] for p in ps) / len(ps), max(p['duration'] for p in ps),
+                  float(sum(p['queries'] for p in ps)) / len(ps), max(p['queries'] for p in ps),
+                  float(sum(p['calls'] for p in ps)) / len(ps), max(p['calls'] for p in ps)))
+
+    print('SQL queries: %s' % CountingCursor.queries)
+    print('kubernetes calls:')
+    for key, count in sorted(kube.calls.items()):
+        print('    %6d %s' % (count, key))
+
+    sys.stdout.flush()
+
+def run(name, args):
+    conn = connect_db()
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    reset_db(conn)
+
+    kube = FakeKube(nodes=args.nodes)
+    api_server = kube.start()
+
+    workload = Workload(conn)
+    runner = JobRunner(workload, args.duration)
+    kube.on_ibjob_created = runner.job_created
+    runner.start()
+
+    if name == 'timeouts':
+        started = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=2)
+        setup_running(workload, kube, args, started, 3600)
+
+    if name == 'aborts':
+        setup_running(workload, kube, args, None, 3600)
+
+    scheduler = make_scheduler(api_server, args)
+    passes = []
+    instrument(scheduler, kube, passes)
+
+    start = time.time()
+
+    t = threading.Thread(target=scheduler.run)
+    t.daemon = True
+    t.start()
+
+    # wait for the informers before creating the workload
+    while not scheduler.job_informer.has_synced():
+        time.sleep(0.1)
+
+    if name == 'fanout':
+        setup_fanout(workload, args)
+    elif name == 'chain':
+        setup_chain(workload, args)
+    elif name == 'aborts':
+        execute(conn, 'INSERT INTO abort (job_id) SELECT id FROM job')
+
+    while count_pending(conn) > 0:
+        if time.time() - start > args.timeout:
+            print('%s: timed out, %s jobs still pending' % (name, count_pending(conn)))
+            break
+
+        time.sleep(0.05)
+
+    report(name, workload, kube, passes, time.time() - start, args)
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument('--workload', choices=WORKLOADS + ('all',), default='all')
+    parser.add_argument('--builds', type=int, default=10)
+    parser.add_argument('--width', type=int, default=50,
+                        help='Children per build for fanout')
+    parser.add_argument('--depth', type=int, default=10,
+                        help='Length of the chains')
+    parser.add_argument('--jobs', type=int, default=1000,
+                        help='Running jobs for aborts and timeouts')
+    parser.add_argument('--console-lines', type=int, default=20,
+                        help='Console rows per job for aborts and timeouts')
+    parser.add_argument('--duration', type=float, default=0.5,
+                        help='Seconds a scheduled job runs')
+    parser.add_argument('--nodes', type=int, default=50)
+    parser.add_argument('--kubernetes-workers', type=int, default=10)
+    parser.add_argument('--reconcile-interval', type=int, default=30)
+    parser.add_argument('--timeout', type=int, default=600)
+    args = parser.parse_args()
+
+    os.environ.setdefault('INFRABOX_CLUSTER_NAME', 'master')
+    os.environ.setdefault('INFRABOX_CLUSTER_LABELS', '')
+    os.environ.setdefault('INFRABOX_ROOT_URL', 'http://localhost')
+    os.environ.setdefault('INFRABOX_GENERAL_WORKER_NAMESPACE', 'infrabox-worker')
+
+    if args.workload != 'all':
+        run(args.workload, args)
+        return
+
+    # every workload gets a fresh process, the scheduler can't be stopped.
+    # The last --workload wins
+    for w in WORKLOADS:
+        subprocess.check_call([sys.executable, __file__] + sys.argv[1:] + ['--workload', w])
+
+if __name__ == '__main__':
+    main()
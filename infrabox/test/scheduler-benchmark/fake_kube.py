@@ -0,0 +1,302 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+ID_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+IBJOBS = re.compile(r'^/apis/core.infrabox.net/v1alpha1/namespaces/([^/]+)/ibjobs(?:/([^/]+))?$')
+NAMESPACES = re.compile(r'^/api/v1/namespaces(?:/([^/]+))?$')
+SECRETS = re.compile(r'^/api/v1/namespaces/([^/]+)/secrets$')
+RBAC = re.compile(r'^/apis/rbac.authorization.k8s.io/v1beta1/namespaces/([^/]+)/(roles|rolebindings)$')
+
+class Collection(object):
+    """ Objects of one kind together with their watch events """
+
+    def __init__(self, kube):
+        self.kube = kube
+        self.objects = {}
+        self.events = []
+
+    def add_event(self, event_type, obj):
+        # called with the kube lock held
+        self.events.append((int(obj['metadata']['resourceVersion']), event_type, obj))
+        self.kube.cond.notify_all()
+
+class FakeKube(object):
+    """ In-process kubernetes API server with the endpoints the scheduler
+    uses: nodes, namespaces, secrets, RBAC objects and IBJobs. It counts
+    all calls and tells the benchmark about created IBJobs. """
+
+    def __init__(self, nodes=10, node_cpu=16, node_memory=65536, watch_timeout=5):
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.resource_version = 0
+        self.ibjobs = Collection(self)
+        self.namespaces = Collection(self)
+        self.calls = Counter()
+        self.watch_timeout = watch_timeout
+        self.on_ibjob_created = None
+        self.ibjob_created_at = {}
+        self.nodes = [{
+            'metadata': {'name': 'node-%s' % i},
+            'spec': {},
+            'status': {
+                'capacity': {'cpu': str(node_cpu), 'memory': '%sKi' % (node_memory * 1024)},
+                'allocatable': {'cpu': str(node_cpu), 'memory': '%sKi' % (node_memory * 1024)}
+            }
+        } for i in range(nodes)]
+
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        kube = self
+
+        class Handler(FakeKubeHandler):
+            pass
+
+        Handler.kube = kube
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        return 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def next_resource_version(self):
+        self.resource_version += 1
+        return str(self.resource_version)
+
+    def record(self, method, path):
+        with self.lock:
+            self.calls['%s %s' % (method, ID_PATTERN.sub('{id}', path))] += 1
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def create(self, collection, obj):
+        """ Stores a new object, returns False if it already exists """
+        with self.lock:
+            name = obj['metadata']['name']
+            if name in collection.objects:
+                return False
+
+            obj['metadata']['resourceVersion'] = self.next_resource_version()
+            obj.setdefault('status', {})
+            collection.objects[name] = obj
+            collection.add_event('ADDED', obj)
+
+        return True
+
+    def delete(self, collection, name):
+        with self.lock:
+            obj = collection.objects.pop(name, None)
+            if not obj:
+                return False
+
+            obj = dict(obj)
+            obj['metadata'] = dict(obj['metadata'])
+            obj['metadata']['resourceVersion'] = self.next_resource_version()
+            collection.add_event('DELETED', obj)
+
+        return True
+
+    def add_ibjob(self, name):
+        """ Creates an IBJob without going through the API, e.g. for already running jobs """
+        self.create(self.ibjobs, {'metadata': {'name': name}, 'spec': {}})
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def match_labels(obj, selector):
+    if not selector:
+        return True
+
+    labels = obj['metadata'].get('labels', None) or {}
+    for term in selector.split(','):
+        if '=' in term:
+            key, value = term.split('=', 1)
+            if labels.get(key, None) != value:
+                return False
+        elif term not in labels:
+            return False
+
+    return True
+
+class FakeKubeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    kube = None
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return None
+
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def send(self, status, data=None):
+        body = json.dumps(data or {}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        path = url.path
+
+        if query.get('watch', None) != 'true':
+            self.kube.record(method, path)
+
+        if path == '/api/v1/nodes' and method == 'GET':
+            return self.send(200, {'items': self.kube.nodes})
+
+        m = IBJOBS.match(path)
+        if m:
+            return self.handle_object(method, self.kube.ibjobs, m.group(2), query)
+
+        m = SECRETS.match(path)
+        if m:
+            return self.send(200, {'items': [{
+                'type': 'kubernetes.io/service-account-token',
+                'data': {'ca.crt': 'ca', 'token': 'token', 'namespace': m.group(1)}
+            }]})
+
+        m = RBAC.match(path)
+        if m and method == 'POST':
+            self.read_body()
+            return self.send(201)
+
+        m = NAMESPACES.match(path)
+        if m:
+            return self.handle_object(method, self.kube.namespaces, m.group(1), query)
+
+        self.send(404, {'message': 'not found'})
+
+    def handle_object(self, method, collection, name, query):
+        kube = self.kube
+
+        if method == 'GET' and not name:
+            if query.get('watch', None) == 'true':
+                return self.watch(collection, query)
+
+            with kube.lock:
+                items = [o for o in collection.objects.values()
+                         if match_labels(o, query.get('labelSelector', None))]
+                rv = str(kube.resource_version)
+
+            return self.send(200, {'metadata': {'resourceVersion': rv}, 'items': items})
+
+        if method == 'POST' and not name:
+            obj = self.read_body()
+
+            if not kube.create(collection, obj):
+                return self.send(409, {'message': 'already exists'})
+
+            if collection is kube.ibjobs:
+                kube.ibjob_created_at[obj['metadata']['name']] = time.time()
+                if kube.on_ibjob_created:
+                    kube.on_ibjob_created(obj['metadata']['name'])
+
+            return self.send(201, obj)
+
+        if method == 'DELETE' and name:
+            if not kube.delete(collection, name):
+                return self.send(404, {'message': 'not found'})
+
+            return self.send(200)
+
+        if method == 'PATCH' and name:
+            return self.patch(collection, name, self.read_body())
+
+        self.send(405, {'message': 'method not allowed'})
+
+    def patch(self, collection, name, patch):
+        kube = self.kube
+
+        with kube.lock:
+            obj = collection.objects.get(name, None)
+            if not obj:
+                return self.send(404, {'message': 'not found'})
+
+            metadata = patch.get('metadata', {})
+            rv = metadata.get('resourceVersion', None)
+            if rv and rv != obj['metadata']['resourceVersion']:
+                return self.send(409, {'message': 'conflict'})
+
+            labels = obj['metadata'].setdefault('labels', {})
+            for k, v in metadata.get('labels', {}).items():
+                if v is None:
+                    labels.pop(k, None)
+                else:
+                    labels[k] = v
+
+            obj['metadata']['resourceVersion'] = kube.next_resource_version()
+            collection.add_event('MODIFIED', obj)
+
+        self.send(200, obj)
+
+    def watch(self, collection, query):
+        kube = self.kube
+        rv = int(query.get('resourceVersion', None) or 0)
+        timeout = min(int(query.get('timeoutSeconds', kube.watch_timeout)), kube.watch_timeout)
+        deadline = time.time() + timeout
+        selector = query.get('labelSelector', None)
+
+        # like the API server the events are sent chunked
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        while True:
+            with kube.lock:
+                events = [e for e in collection.events if e[0] > rv]
+
+                if not events:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.write_chunk(b'')
+                        return
+
+                    kube.cond.wait(remaining)
+                    continue
+
+            for event_rv, event_type, obj in events:
+                rv = event_rv
+
+                if not match_labels(obj, selector):
+                    continue
+
+                line = json.dumps({'type': event_type, 'object': obj}) + '\n'
+                try:
+                    self.write_chunk(line.encode('utf-8'))
+                except (IOError, OSError):
+                    return
+
+    def write_chunk(self, data):
+        self.wfile.write(('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
@@ -0,0 +1,150 @@
+""" Storage side of the chunked job cache.
+
+A job's cache is a manifest, stored per project and job name, which
+references chunks named by the sha256 of their content. The chunks are
+shared by all caches of a project. Chunks which are not referenced by
+any manifest anymore are removed by collect_garbage. """
+
+import hashlib
+import os
+import re
+import subprocess
+import tempfile
+import zlib
+
+from pyinfraboxutils import get_logger
+from pyinfraboxutils.storage import storage
+
+logger = get_logger('cache')
+
+CHUNK_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+# chunks younger than that are kept, a running job may be about to
+# upload a manifest referencing them
+GC_GRACE_PERIOD = '1 day'
+GC_BATCH_SIZE = 1000
+
+# a job closes a pack once it reaches 4 MiB, the last file which is
+# added is smaller than 256 KiB
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+
+# the first bytes of the chunks of the job's codecs, zlib chunks have none
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+RAW_MARKER = '\x00'
+
+def get_manifest_key(project_id, job_name):
+    key = 'project_%s_job_%s.manifest.json.gz' % (project_id, job_name)
+    return key.replace('/', '_')
+
+def get_chunk_key(project_id, chunk):
+    return 'chunks/%s/%s' % (project_id, chunk)
+
+def get_definitions_key(project_id, key):
+    return 'definitions/%s/%s.json.gz' % (project_id, key)
+
+def is_chunk(chunk):
+    return CHUNK_PATTERN.match(chunk) is not None
+
+def decompress_zstd(data):
+    with tempfile.NamedTemporaryFile() as f, open(os.devnull, 'w') as devnull:
+        f.write(data)
+        f.flush()
+
+        # read no more than a chunk may have, the data may expand to anything
+        p = subprocess.Popen(['zstd', '-q', '-dc', f.name], stdout=subprocess.PIPE, stderr=devnull)
+        content = None
+        try:
+            content = p.stdout.read(MAX_CHUNK_SIZE + 1)
+        finally:
+            if content is None or len(content) > MAX_CHUNK_SIZE:
+                p.kill()
+
+            p.wait()
+
+    if len(content) > MAX_CHUNK_SIZE:
+        return content
+
+    if p.returncode != 0:
+        return None
+
+    return content
+
+def decompress_chunk(data):
+    """ The content of a chunk written with any of the job's codecs, None
+    if it can't be decompressed or is too large """
+    try:
+        if data.startswith(ZSTD_MAGIC):
+            content = decompress_zstd(data)
+        elif data.startswith(RAW_MARKER):
+            content = data[len(RAW_MARKER):]
+        else:
+            d = zlib.decompressobj()
+            content = d.decompress(data, MAX_CHUNK_SIZE + 1)
+    except Exception as e:
+        logger.info('Failed to decompress chunk: %s', e)
+        return None
+
+    if content is None or len(content) > MAX_CHUNK_SIZE:
+        return None
+
+    return content
+
+def is_valid_chunk(chunk, data):
+    """ True if the content of the chunk data hashes to its name """
+    content = decompress_chunk(data)
+    return content is not None and hashlib.sha256(content).hexdigest() == chunk
+
+def clear_cache(db, project_id, job_name):
+    """ Drops the manifest, its chunks are collected later """
+    db.execute('''
+        DELETE FROM cache_manifest
+        WHERE project_id = %s
+        AND job_name = %s
+    ''', [project_id, job_name])
+    db.commit()
+
+    try:
+        storage.delete_cache(get_manifest_key(project_id, job_name))
+    except Exception as e:
+        logger.exception(e)
+
+def collect_garbage(db):
+    """ Deletes unreferenced chunks, returns how many """
+    deleted = 0
+
+    while True:
+        # only one api replica at a time, released with the transaction
+        if not db.execute_one('SELECT pg_try_advisory_xact_lock(hashtext(%s))', ['infrabox-cache-gc'])[0]:
+            db.rollback()
+            return deleted
+
+        # the rows stay locked until the objects are gone, so a job
+        # can't find a chunk which is being deleted
+        chunks = db.execute_many('''
+            DELETE FROM cache_chunk
+            WHERE (project_id, hash) IN (
+                SELECT c.project_id, c.hash
+                FROM cache_chunk c
+                WHERE c.last_used < now() - %s::interval
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM cache_manifest m
+                    WHERE m.project_id = c.project_id
+                    AND c.hash = ANY(m.chunks)
+                )
+                LIMIT %s
+            )
+            RETURNING project_id, hash
+        ''', [GC_GRACE_PERIOD, GC_BATCH_SIZE])
+
+        for project_id, chunk in chunks:
+            try:
+                storage.delete_cache(get_chunk_key(project_id, chunk))
+            except Exception as e:
+                logger.exception(e)
+
+        db.commit()
+        deleted += len(chunks)
+
+        if len(chunks) < GC_BATCH_SIZE:
+            return deleted
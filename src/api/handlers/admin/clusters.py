@@ -59,4 +59,60 @@ class Clusters(Resource):
                 'queued': r['queued_memory'],
             }
 
+        projects = g.db.execute_many_dict('''
+            SELECT j.cluster_name, p.id, p.name, p.scheduler_weight,
+                p.quota_cpu, p.quota_memory, p.quota_jobs,
+                SUM(CASE WHEN j.state IN ('scheduled', 'running') THEN 1 ELSE 0 END) active,
+                SUM(CASE WHEN j.state IN ('scheduled', 'running') THEN j.cpu ELSE 0 END) active_cpu,
+                SUM(CASE WHEN j.state IN ('scheduled', 'running') THEN j.memory ELSE 0 END) active_memory,
+                SUM(CASE WHEN j.state = 'queued' THEN 1 ELSE 0 END) queued
+            FROM job j
+            JOIN project p
+                ON p.id = j.project_id
+            WHERE j.state IN ('queued', 'scheduled', 'running')
+            GROUP BY j.cluster_name, p.id
+            ORDER BY p.name
+        ''')
+
+        # quotas apply to the jobs of a project on all clusters
+        usage = g.db.execute_many_dict('''
+            SELECT project_id, count(*) active, SUM(cpu) active_cpu, SUM(memory) active_memory
+            FROM job
+            WHERE state IN ('scheduled', 'running')
+            AND type != 'wait'
+            GROUP BY project_id
+        ''')
+        usage = dict((u['project_id'], u) for u in usage)
+        no_usage = {'active': 0, 'active_cpu': 0, 'active_memory': 0}
+
+        for c in clusters:
+            c['projects'] = []
+
+            for p in projects:
+                if p['cluster_name'] != c['name']:
+                    continue
+
+                u = usage.get(p['id'], no_usage)
+                c['projects'].append({
+                    'id': p['id'],
+                    'name': p['name'],
+                    'weight': p['scheduler_weight'],
+                    'jobs': {
+                        'active': p['active'],
+                        'queued': p['queued'],
+                        'total': u['active'],
+                        'quota': p['quota_jobs']
+                    },
+                    'cpu': {
+                        'active': p['active_cpu'],
+                        'total': u['active_cpu'],
+                        'quota': p['quota_cpu']
+                    },
+                    'memory': {
+                        'active': p['active_memory'],
+                        'total': u['active_memory'],
+                        'quota': p['quota_memory']
+                    }
+                })
+
         return clusters
@@ -1,11 +1,10 @@
 #pylint: disable=too-many-lines,too-few-public-methods,too-many-locals,too-many-statements,too-many-branches
 import os
 import json
-import time
 import uuid
-import copy
+import gzip
 import urllib
-from datetime import datetime
+import zlib
 
 import requests
 
@@ -20,19 +19,32 @@ from pyinfrabox.markup import validate_markup
 from pyinfrabox.testresult import validate_result
 from pyinfrabox import ValidationError
 
-from pyinfraboxutils import get_env
 from pyinfraboxutils.token import encode_job_token
 from pyinfraboxutils.ibrestplus import api
 from pyinfraboxutils.ibflask import job_token_required, app
 from pyinfraboxutils.storage import storage
 from pyinfraboxutils.secrets import decrypt_secret
+from pyinfraboxutils.jobgraph import insert_jobs, InvalidJobsError
+
+from api.cache import get_manifest_key, get_chunk_key, get_definitions_key, is_chunk
+from api.cache import is_valid_chunk, MAX_CHUNK_SIZE
 
 ns = api.namespace('api/job',
                    description='Job runtime related operations')
 
+# uncompressed, a job sends at most 1 MiB of output at once
+MAX_CONSOLE_UPDATE_SIZE = 4 * 1024 * 1024
+
 def allowed_file(filename, extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in extensions
 
+def update_heartbeat(job_id):
+    # one row per job, updated in place
+    g.db.execute("""
+        INSERT INTO job_heartbeat (job_id, last_seen) VALUES (%s, now())
+        ON CONFLICT (job_id) DO UPDATE SET last_seen = now()
+    """, [job_id])
+
 def delete_file(path):
     if os.path.exists(path):
         try:
@@ -455,6 +467,200 @@ class Cache(Resource):
         return jsonify({})
 
 
+cache_manifest_upload_parser = api.parser()
+cache_manifest_upload_parser.add_argument('manifest.json.gz', location='files',
+                                          type=FileStorage, required=True)
+
+@ns.route("/cache/manifest")
+class CacheManifest(Resource):
+
+    @job_token_required
+    def get(self):
+        project_id = g.token['project']['id']
+        job_name = g.token['job']['name']
+
+        g.release_db()
+
+        f = storage.download_cache(get_manifest_key(project_id, job_name))
+
+        if not f:
+            abort(404)
+
+        return send_file(f)
+
+    @job_token_required
+    @ns.expect(cache_manifest_upload_parser)
+    def post(self):
+        project_id = g.token['project']['id']
+        job_name = g.token['job']['name']
+
+        stream = request.files['manifest.json.gz'].stream
+
+        try:
+            manifest = json.loads(gzip.GzipFile(fileobj=stream).read())
+            chunks = list(manifest['chunks'].keys())
+        except:
+            abort(400, 'Invalid manifest')
+
+        unknown = g.db.execute_many('''
+            SELECT h FROM unnest(%s::character varying[]) h
+            WHERE NOT EXISTS (
+                SELECT 1 FROM cache_chunk c
+                WHERE c.project_id = %s
+                AND c.hash = h
+            )
+        ''', [chunks, project_id])
+
+        if unknown:
+            abort(400, 'Manifest references unknown chunks')
+
+        stream.seek(0)
+        storage.upload_cache(stream, get_manifest_key(project_id, job_name))
+
+        g.db.execute('''
+            INSERT INTO cache_manifest (project_id, job_name, chunks)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (project_id, job_name)
+            DO UPDATE SET chunks = EXCLUDED.chunks, updated_at = now()
+        ''', [project_id, job_name, chunks])
+        g.db.commit()
+
+        return jsonify({})
+
+@ns.route("/cache/chunks/missing")
+class CacheChunksMissing(Resource):
+
+    @job_token_required
+    def post(self):
+        project_id = g.token['project']['id']
+        chunks = request.json['chunks']
+
+        # keeps the chunks we have from being collected while the job
+        # uploads the rest
+        found = g.db.execute_many('''
+            UPDATE cache_chunk
+            SET last_used = now()
+            WHERE project_id = %s
+            AND hash = ANY(%s::character varying[])
+            RETURNING hash
+        ''', [project_id, chunks])
+        g.db.commit()
+
+        found = set(f[0] for f in found)
+        return jsonify({'chunks': [c for c in chunks if c not in found]})
+
+cache_chunk_upload_parser = api.parser()
+cache_chunk_upload_parser.add_argument('chunk', location='files',
+                                       type=FileStorage, required=True)
+
+@ns.route("/cache/chunks/<chunk>")
+class CacheChunk(Resource):
+
+    @job_token_required
+    def get(self, chunk):
+        project_id = g.token['project']['id']
+
+        if not is_chunk(chunk):
+            abort(400, 'Invalid chunk')
+
+        g.release_db()
+
+        f = storage.download_cache(get_chunk_key(project_id, chunk))
+
+        if not f:
+            abort(404)
+
+        return send_file(f)
+
+    @job_token_required
+    @ns.expect(cache_chunk_upload_parser)
+    def post(self, chunk):
+        project_id = g.token['project']['id']
+
+        if not is_chunk(chunk):
+            abort(400, 'Invalid chunk')
+
+        # chunks are shared by all jobs of the project, an existing one is
+        # never replaced
+        existing = g.db.execute_one('''
+            UPDATE cache_chunk
+            SET last_used = now()
+            WHERE project_id = %s
+            AND hash = %s
+            RETURNING hash
+        ''', [project_id, chunk])
+
+        if existing:
+            g.db.commit()
+            return jsonify({})
+
+        stream = request.files['chunk'].stream
+        data = stream.read(MAX_CHUNK_SIZE + 1)
+
+        if len(data) > MAX_CHUNK_SIZE or not is_valid_chunk(chunk, data):
+            abort(400, 'Chunk content does not match its hash')
+
+        stream.seek(0)
+        storage.upload_cache(stream, get_chunk_key(project_id, chunk))
+
+        g.db.execute('''
+            INSERT INTO cache_chunk (project_id, hash, size)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (project_id, hash)
+            DO UPDATE SET last_used = now()
+        ''', [project_id, chunk, len(data)])
+        g.db.commit()
+
+        return jsonify({})
+
+cache_definitions_upload_parser = api.parser()
+cache_definitions_upload_parser.add_argument('definitions.json.gz', location='files',
+                                             type=FileStorage, required=True)
+
+@ns.route("/cache/definitions/<key>")
+class CacheDefinitions(Resource):
+    """ The parsed infrabox.json files of a repository which is included
+    at a fixed commit, the key is the sha256 of the include """
+
+    @job_token_required
+    def get(self, key):
+        project_id = g.token['project']['id']
+
+        if not is_chunk(key):
+            abort(400, 'Invalid key')
+
+        g.release_db()
+
+        f = storage.download_cache(get_definitions_key(project_id, key))
+
+        if not f:
+            abort(404)
+
+        return send_file(f)
+
+    @job_token_required
+    @ns.expect(cache_definitions_upload_parser)
+    def post(self, key):
+        project_id = g.token['project']['id']
+        job_id = g.token['job']['id']
+
+        if not is_chunk(key):
+            abort(400, 'Invalid key')
+
+        # the definitions become jobs of later builds, no job
+        # running user code may write them
+        r = g.db.execute_one("SELECT type FROM job WHERE id = %s", [job_id])
+
+        if not r or r[0] != 'create_job_matrix':
+            abort(403, 'Only the job creating the jobs may cache definitions')
+
+        g.release_db()
+
+        stream = request.files['definitions.json.gz'].stream
+        storage.upload_cache(stream, get_definitions_key(project_id, key))
+
+        return jsonify({})
+
 @ns.route("/archive")
 class Archive(Resource):
 
@@ -607,288 +813,37 @@ class SetRunning(Resource):
         g.db.execute("""
             UPDATE job SET state = 'running', start_date = current_timestamp
             WHERE id = %s""", [job_id])
+        update_heartbeat(job_id)
         g.db.commit()
 
         return jsonify({})
 
-def find_leaf_jobs(jobs):
-    parent_jobs = {}
-    leaf_jobs = []
+@ns.route("/heartbeat")
+class Heartbeat(Resource):
 
-    for j in jobs:
-        for d in j.get('depends_on', []):
-            parent_jobs[d['job']] = True
+    @job_token_required
+    def post(self):
+        job_id = g.token['job']['id']
 
-    for j in jobs:
-        if not parent_jobs.get(j['name'], False):
-            leaf_jobs.append(j)
+        update_heartbeat(job_id)
+        g.db.commit()
 
-    return leaf_jobs
+        return jsonify({})
 
 @ns.route("/create_jobs")
 class CreateJobs(Resource):
-    def get_target_cluster(self, clusters, cluster_selector):
-        for c in clusters:
-            matches = True
-            for s in cluster_selector:
-                if s not in c['labels']:
-                    matches = False
-                    break
-
-            if matches:
-                return c['name']
-
-        return None
-
-    def assign_cluster(self, jobs):
-        clusters = g.db.execute_many_dict('''
-            SELECT name, labels
-            FROM cluster
-        ''')
-
-        assigned_clusters = {}
-
-        for j in jobs:
-            if 'cluster' not in j:
-                j['cluster'] = {}
-
-            cluster_selector = j['cluster'].get('selector', None)
-            target_cluster = None
-
-            # Find a cluster which matches the selector
-            if cluster_selector:
-                target_cluster = self.get_target_cluster(clusters, cluster_selector)
-
-                if not target_cluster:
-                    abort(400, 'Could not find a cluster which could satisfy the selector: %s' %
-                          json.dumps(cluster_selector))
-
-            # Use the same cluster as the parent if there's not selector
-            if not target_cluster:
-                target_cluster = 'master'
-                for d in j.get('depends_on', []):
-                    target_cluster = assigned_clusters.get(d['job'], 'master')
-                    break
-
-            assigned_clusters[j['name']] = target_cluster
-            j['cluster']['name'] = target_cluster
 
     @job_token_required
     def post(self):
-        project_id = g.token['project']['id']
-        parent_job_id = g.token['job']['id']
-
-        d = request.json
-        jobs = d['jobs']
+        jobs = request.json['jobs']
 
         if not jobs:
             return "No jobs"
 
-        # Check if capabilities are set and allowed
-        if get_env('INFRABOX_JOB_SECURITY_CONTEXT_CAPABILITIES_ENABLED') != 'true':
-            for job in jobs:
-                sc = job.get('security_context', None)
-                if not sc:
-                    continue
-
-                if sc.get('capabilities', None):
-                    abort(400, 'Capabilities are disabled')
-
-        result = g.db.execute_one("SELECT env_var, build_id FROM job WHERE id = %s", [parent_job_id])
-        base_env_var = result[0]
-        build_id = result[1]
-
-        # Get some project info
-        result = g.db.execute_one("""
-            SELECT co.user_id, b.build_number, j.project_id FROM collaborator co
-            INNER JOIN job j
-                ON j.project_id = co.project_id
-                AND co.owner = true
-                AND j.id = %s
-            INNER JOIN build b
-                ON b.id = j.build_id
-        """, [parent_job_id])
-
-        build_number = result[1]
-        project_id = result[2]
-
-        # name->id mapping
-        jobname_id = {}
-        for job in jobs:
-            name = job["name"]
-            job_id = job['id']
-            jobname_id[name] = job_id
-
-        for job in jobs:
-            job['env_var_refs'] = None
-            job['env_vars'] = copy.deepcopy(base_env_var)
-
-            if job['type'] == "wait":
-                continue
-
-            avg_duration = g.db.execute_one("""
-                SELECT EXTRACT(EPOCH FROM avg(j.end_date - j.start_date))
-                FROM job j
-                INNER JOIN build b
-                    ON b.id = j.build_id
-                    AND j.project_id = %s
-                    AND b.project_id = %s
-                    AND b.build_number between %s and %s
-                    AND j.name = %s
-                    AND j.state = 'finished'
-            """, [project_id, project_id, build_number - 10, build_number, job['name']])[0]
-
-            job['avg_duration'] = avg_duration
-
-            # Handle environment vars
-            if 'environment' in job:
-                for ename in job['environment']:
-                    value = job['environment'][ename]
-
-                    if isinstance(value, dict):
-                        env_var_ref_name = value['$secret']
-                        result = g.db.execute_many("""
-                                    SELECT value FROM secret WHERE name = %s and project_id = %s
-                                    """, [env_var_ref_name, project_id])
-
-                        if not result:
-                            abort(400, "Secret '%s' not found" % env_var_ref_name)
-
-                        if not job['env_var_refs']:
-                            job['env_var_refs'] = {}
-
-                        job['env_var_refs'][ename] = env_var_ref_name
-                    else:
-                        if not job['env_vars']:
-                            job['env_vars'] = {}
-
-                        job['env_vars'][ename] = value
-
-        jobs.sort(key=lambda k: k.get('avg_duration', 0), reverse=True)
-
-        if g.token['job']['name'] != 'Create Jobs':
-            # Update names, prefix with parent names
-            for j in jobs:
-                j['name'] = g.token['job']['name'] + '/' + j['name']
-
-            leaf_jobs = find_leaf_jobs(jobs)
-
-            for j in leaf_jobs:
-                wait_job = {
-                    'job': j['name'],
-                    'job-id': j['id'],
-                    'on': ['finished']
-                }
-
-                # Update direct children of this job to now wait for the leaf jobs
-                g.db.execute('''
-                    UPDATE job
-                    SET dependencies = dependencies || %s::jsonb
-                    WHERE id IN (
-                        SELECT id parent_id
-                        FROM job, jsonb_array_elements(job.dependencies) as deps
-                        WHERE (deps->>'job-id')::uuid = %s
-                            AND build_id = %s
-                            AND project_id = %s
-                    )
-                ''', [json.dumps(wait_job), job_id, build_id, project_id])
-
-        self.assign_cluster(jobs)
-
-        for job in jobs:
-            name = job["name"]
-
-            job_type = job["type"]
-            job_id = job['id']
-
-            build_only = job.get("build_only", True)
-            depends_on = job.get("depends_on", [])
-
-            if depends_on:
-                for dep in depends_on:
-                    dep['job-id'] = jobname_id[dep['job']]
-            else:
-                depends_on = [{"job": g.token['job']['name'], "job-id": parent_job_id, "on": ["finished"]}]
-
-            if job_type == "docker":
-                f = job['docker_file']
-                t = 'run_project_container'
-            elif job_type == "docker-image":
-                f = None
-                t = 'run_project_container'
-            elif job_type == "docker-compose":
-                f = job['docker_compose_file']
-                t = 'run_docker_compose'
-            elif job_type == "wait":
-                f = None
-                t = 'wait'
-            else:
-                abort(400, "Unknown job type: %s" % job_type)
-
-            limits_cpu = 1
-            limits_memory = 1024
-            timeout = job.get('timeout', 3600)
-
-            if 'resources' in job and 'limits' in job['resources']:
-                limits_cpu = job['resources']['limits']['cpu']
-                limits_memory = job['resources']['limits']['memory']
-
-            # Create external git repo if necessary
-            repo = job.get('repo', None)
-            if repo:
-                repo['clone_all'] = False
-                repo = json.dumps(repo)
-
-            # Handle build arguments
-            build_arguments = None
-            if 'build_arguments' in job:
-                build_arguments = json.dumps(job['build_arguments'])
-
-            # Handle Deployments
-            deployments = None
-            if 'deployments' in job:
-                deployments = json.dumps(job['deployments'])
-
-            # Handle env vars
-            env_vars = None
-            if 'env_vars' in job:
-                env_vars = json.dumps(job['env_vars'])
-
-            # Handle env var refs
-            env_var_refs = None
-            if 'env_var_refs' in job:
-                env_var_refs = json.dumps(job['env_var_refs'])
-
-            # Handle resources
-            resources = None
-            if 'resources' in job:
-                resources = json.dumps(job['resources'])
-
-            if 'services' in job:
-                for s in job['services']:
-                    if 'labels' not in s['metadata']:
-                        s['metadata']['labels'] = {}
-
-                    s['metadata']['labels']['service.infrabox.net/id'] = str(uuid.uuid4())
-
-            # Create job
-            g.db.execute("""
-                         INSERT INTO job (id, state, build_id, type, dockerfile, name,
-                             project_id, dependencies, build_only,
-                             created_at, repo,
-                             env_var_ref, env_var, build_arg, deployment, cpu, memory,
-                             timeout, resources, definition, cluster_name)
-                         VALUES (%s, 'queued', %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                                 %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                         """, [job_id, build_id, t, f, name,
-                               project_id,
-                               json.dumps(depends_on), build_only, datetime.now(),
-                               repo, env_var_refs, env_vars,
-                               build_arguments, deployments, limits_cpu, limits_memory, timeout,
-                               resources, json.dumps(job), job['cluster']['name']])
-
-            # to make sure the get picked up in the right order by the scheduler
-            time.sleep(0.1)
+        try:
+            insert_jobs(g.db, g.token['job']['id'], g.token['job']['name'], jobs)
+        except InvalidJobsError as e:
+            abort(400, e.message)
 
         g.db.commit()
         return "Successfully create jobs"
@@ -896,9 +851,23 @@ class CreateJobs(Resource):
 @ns.route("/consoleupdate")
 class ConsoleUpdate(Resource):
 
+    @staticmethod
+    def get_output():
+        if request.headers.get('Content-Encoding', None) != 'gzip':
+            return request.json['output']
+
+        # bounded, the request may expand to anything
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = d.decompress(request.get_data(), MAX_CONSOLE_UPDATE_SIZE + 1)
+
+        if len(data) > MAX_CONSOLE_UPDATE_SIZE:
+            abort(400, "Console update too big")
+
+        return json.loads(data)['output']
+
     @job_token_required
     def post(self):
-        output = request.json['output']
+        output = self.get_output()
 
         job_id = g.token['job']['id']
 
@@ -922,7 +891,15 @@ class ConsoleUpdate(Resource):
             g.db.execute("INSERT INTO console (job_id, output) VALUES (%s, %s)", [job_id, output])
             g.db.commit()
         except:
-            pass
+            g.db.rollback()
+
+        # console updates count as heartbeats
+        try:
+            update_heartbeat(job_id)
+            g.db.commit()
+        except Exception as e:
+            app.logger.warn("Failed to update the heartbeat of %s: %s", job_id, e)
+            g.db.rollback()
 
         return jsonify({})
 
@@ -1255,6 +1232,7 @@ class SetFinished(Resource):
 
         # remove form console table
         g.db.execute("DELETE FROM console WHERE job_id = %s", [job_id])
+        g.db.execute("DELETE FROM job_heartbeat WHERE job_id = %s", [job_id])
 
         g.db.commit()
         return jsonify({})
@@ -18,6 +18,7 @@ from pyinfraboxutils.ibflask import auth_required, OK
 from pyinfraboxutils.ibrestplus import api
 from pyinfraboxutils.storage import storage
 from pyinfraboxutils.token import encode_project_token
+from pyinfraboxutils.jobgraph import create_upload_jobs
 
 logger = get_logger('api')
 
@@ -364,12 +365,15 @@ if os.environ['INFRABOX_CLUSTER_NAME'] == 'master':
                 VALUES (null, %s, %s, %s, %s)
             ''', [build_number, project_id, source_upload_id, build_id])
 
-            g.db.execute('''
+            job_id = g.db.execute_one('''
                 INSERT INTO job (id, state, build_id, type, name, project_id,
                                  dockerfile, build_only, cpu, memory)
                 VALUES (gen_random_uuid(), 'queued', %s, 'create_job_matrix',
-                        'Create Jobs', %s, '', false, 1, 1024);
-            ''', [build_id, project_id])
+                        'Create Jobs', %s, '', false, 1, 1024)
+                RETURNING id
+            ''', [build_id, project_id])[0]
+
+            create_upload_jobs(g.db, job_id, stream)
 
             project_name = g.db.execute_one('''
                 SELECT name FROM project WHERE id = %s
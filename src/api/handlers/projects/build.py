@@ -5,7 +5,9 @@ from flask_restplus import Resource
 
 from pyinfraboxutils.ibflask import auth_required, OK
 from pyinfraboxutils.storage import storage
+from pyinfraboxutils.jobgraph import create_jobs, fetch_github_definition
 from api.namespaces import project as ns
+from api.cache import clear_cache
 
 def restart_build(project_id, build_id):
     user_id = g.token['user']['id']
@@ -33,6 +35,21 @@ def restart_build(project_id, build_id):
 
     restart_counter = result['restart_counter'] + 1
 
+    job = g.db.execute_one_dict('''
+           SELECT repo, env_var, definition FROM job
+           WHERE project_id = %s
+           AND name = 'Create Jobs'
+           AND build_id = %s
+    ''', [project_id, build_id])
+
+    project = g.db.execute_one('''
+        SELECT type FROM project WHERE id = %s
+    ''', [project_id])
+
+    github_definition = None
+    if project[0] == 'github' and job['repo']:
+        github_definition = fetch_github_definition(g.db, project_id, job['repo']['commit'])
+
     result = g.db.execute_one_dict('''
         INSERT INTO build (commit_id, build_number,
                            project_id, restart_counter, source_upload_id)
@@ -45,13 +62,6 @@ def restart_build(project_id, build_id):
 
     new_build_id = result['id']
 
-    job = g.db.execute_one_dict('''
-           SELECT repo, env_var, definition FROM job
-           WHERE project_id = %s
-           AND name = 'Create Jobs'
-           AND build_id = %s
-    ''', [project_id, build_id])
-
     env_var = job['env_var']
     if env_var:
         env_var = json.dumps(env_var)
@@ -64,12 +74,16 @@ def restart_build(project_id, build_id):
     if definition:
         definition = json.dumps(definition)
 
-    g.db.execute('''
+    job_id = g.db.execute_one('''
         INSERT INTO job (id, state, build_id, type,
             name, cpu, memory, project_id, build_only, dockerfile, repo, env_var, definition)
         VALUES (gen_random_uuid(), 'queued', %s, 'create_job_matrix',
-                'Create Jobs', 1, 1024, %s, false, '', %s, %s, %s);
-    ''', [new_build_id, project_id, repo, env_var, definition])
+                'Create Jobs', 1, 1024, %s, false, '', %s, %s, %s)
+        RETURNING id
+    ''', [new_build_id, project_id, repo, env_var, definition])[0]
+
+    create_jobs(g.db, job_id, github_definition, job['repo'])
+
     g.db.commit()
 
     return OK('Restarted', {'build': {'id': new_build_id, 'restartCounter': restart_counter}})
@@ -126,6 +140,7 @@ class BuildCacheClear(Resource):
         for j in jobs:
             key = 'project_%s_branch_%s_job_%s.tar.gz' % (project_id, j['branch'], j['name'])
             storage.delete_cache(key)
+            clear_cache(g.db, project_id, j['name'])
 
         return OK('Cleared cache')
 
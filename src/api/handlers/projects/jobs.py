@@ -8,6 +8,8 @@ from pyinfraboxutils import get_logger
 from pyinfraboxutils.ibflask import auth_required, OK
 from pyinfraboxutils.storage import storage
 from api.namespaces import project as ns
+from pyinfraboxutils.rightsizing import get_recommendations
+from api.cache import clear_cache
 
 logger = get_logger('api')
 
@@ -174,6 +176,13 @@ class Jobs(Resource):
         return result
 
 
+@ns.route('/<project_id>/jobs/resources')
+class Resources(Resource):
+
+    @auth_required(['user'])
+    def get(self, project_id):
+        return get_recommendations(g.db, project_id)
+
 @ns.route('/<project_id>/jobs/<job_id>/restart')
 class JobRestart(Resource):
 
@@ -522,5 +531,6 @@ class JobCacheClear(Resource):
 
         key = 'project_%s_branch_%s_job_%s.tar.gz' % (project_id, job['branch'], job['name'])
         storage.delete_cache(key)
+        clear_cache(g.db, project_id, job['name'])
 
         return OK('Cleared cache')
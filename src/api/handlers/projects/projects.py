@@ -32,6 +32,10 @@ add_project_schema = {
 
 add_project_model = ns.schema_model('AddProject', add_project_schema)
 
+project_settings_model = api.model('ProjectSettings', {
+    'cancel_superseded_builds': fields.Boolean(required=True)
+})
+
 @ns.route('/')
 class Projects(Resource):
 
@@ -278,3 +282,33 @@ class Project(Resource):
         g.db.commit()
 
         return OK('deleted project')
+
+@ns.route('/<project_id>/settings')
+class ProjectSettings(Resource):
+
+    @auth_required(['user'])
+    @api.marshal_with(project_settings_model)
+    def get(self, project_id):
+        settings = g.db.execute_one_dict('''
+            SELECT cancel_superseded_builds
+            FROM project
+            WHERE id = %s
+        ''', [project_id])
+
+        if not settings:
+            abort(404)
+
+        return settings
+
+    @auth_required(['user'], check_project_owner=True)
+    @api.expect(project_settings_model)
+    def post(self, project_id):
+        b = request.get_json()
+
+        # abort older builds of the same branch or pull request when a new one starts
+        g.db.execute('''
+            UPDATE project SET cancel_superseded_builds = %s WHERE id = %s
+        ''', [bool(b['cancel_superseded_builds']), project_id])
+        g.db.commit()
+
+        return OK('Successfully updated settings')
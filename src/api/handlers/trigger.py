@@ -8,6 +8,7 @@ from flask import abort, request, g
 
 from pyinfraboxutils.ibflask import auth_required, OK
 from pyinfraboxutils.ibrestplus import api
+from pyinfraboxutils.jobgraph import create_jobs, fetch_github_definition
 from project import ns
 
 def execute_github_api(url, token):
@@ -156,6 +157,10 @@ def create_gerrit_commit(project_id, repo_id, branch_or_sha):
     return commit
 
 def create_git_job(commit, build_no, project_id, repo, project_type, env):
+    definition = None
+    if project_type == 'github':
+        definition = fetch_github_definition(g.db, project_id, commit['sha'])
+
     build = g.db.execute_one('''
         INSERT INTO build (commit_id, build_number, project_id)
         VALUES (%s, %s, %s)
@@ -177,12 +182,15 @@ def create_git_job(commit, build_no, project_id, repo, project_type, env):
         for e in env:
             env_var[e['name']] = e['value']
 
-    g.db.execute('''
+    job_id = g.db.execute_one('''
         INSERT INTO job (id, state, build_id, type, name, project_id,
                          build_only, dockerfile, cpu, memory, repo, env_var, cluster_name)
         VALUES (gen_random_uuid(), 'queued', %s, 'create_job_matrix',
                 'Create Jobs', %s, false, '', 1, 1024, %s, %s, 'master')
-    ''', [build['id'], project_id, json.dumps(git_repo), json.dumps(env_var)])
+        RETURNING id
+    ''', [build['id'], project_id, json.dumps(git_repo), json.dumps(env_var)])[0]
+
+    create_jobs(g.db, job_id, definition, git_repo)
 
     return (build['id'], build['build_number'])
 
@@ -20,12 +20,26 @@ from pyinfraboxutils import dbpool
 
 import handlers
 import settings
+from api.cache import collect_garbage
 
 import listeners.console
 import listeners.job
 
 logger = get_logger('api')
 
+def collect_cache_garbage():
+    while True:
+        eventlet.sleep(3600)
+
+        db = dbpool.get()
+        try:
+            deleted = collect_garbage(db)
+            logger.info('Deleted %s unreferenced cache chunks', deleted)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            dbpool.put(db)
+
 @app.route('/ping')
 def ping():
     return jsonify({'status': 200})
@@ -250,6 +264,7 @@ def main(): # pragma: no cover
     logger.info('Starting DB listeners')
     sio.start_background_task(listeners.job.listen, sio)
     sio.start_background_task(listeners.console.listen, sio, client_manager)
+    sio.start_background_task(collect_cache_garbage)
 
     port = int(os.environ.get('INFRABOX_PORT', 8080))
     logger.info('Starting Server on port %s', port)
@@ -66,6 +66,9 @@ type Controller struct {
 	tag                          string
 	dockerRegistry               string
 	localCacheHostPath           string
+	gitMirrorEnabled             string
+	gitMirrorHostPath            string
+	gitMirrorMaxAge              string
 	gerritEnabled                string
 	gerritUsername               string
 	gerritHostname               string
@@ -120,6 +123,9 @@ func NewController(
 		tag:                          os.Getenv("INFRABOX_VERSION"),
 		dockerRegistry:               os.Getenv("INFRABOX_GENERAL_DOCKER_REGISTRY"),
 		localCacheHostPath:           os.Getenv("INFRABOX_LOCAL_CACHE_HOST_PATH"),
+		gitMirrorEnabled:             os.Getenv("INFRABOX_GIT_MIRROR_ENABLED"),
+		gitMirrorHostPath:            os.Getenv("INFRABOX_GIT_MIRROR_HOST_PATH"),
+		gitMirrorMaxAge:              os.Getenv("INFRABOX_GIT_MIRROR_MAX_AGE"),
 		gerritEnabled:                os.Getenv("INFRABOX_GERRIT_ENABLED"),
 	}
 
@@ -394,6 +400,34 @@ func (c *Controller) newBatchJob(job *jobv1alpha1.IBJob, token string) *batchv1.
 		})
 	}
 
+	if c.gitMirrorEnabled == "true" {
+		// only mounted into the clone container, the jobs
+		// must not see the repositories of other projects
+		hostPathType := corev1.HostPathDirectoryOrCreate
+		volumes = append(volumes, corev1.Volume{
+			Name: "git-mirror",
+			VolumeSource: corev1.VolumeSource{
+				HostPath: &corev1.HostPathVolumeSource{
+					Path: c.gitMirrorHostPath,
+					Type: &hostPathType,
+				},
+			},
+		})
+
+		cloneVolumeMounts = append(cloneVolumeMounts, corev1.VolumeMount{
+			MountPath: "/git-mirror",
+			Name:      "git-mirror",
+		})
+
+		cloneEnv = append(cloneEnv, corev1.EnvVar{
+			Name:  "INFRABOX_JOB_GIT_MIRROR_PATH",
+			Value: "/git-mirror",
+		}, corev1.EnvVar{
+			Name:  "INFRABOX_JOB_GIT_MIRROR_MAX_AGE",
+			Value: c.gitMirrorMaxAge,
+		})
+	}
+
 	for _, s := range job.Spec.Services {
 		id, _ := s.Metadata.Labels["service.infrabox.net/id"]
 
@@ -0,0 +1,12 @@
+CREATE FUNCTION abort_notify() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+BEGIN
+    PERFORM pg_notify('job_abort', json_build_object('job_id', NEW.job_id)::text);
+
+    RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER abort_notify_insert AFTER INSERT ON abort FOR EACH ROW EXECUTE PROCEDURE abort_notify();
@@ -0,0 +1 @@
+ALTER TABLE job ADD COLUMN priority integer DEFAULT 0 NOT NULL;
@@ -0,0 +1,4 @@
+ALTER TABLE project ADD COLUMN scheduler_weight integer DEFAULT 1 NOT NULL;
+ALTER TABLE project ADD COLUMN quota_cpu integer;
+ALTER TABLE project ADD COLUMN quota_memory integer;
+ALTER TABLE project ADD COLUMN quota_jobs integer;
@@ -0,0 +1 @@
+CREATE INDEX console_job_id_idx ON console USING btree (job_id, date);
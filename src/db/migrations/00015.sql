@@ -0,0 +1,7 @@
+CREATE TABLE job_heartbeat (
+    job_id uuid NOT NULL,
+    last_seen timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT job_heartbeat_pkey PRIMARY KEY (job_id)
+);
+
+ALTER TABLE job ADD COLUMN requeue_count integer DEFAULT 0 NOT NULL;
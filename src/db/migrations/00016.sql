@@ -0,0 +1,2 @@
+ALTER TABLE project ADD COLUMN cancel_superseded_builds boolean DEFAULT false NOT NULL;
+ALTER TABLE build ADD COLUMN superseded_by uuid;
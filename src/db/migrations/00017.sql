@@ -0,0 +1,15 @@
+CREATE TABLE cache_chunk (
+    project_id uuid NOT NULL,
+    hash character varying NOT NULL,
+    size bigint NOT NULL,
+    last_used timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT cache_chunk_pkey PRIMARY KEY (project_id, hash)
+);
+
+CREATE TABLE cache_manifest (
+    project_id uuid NOT NULL,
+    job_name character varying NOT NULL,
+    chunks character varying[] NOT NULL,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL,
+    CONSTRAINT cache_manifest_pkey PRIMARY KEY (project_id, job_name)
+);
@@ -1,12 +1,17 @@
 import json
 import datetime
+import subprocess
+import tarfile
+from StringIO import StringIO
 
 import paramiko
 
 import psycopg2
 
 from pyinfraboxutils import get_logger, get_env, print_stackdriver
-from pyinfraboxutils.db import connect_db
+from pyinfraboxutils.db import connect_db, DB
+from pyinfraboxutils.superseded import abort_superseded_builds
+from pyinfraboxutils.jobgraph import create_jobs, is_enabled, MAX_DEFINITION_SIZE
 
 logger = get_logger("gerrit")
 
@@ -57,6 +62,31 @@ def main():
                 conn = connect_db()
                 logger.info("reconnected to db")
 
+def get_gerrit_definition(clone_url, ref):
+    """ The infrabox.json of a patch set, from an archive of only this file """
+    archive = subprocess.check_output(['timeout', '10', 'git', 'archive', '--format=tar',
+                                       '--remote=' + clone_url, ref, 'infrabox.json'])
+
+    t = tarfile.open(fileobj=StringIO(archive))
+    info = t.getmember('infrabox.json')
+
+    if info.size > MAX_DEFINITION_SIZE:
+        return None
+
+    return t.extractfile(info).read()
+
+def fetch_gerrit_definition(clone_url, ref):
+    """ The infrabox.json for create_jobs of a patch set, None if the
+    job has to create the jobs itself """
+    if not is_enabled():
+        return None
+
+    try:
+        return get_gerrit_definition(clone_url, ref)
+    except Exception as e:
+        # e.g. archives are disabled on the gerrit server
+        logger.warn('Failed to get infrabox.json from gerrit: %s', e)
+        return None
 
 def handle_patchset_created_project(conn, event, project_id, project_name):
     if event['patchSet']['isDraft']:
@@ -72,6 +102,19 @@ def handle_patchset_created_project(conn, event, project_id, project_name):
 
     logger.info("Repository ID: %s", repository_id)
 
+    git_repo = {
+        "commit": sha,
+        "clone_url": "ssh://%s@%s:%s/%s" % (get_env('INFRABOX_GERRIT_USERNAME'),
+                                            get_env('INFRABOX_GERRIT_HOSTNAME'),
+                                            get_env('INFRABOX_GERRIT_PORT'),
+                                            project_name),
+        "ref": event['patchSet']['ref'],
+        "event": event['change']['branch']
+    }
+
+    # before writing anything, gerrit may take a while to answer
+    definition = fetch_gerrit_definition(git_repo['clone_url'], git_repo['ref'])
+
     c = conn.cursor()
     c.execute('SELECT * FROM "commit" WHERE project_id = %s and id = %s', [project_id, sha])
     result = c.fetchone()
@@ -147,25 +190,23 @@ def handle_patchset_created_project(conn, event, project_id, project_name):
         "GERRIT_UPLOADER_EMAIL": event['uploader']['email']
     }
 
-    git_repo = {
-        "commit": sha,
-        "clone_url": "ssh://%s@%s:%s/%s" % (get_env('INFRABOX_GERRIT_USERNAME'),
-                                            get_env('INFRABOX_GERRIT_HOSTNAME'),
-                                            get_env('INFRABOX_GERRIT_PORT'),
-                                            project_name),
-        "ref": event['patchSet']['ref'],
-        "event": event['change']['branch']
-    }
-
     c = conn.cursor()
     c.execute('''INSERT INTO job (id, state, build_id, type, name,
                                  project_id, build_only, dockerfile,
                                  cpu, memory, repo, env_var, cluster_name)
                 VALUES (gen_random_uuid(), 'queued', %s, 'create_job_matrix', 'Create Jobs',
-                        %s, false, '', 1, 1024, %s, %s, 'master')''', (build_id,
-                                                                       project_id,
-                                                                       json.dumps(git_repo),
-                                                                       json.dumps(env_vars)))
+                        %s, false, '', 1, 1024, %s, %s, 'master')
+                RETURNING id''', (build_id,
+                                  project_id,
+                                  json.dumps(git_repo),
+                                  json.dumps(env_vars)))
+    job_id = c.fetchone()[0]
+    c.close()
+
+    create_jobs(DB(conn), job_id, definition, git_repo)
+
+    # older patch sets of the same change
+    abort_superseded_builds(conn, project_id, build_id, change_url=event['change']['url'])
 
 def handle_patchset_created(conn, event):
     conn.rollback()
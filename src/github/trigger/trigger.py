@@ -8,7 +8,9 @@ from urllib3.util.retry import Retry
 
 from pyinfraboxutils import get_env, get_logger
 from pyinfraboxutils.ibbottle import InfraBoxPostgresPlugin
-from pyinfraboxutils.db import connect_db
+from pyinfraboxutils.db import connect_db, DB
+from pyinfraboxutils.superseded import abort_superseded_builds
+from pyinfraboxutils.jobgraph import create_jobs, fetch_github_definition
 
 from bottle import post, run, request, response, install, get
 
@@ -117,7 +119,8 @@ class Trigger(object):
         build_id = result[0][0]
         return build_id
 
-    def create_job(self, commit_id, clone_url, build_id, project_id, github_private_repo, branch, env=None, fork=False):
+    def create_job(self, commit_id, clone_url, build_id, project_id, github_private_repo, branch,
+                   env=None, fork=False, definition=None):
         git_repo = {
             "commit": commit_id,
             "clone_url": clone_url,
@@ -126,14 +129,16 @@ class Trigger(object):
             "fork": fork
         }
 
-        self.execute('''
+        job_id = self.execute('''
             INSERT INTO job (id, state, build_id, type,
                              name, project_id, build_only,
                              dockerfile, cpu, memory, repo, env_var, cluster_name)
             VALUES (gen_random_uuid(), 'queued', %s, 'create_job_matrix',
                     'Create Jobs', %s, false, '', 1, 1024, %s, %s, 'master')
-        ''', [build_id, project_id, json.dumps(git_repo), env], fetch=False)
+            RETURNING id
+        ''', [build_id, project_id, json.dumps(git_repo), env])[0][0]
 
+        create_jobs(DB(self.conn), job_id, definition, git_repo)
 
     def create_push(self, c, repository, branch, tag):
         if not c['distinct']:
@@ -158,6 +163,9 @@ class Trigger(object):
 
         commit_id = c['id']
 
+        # before writing anything, github may take a while to answer
+        definition = fetch_github_definition(DB(self.conn), project_id, commit_id)
+
         if not result:
             status_url = repository['statuses_url'].format(sha=c['id'])
             result = self.execute('''
@@ -196,7 +204,10 @@ class Trigger(object):
 
         build_id = self.create_build(commit_id, project_id)
         self.create_job(c['id'], repository['clone_url'], build_id,
-                        project_id, github_repo_private, branch)
+                        project_id, github_repo_private, branch, definition=definition)
+
+        if not tag:
+            abort_superseded_builds(self.conn, project_id, build_id, branch=branch)
 
     def handle_push(self, event):
         result = self.execute('''
@@ -285,11 +296,25 @@ class Trigger(object):
 
         is_fork = event['pull_request']['head']['repo']['fork']
 
+        commit = self.execute('''
+            SELECT id
+            FROM "commit"
+            WHERE id = %s
+                AND project_id = %s
+        ''', [hc['sha'], project_id])
+
+        definition = None
+        if not commit:
+            # before writing anything, github may take a while to answer
+            definition = fetch_github_definition(DB(self.conn), project_id, hc['sha'])
+
         result = self.execute('''
             SELECT id FROM pull_request WHERE project_id = %s and github_pull_request_id = %s
-        ''', [repo_id, event['pull_request']['id']])
+        ''', [project_id, event['pull_request']['id']])
 
-        if not result:
+        if result:
+            pr_id = result[0][0]
+        else:
             result = self.execute('''
                 INSERT INTO pull_request (project_id, github_pull_request_id,
                                          title, url)
@@ -301,13 +326,6 @@ class Trigger(object):
                  ])
             pr_id = result[0][0]
 
-        result = self.execute('''
-            SELECT id
-            FROM "commit"
-            WHERE id = %s
-                AND project_id = %s
-        ''', [hc['sha'], project_id])
-
         committer_login = None
         if hc.get('committer', None):
             committer_login = hc['committer']['login']
@@ -322,7 +340,7 @@ class Trigger(object):
             "GITHUB_REPOSITORY_FULL_NAME": event['repository']['full_name']
         })
 
-        if not result:
+        if not commit:
             result = self.execute('''
                 INSERT INTO "commit" (
                     id, message, repository_id, timestamp,
@@ -347,7 +365,10 @@ class Trigger(object):
             build_id = self.create_build(commit_id, project_id)
             self.create_job(event['pull_request']['head']['sha'],
                             event['pull_request']['head']['repo']['clone_url'],
-                            build_id, project_id, github_repo_private, branch, env=env, fork=is_fork)
+                            build_id, project_id, github_repo_private, branch,
+                            env=env, fork=is_fork, definition=definition)
+
+            abort_superseded_builds(self.conn, project_id, build_id, pull_request_id=pr_id)
 
             self.conn.commit()
 
@@ -1,11 +1,20 @@
 #pylint: disable=wrong-import-position
-import subprocess
 import os
+import re
+import fcntl
+import hashlib
+import shutil
+import time
 import traceback
+import uuid
 
+import gevent
+from gevent import subprocess
+from gevent import os as gevent_os
+from gevent.queue import Queue
 from gevent.wsgi import WSGIServer
 
-from flask import Flask, request
+from flask import Flask, request, Response
 from flask_restplus import Api, Resource, fields
 
 from pyinfraboxutils import print_stackdriver, get_logger
@@ -16,37 +25,326 @@ api = Api(app)
 logger = get_logger('api')
 ns = api.namespace('/', description='Clone repo')
 
+# bare mirrors of the cloned repositories, shared by the jobs on the node
+mirror_path = os.environ.get('INFRABOX_JOB_GIT_MIRROR_PATH', None)
+
+# mirrors which haven't been used for that many days are removed
+mirror_max_age = int(os.environ.get('INFRABOX_JOB_GIT_MIRROR_MAX_AGE', '7'))
+
+# the last line of the output of a clone, followed by ok or failed
+RESULT_PREFIX = '##infrabox-clone-result '
+
+# git rewrites its progress line with \r, one of them is sent per interval
+PROGRESS_INTERVAL = 1.0
+
+LINE_END = re.compile(r'\r\n|\r|\n')
+
+# the clones which are running by their id, killed by /cancel
+clones = {}
+
+def read_lines(f):
+    """ Yields the lines of a process' output as they come """
+    fd = f.fileno()
+    gevent_os.make_nonblocking(fd)
+
+    buf = ''
+    last_progress = 0
+    eof = False
+
+    while not eof:
+        data = gevent_os.nb_read(fd, 4096)
+        eof = not data
+        buf += data
+
+        while True:
+            m = LINE_END.search(buf)
+            if not m or (m.group() == '\r' and m.end() == len(buf) and not eof):
+                # a \r at the end may be the start of \r\n
+                break
+
+            line = buf[:m.start()]
+            buf = buf[m.end():]
+
+            if m.group() == '\r':
+                if time.time() - last_progress < PROGRESS_INTERVAL:
+                    continue
+
+                last_progress = time.time()
+
+            yield line + '\n'
+
+    if buf:
+        yield buf + '\n'
+
+def get_mirror_dir(clone_url):
+    # the url may contain credentials, so only jobs which
+    # could clone the repository anyway share its mirror
+    return os.path.join(mirror_path, hashlib.sha256(clone_url).hexdigest() + '.git')
+
+def get_workspace(sub_path):
+    """ The directory to clone into, None if it isn't inside the
+    repository mount. The job may send anything. """
+    root = os.path.realpath(os.environ.get('INFRABOX_JOB_REPO_MOUNT_PATH', '/repo'))
+
+    if not sub_path:
+        return root
+
+    path = os.path.realpath(os.path.join(root, sub_path))
+    if not path.startswith(root + os.sep):
+        return None
+
+    return path
+
+def open_lock(path):
+    """ The lock file, None if it has been removed together with its
+    mirror after it was opened. Must be called with the lock held. """
+    f = open(path, 'a')
+
+    try:
+        if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+            return f
+    except OSError:
+        pass
+
+    f.close()
+    return None
+
+def try_lock(f):
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except IOError:
+        return False
+
+def evict_mirrors():
+    """ Removes the mirrors which haven't been used for a while, e.g.
+    those of a token which has been replaced. The mtime of the lock
+    file is the time of the last use. """
+    deadline = time.time() - mirror_max_age * 24 * 3600
+
+    for name in os.listdir(mirror_path):
+        if not name.endswith('.lock'):
+            continue
+
+        path = os.path.join(mirror_path, name)
+
+        try:
+            if os.stat(path).st_mtime > deadline:
+                continue
+        except OSError:
+            continue
+
+        with open(path, 'a') as f:
+            if not try_lock(f):
+                # in use
+                continue
+
+            try:
+                if os.fstat(f.fileno()).st_ino != os.stat(path).st_ino or os.stat(path).st_mtime > deadline:
+                    continue
+            except OSError:
+                continue
+
+            mirror_dir = path[:-len('.lock')]
+            logger.info('Removing unused mirror %s', mirror_dir)
+            shutil.rmtree(mirror_dir + '.tmp', True)
+            shutil.rmtree(mirror_dir, True)
+            os.remove(path)
+
 @ns.route('/ping')
 class Ping(Resource):
     def get(self):
         return {'status': 200}
 
+cancel_model = api.model('Cancel', {
+    'id': fields.String(required=True, description='Id of the clone')
+})
+
+@ns.route('/cancel')
+class Cancel(Resource):
+    @api.expect(cancel_model, validate=True)
+    def post(self):
+        """ Kills the clone, several jobs may use the server at once """
+        c = clones.get(request.get_json()['id'], None)
+
+        if c:
+            c.kill()
+
+        return {'status': 200}
+
 clone_model = api.model('Clone', {
+    'id': fields.String(required=False, description='Id to cancel the clone with'),
     'commit': fields.String(required=True, description='Commit'),
     'clone_url': fields.String(required=True, description='Clone URL'),
     'branch': fields.String(required=False, description='Branch'),
     'ref': fields.String(required=False, description='Ref'),
     'clone_all': fields.Boolean(required=False, description='Clone all'),
     'sub_path': fields.String(required=False, description='Sub path'),
-    'submodules': fields.String(required=False, description='Init submodules')
+    'submodules': fields.String(required=False, description='Init submodules'),
+    'sparse_checkout': fields.List(fields.String, required=False, description='Paths to check out')
 })
 
 @ns.route('/clone_repo')
 class Clone(Resource):
+    def write(self, line):
+        self.output.put(line)
+
     def execute(self, args, cwd=None):
-        output = '\n'
-        output += ' '.join(args)
-        output += '\n'
-        output += subprocess.check_output(args, cwd=cwd, stderr=subprocess.STDOUT)
-        return output
+        """ Runs the command, its output is sent while it runs """
+        if args[1] in ('clone', 'fetch'):
+            # only written by default if stderr is a terminal
+            args = args[:2] + ['--progress'] + args[2:]
+
+        self.write('\n' + ' '.join(args) + '\n')
+
+        p = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-    @api.expect(clone_model)
-    def post(self):
         try:
-            output = ""
-            mount_repo_dir = os.environ.get('INFRABOX_JOB_REPO_MOUNT_PATH', '/repo')
+            for line in read_lines(p.stdout):
+                self.write(line)
+
+            p.wait()
+        finally:
+            # cancelled
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, args)
+
+    def has_commit(self, repo_dir, commit):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(['git', 'cat-file', '-e', '%s^{commit}' % commit],
+                                   cwd=repo_dir, stdout=devnull, stderr=devnull) == 0
 
-            body = request.get_json()
+    def lock_mirror(self, mirror_dir):
+        """ Waits for the lock of the mirror without blocking the server """
+        while True:
+            with open(mirror_dir + '.lock', 'a') as f:
+                while not try_lock(f):
+                    gevent.sleep(0.5)
+
+                lock = open_lock(mirror_dir + '.lock')
+
+            if lock:
+                # still locked through the new file object, the flock
+                # belongs to the open file, which both refer to
+                return lock
+
+    def is_mirror_of(self, mirror_dir, clone_url):
+        """ Whether the directory is a bare repository of the url, a job
+        must never fetch into something else """
+        git = ['git', '--git-dir', mirror_dir]
+
+        try:
+            with open(os.devnull, 'w') as devnull:
+                bare = subprocess.check_output(git + ['rev-parse', '--is-bare-repository'], stderr=devnull)
+                url = subprocess.check_output(git + ['config', '--get', 'remote.origin.url'], stderr=devnull)
+        except subprocess.CalledProcessError:
+            return False
+
+        return bare.strip() == 'true' and url.strip() == clone_url
+
+    def update_mirror(self, clone_url, commit, ref):
+        """ Fetches what is new into the mirror of the repository, which is
+        created on first use. Only one job at a time updates a mirror. """
+        mirror_dir = get_mirror_dir(clone_url)
+
+        with self.lock_mirror(mirror_dir) as lock:
+            if os.path.isdir(mirror_dir) and not self.is_mirror_of(mirror_dir, clone_url):
+                self.write("\n%s is not a mirror of the repository, replacing it\n" % mirror_dir)
+                shutil.rmtree(mirror_dir, True)
+
+            if not os.path.isdir(mirror_dir):
+                # a half cloned mirror must never be used
+                tmp_dir = mirror_dir + '.tmp'
+                shutil.rmtree(tmp_dir, True)
+
+                self.execute(['git', 'clone', '--mirror', clone_url, tmp_dir])
+
+                # the workspaces fetch the commit by its sha
+                self.execute(['git', 'config', 'uploadpack.allowAnySHA1InWant', 'true'], cwd=tmp_dir)
+                os.rename(tmp_dir, mirror_dir)
+            else:
+                self.execute(['git', 'fetch', '--prune', 'origin'], cwd=mirror_dir)
+
+            if ref:
+                self.execute(['git', 'fetch', 'origin', ref], cwd=mirror_dir)
+
+            if not self.has_commit(mirror_dir, commit):
+                self.execute(['git', 'fetch', 'origin', commit], cwd=mirror_dir)
+
+            # the last use, for evict_mirrors
+            os.utime(lock.name, None)
+
+        return mirror_dir
+
+    def clone_from_mirror(self, mount_repo_dir, clone_url, commit, ref, branch, clone_all):
+        """ Everything is fetched from the node's mirror, only what the
+        mirror doesn't have yet is fetched from the remote """
+        mirror_dir = self.update_mirror(clone_url, commit, ref)
+
+        # the workspace is mounted into the job, where the mirror
+        # isn't, so it must not borrow objects from it
+        if clone_all:
+            cmd = ['git', 'clone', '--no-checkout', mirror_dir, mount_repo_dir]
+            fetch = ['git', 'fetch', mirror_dir, commit]
+        else:
+            cmd = ['git', 'clone', '--no-checkout', '--depth=10']
+
+            if branch:
+                cmd += ['--single-branch', '-b', branch]
+
+            cmd += ['file://' + mirror_dir, mount_repo_dir]
+            fetch = ['git', 'fetch', '--depth=10', 'file://' + mirror_dir, commit]
+
+        self.execute(cmd)
+        self.execute(fetch, cwd=mount_repo_dir)
+        self.execute(['git', 'config', 'remote.origin.url', clone_url], cwd=mount_repo_dir)
+        self.execute(['git', 'config', 'remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*'],
+                     cwd=mount_repo_dir)
+
+    def clone_from_remote(self, mount_repo_dir, clone_url, commit, ref, branch, clone_all):
+        cmd = ['git', 'clone', '--no-checkout']
+
+        if not clone_all:
+            cmd += ['--depth=10']
+
+            if branch:
+                cmd += ['--single-branch', '-b', branch]
+
+        cmd += [clone_url, mount_repo_dir]
+
+        for _ in range(0, 2):
+            try:
+                self.execute(cmd)
+                break
+            except subprocess.CalledProcessError:
+                pass
+
+        if ref:
+            cmd = ['git', 'fetch', '--depth=10', clone_url, ref]
+            self.execute(cmd, cwd=mount_repo_dir)
+
+        self.execute(['git', 'config', 'remote.origin.url', clone_url], cwd=mount_repo_dir)
+        self.execute(['git', 'config', 'remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*'],
+                     cwd=mount_repo_dir)
+        self.execute(['git', 'fetch', 'origin', commit], cwd=mount_repo_dir)
+
+    def set_sparse_checkout(self, mount_repo_dir, paths):
+        self.execute(['git', 'config', 'core.sparseCheckout', 'true'], cwd=mount_repo_dir)
+
+        info_dir = os.path.join(mount_repo_dir, '.git', 'info')
+        if not os.path.isdir(info_dir):
+            os.makedirs(info_dir)
+
+        with open(os.path.join(info_dir, 'sparse-checkout'), 'w') as f:
+            for p in paths:
+                f.write(p + '\n')
+
+    def clone(self, body):
+        try:
             commit = body['commit']
             clone_url = body['clone_url']
             branch = body.get('branch', None)
@@ -54,58 +352,86 @@ class Clone(Resource):
             clone_all = body.get('clone_all', False)
             sub_path = body.get('sub_path', None)
             submodules = body.get('submodules', True)
+            sparse_checkout = body.get('sparse_checkout', None)
 
-            if sub_path:
-                mount_repo_dir = os.path.join(mount_repo_dir, sub_path)
-
-            if os.environ['INFRABOX_GENERAL_DONT_CHECK_CERTIFICATES'] == 'true':
-                output += self.execute(('git', 'config', '--global', 'http.sslVerify', 'false'))
-
-            cmd = ['git', 'clone']
-
-            if not clone_all:
-                cmd += ['--depth=10']
+            mount_repo_dir = get_workspace(sub_path)
+            if not mount_repo_dir:
+                self.write("Invalid sub path: %s\n" % sub_path)
+                self.write(RESULT_PREFIX + 'failed\n')
+                return
 
-                if branch:
-                    cmd += ['--single-branch', '-b', branch]
-
-            cmd += [clone_url, mount_repo_dir]
+            cloned = False
+            if mirror_path:
+                try:
+                    self.clone_from_mirror(mount_repo_dir, clone_url, commit, ref, branch, clone_all)
+                    cloned = True
+                except subprocess.CalledProcessError as e:
+                    self.write("\n%s\nFailed to clone from the mirror, cloning from the remote\n" % e)
+                    shutil.rmtree(mount_repo_dir, True)
 
-            for _ in range(0, 2):
                 try:
-                    output += self.execute(cmd)
-                    break
-                except:
-                    pass
+                    evict_mirrors()
+                except Exception as e:
+                    logger.exception(e)
 
-            if ref:
-                cmd = ['git', 'fetch', '--depth=10', clone_url, ref]
-                output += self.execute(cmd, cwd=mount_repo_dir)
+            if not cloned:
+                self.clone_from_remote(mount_repo_dir, clone_url, commit, ref, branch, clone_all)
 
-            output += self.execute(['git', 'config', 'remote.origin.url', clone_url], cwd=mount_repo_dir)
-            output += self.execute(['git', 'config', 'remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*'],
-                                   cwd=mount_repo_dir)
-            output += self.execute(['git', 'fetch', 'origin', commit], cwd=mount_repo_dir)
+            if sparse_checkout:
+                self.set_sparse_checkout(mount_repo_dir, sparse_checkout)
 
             cmd = ['git', 'checkout', '-qf', commit]
 
             #if not branch:
             #    cmd += ['-b', 'infrabox']
 
-            output += self.execute(cmd, cwd=mount_repo_dir)
+            self.execute(cmd, cwd=mount_repo_dir)
 
             if submodules:
-                output += self.execute(['git', 'submodule', 'init'], cwd=mount_repo_dir)
-                output += self.execute(['git', 'submodule', 'update'], cwd=mount_repo_dir)
+                self.execute(['git', 'submodule', 'init'], cwd=mount_repo_dir)
+                self.execute(['git', 'submodule', 'update'], cwd=mount_repo_dir)
 
-            return output
+            self.write(RESULT_PREFIX + 'ok\n')
         except subprocess.CalledProcessError as e:
-            return output + e.output + "\n" + str(e), 500
-        except Exception as e:
-            return traceback.format_exc(), 500
+            self.write("\n%s\n" % e)
+            self.write(RESULT_PREFIX + 'failed\n')
+        except Exception:
+            self.write(traceback.format_exc())
+            self.write(RESULT_PREFIX + 'failed\n')
+
+    @api.expect(clone_model)
+    def post(self):
+        """ Streams the output of the clone, its last line tells whether
+        it succeeded """
+        body = request.get_json()
+        self.output = Queue()
+
+        clone_id = body.get('id', None) or str(uuid.uuid4())
+        clone = gevent.spawn(self.clone, body)
+        clones[clone_id] = clone
+
+        def done(_):
+            clones.pop(clone_id, None)
+            self.output.put(StopIteration)
+
+        clone.link(done)
+
+        def stream():
+            try:
+                for line in self.output:
+                    yield line
+            finally:
+                # the job went away, no need to finish the clone
+                clone.kill()
+
+        return Response(stream(), mimetype='text/plain')
 
 
 def main(): # pragma: no cover
+    # once for all clones, concurrent git config calls fail on the lock of the file
+    if os.environ['INFRABOX_GENERAL_DONT_CHECK_CERTIFICATES'] == 'true':
+        subprocess.check_call(['git', 'config', '--global', 'http.sslVerify', 'false'])
+
     logger.info('Starting Server')
     http_server = WSGIServer(('0.0.0.0', 8080), app)
     http_server.serve_forever()
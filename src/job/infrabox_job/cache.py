@@ -0,0 +1,376 @@
+""" Chunked, content addressed job cache.
+
+The cache directory is described by a manifest listing its directories,
+symlinks and files. The content of the files is stored in chunks named by
+the sha256 of their uncompressed content, which are shared by all caches
+of a project, whatever codec they were compressed with.
+Large files are split into chunks, small files are packed together. The
+pack boundaries depend on the file names only, so adding or changing a
+file only changes its own pack.
+
+Only chunks the API doesn't have yet are uploaded. Files which are still
+as they were restored are not even read again, so an unchanged cache
+costs one walk over the directory. """
+
+import gzip
+import hashlib
+import json
+import os
+import stat
+import threading
+import time
+import Queue
+from StringIO import StringIO
+
+from infrabox_job.process import Failure
+from infrabox_job.codec import detect_chunk
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# files smaller than that are packed together
+SMALL_FILE_SIZE = 256 * 1024
+
+# on average every PACK_BOUNDARY-th file closes a pack
+PACK_BOUNDARY = 64
+
+WORKERS = 8
+
+def run_parallel(fn, items, workers=WORKERS):
+    """ Calls fn for all items with a pool of threads, raises the first error """
+    items = list(items)
+    queue = Queue.Queue()
+    for i in items:
+        queue.put(i)
+
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                fn(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+def get_mtime(st):
+    # in microseconds, survives the round trip through os.utime
+    return int(round(st.st_mtime * 1000000))
+
+def is_pack_boundary(path):
+    return int(hashlib.md5(path).hexdigest()[:8], 16) % PACK_BOUNDARY == 0
+
+def scan(root):
+    """ All directories, symlinks and regular files below root """
+    entries = []
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root)
+            st = os.lstat(path)
+
+            if stat.S_ISLNK(st.st_mode):
+                entries.append({'path': rel, 'type': 'symlink', 'target': os.readlink(path)})
+            elif stat.S_ISDIR(st.st_mode):
+                entries.append({'path': rel, 'type': 'dir', 'mode': stat.S_IMODE(st.st_mode)})
+            elif stat.S_ISREG(st.st_mode):
+                entries.append({'path': rel, 'type': 'file', 'mode': stat.S_IMODE(st.st_mode),
+                                'size': st.st_size, 'mtime': get_mtime(st)})
+
+    return entries
+
+def read_file(path, offset, length):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+class ManifestBuilder(object):
+    def __init__(self, root, previous):
+        self.root = root
+        self.chunks = {}
+        self.previous_chunks = {}
+        self.previous_files = {}
+
+        if previous:
+            self.previous_chunks = previous['chunks']
+            for e in previous['entries']:
+                if e['type'] == 'file':
+                    self.previous_files[e['path']] = e
+
+    def unchanged(self, e):
+        p = self.previous_files.get(e['path'], None)
+        return p and p['size'] == e['size'] and p['mtime'] == e['mtime']
+
+    def add_file(self, e):
+        if self.unchanged(e):
+            e['segments'] = self.previous_files[e['path']]['segments']
+            for s in e['segments']:
+                self.chunks[s[0]] = self.previous_chunks[s[0]]
+            return
+
+        e['segments'] = []
+        with open(os.path.join(self.root, e['path']), 'rb') as f:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+
+                h = hashlib.sha256(data).hexdigest()
+                self.chunks[h] = len(data)
+                e['segments'].append([h, 0, len(data)])
+
+    def reuse_pack(self, pack):
+        """ The chunk of the pack if the same unchanged files were packed before """
+        if not all(self.unchanged(e) for e in pack):
+            return None
+
+        h = None
+        offset = 0
+        for e in pack:
+            segments = self.previous_files[e['path']]['segments']
+
+            if e['size'] == 0:
+                continue
+
+            if len(segments) != 1:
+                return None
+
+            s = segments[0]
+            if (h and s[0] != h) or s[1] != offset:
+                return None
+
+            h = s[0]
+            offset += s[2]
+
+        if h and self.previous_chunks.get(h, None) != offset:
+            return None
+
+        return h
+
+    def add_pack(self, pack):
+        h = self.reuse_pack(pack)
+
+        if h is None:
+            data = ''.join(read_file(os.path.join(self.root, e['path']), 0, e['size']) for e in pack)
+            h = hashlib.sha256(data).hexdigest()
+
+        offset = 0
+        for e in pack:
+            e['segments'] = [[h, offset, e['size']]]
+            offset += e['size']
+
+        self.chunks[h] = offset
+
+    def build(self):
+        entries = scan(self.root)
+
+        pack = []
+        pack_size = 0
+        for e in entries:
+            if e['type'] != 'file':
+                continue
+
+            if e['size'] >= SMALL_FILE_SIZE:
+                self.add_file(e)
+                continue
+
+            pack.append(e)
+            pack_size += e['size']
+
+            if is_pack_boundary(e['path']) or pack_size >= CHUNK_SIZE:
+                self.add_pack(pack)
+                pack = []
+                pack_size = 0
+
+        if pack:
+            self.add_pack(pack)
+
+        return {
+            'version': 1,
+            'entries': entries,
+            'chunks': self.chunks
+        }
+
+def get_pieces(manifest):
+    """ For every chunk the file ranges it is made of:
+    (offset in chunk, path, offset in file, length) """
+    pieces = {}
+
+    for e in manifest['entries']:
+        if e['type'] != 'file':
+            continue
+
+        pos = 0
+        for h, offset, length in e['segments']:
+            pieces.setdefault(h, []).append((offset, e['path'], pos, length))
+            pos += length
+
+    return pieces
+
+def check_path(root, path):
+    full = os.path.normpath(os.path.join(root, path))
+    if os.path.isabs(path) or not full.startswith(root + os.sep):
+        raise Failure('Invalid path in cache manifest: %s' % path)
+
+    return full
+
+class ChunkedCache(object):
+    def __init__(self, job, console, codec):
+        self.job = job
+        self.console = console
+        self.codec = codec
+
+    def url(self, path):
+        return '%s/cache%s' % (self.job.api_server, path)
+
+    def get(self, path):
+        r = self.job.session.get(self.url(path), headers=self.job.get_headers(),
+                                 timeout=600, verify=self.job.verify)
+
+        if r.status_code == 404:
+            return None
+
+        if r.status_code != 200:
+            raise Failure('Failed to download %s: %s' % (path, r.text))
+
+        return r.content
+
+    def post(self, path, files=None, json_data=None):
+        message = None
+
+        for _ in xrange(0, 5):
+            try:
+                r = self.job.session.post(self.url(path), headers=self.job.get_headers(),
+                                          files=files, json=json_data, timeout=600, verify=self.job.verify)
+            except Exception as e:
+                message = str(e)
+                time.sleep(5)
+                continue
+
+            if r.status_code == 200:
+                return r.json()
+
+            message = r.text
+            if r.status_code == 400:
+                break
+
+            time.sleep(5)
+
+        raise Failure('Failed to upload %s: %s' % (path, message))
+
+    def restore(self, root):
+        """ Returns the restored manifest or None if there is no cache """
+        data = self.get('/manifest')
+        if data is None:
+            return None
+
+        manifest = json.loads(gzip.GzipFile(fileobj=StringIO(data)).read())
+        root = os.path.normpath(root)
+
+        for e in manifest['entries']:
+            path = check_path(root, e['path'])
+
+            if e['type'] == 'dir':
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+            elif e['type'] == 'file':
+                with open(path, 'wb') as f:
+                    f.truncate(e['size'])
+
+        pieces = get_pieces(manifest)
+        downloaded = [0]
+
+        def fetch(h):
+            data = self.get('/chunks/%s' % h)
+            if data is None:
+                raise Failure('Cache chunk %s is missing' % h)
+
+            downloaded[0] += len(data)
+            data = detect_chunk(data).decompress(data)
+
+            if hashlib.sha256(data).hexdigest() != h:
+                raise Failure('Cache chunk %s is corrupt' % h)
+
+            for offset, path, pos, length in pieces[h]:
+                with open(os.path.join(root, path), 'r+b') as f:
+                    f.seek(pos)
+                    f.write(data[offset:offset + length])
+
+        run_parallel(fetch, pieces.keys())
+
+        # only now, writing the files changes them
+        for e in manifest['entries']:
+            path = os.path.join(root, e['path'])
+
+            if e['type'] == 'file':
+                os.chmod(path, e['mode'])
+                mtime = e['mtime'] / 1000000.0
+                os.utime(path, (mtime, mtime))
+
+                # may be off by a microsecond, what counts is what's on disk
+                e['mtime'] = get_mtime(os.stat(path))
+            elif e['type'] == 'symlink':
+                os.symlink(e['target'], path)
+
+        for e in reversed(manifest['entries']):
+            if e['type'] == 'dir':
+                os.chmod(os.path.join(root, e['path']), e['mode'])
+
+        self.console.collect("Downloaded %s chunks, %s kb\n" % (len(pieces), downloaded[0] / 1024), show=True)
+        return manifest
+
+    def save(self, root, previous):
+        root = os.path.normpath(root)
+        manifest = ManifestBuilder(root, previous).build()
+
+        if previous and manifest['entries'] == previous['entries']:
+            self.console.collect("Cache is unchanged\n", show=True)
+            return
+
+        missing = self.post('/chunks/missing', json_data={'chunks': list(manifest['chunks'].keys())})
+        missing = missing['chunks']
+
+        pieces = get_pieces(manifest)
+        uploaded = [0]
+
+        def upload(h):
+            data = []
+            size = 0
+            for offset, path, pos, length in sorted(pieces[h]):
+                if offset != size:
+                    # another file with the same content
+                    continue
+
+                data.append(read_file(os.path.join(root, path), pos, length))
+                size += length
+
+            data = self.codec.compress(''.join(data))
+            uploaded[0] += len(data)
+            self.post('/chunks/%s' % h, files={'chunk': data})
+
+        run_parallel(upload, missing)
+
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            json.dump(manifest, f)
+
+        self.post('/manifest', files={'manifest.json.gz': buf.getvalue()})
+        self.console.collect("Uploaded %s of %s chunks, %s kb\n" % (len(missing), len(manifest['chunks']),
+                                                                    uploaded[0] / 1024), show=True)
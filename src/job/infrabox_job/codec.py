@@ -0,0 +1,114 @@
+""" Compression codecs for caches and outputs.
+
+A codec compresses tar streams with an external command and cache chunks
+in process. Outputs are always gzip, they are also downloaded as tar.gz
+by others. Which codec wrote some data is told by its first bytes, so
+outputs and chunks written with any codec, or before codecs existed,
+can always be read. """
+
+import subprocess
+import zlib
+
+from infrabox_job.process import Failure
+
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+GZIP_MAGIC = '\x1f\x8b'
+
+# uncompressed chunks are prefixed with it, zlib and zstd never start with it
+RAW_MARKER = '\x00'
+
+def run(cmd, data):
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate(data)
+
+    if p.returncode != 0:
+        raise Failure('%s failed: %s' % (cmd[0], err))
+
+    return out
+
+class Zstd(object):
+    """ Multithreaded, decompresses several times faster than gzip """
+    name = 'zstd'
+
+    def __init__(self, level=None):
+        self.level = level or 3
+
+    def compress_command(self):
+        return 'zstd -q -T0 -%s -c' % self.level
+
+    def decompress_command(self):
+        return 'zstd -q -dc'
+
+    def compress(self, data):
+        return run(['zstd', '-q', '-%s' % self.level, '-c'], data)
+
+    def decompress(self, data):
+        return run(['zstd', '-q', '-dc'], data)
+
+class Gzip(object):
+    """ pigz for tar streams, readable by everything """
+    name = 'gzip'
+
+    def __init__(self, level=None):
+        self.level = level or 6
+
+    def compress_command(self):
+        return 'pigz -n -%s' % self.level
+
+    def decompress_command(self):
+        return 'pigz -dc'
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+class NoCompression(object):
+    """ For data which is already compressed """
+    name = 'none'
+
+    def __init__(self, level=None):
+        pass
+
+    def compress_command(self):
+        return 'cat'
+
+    def decompress_command(self):
+        return 'cat'
+
+    def compress(self, data):
+        return RAW_MARKER + data
+
+    def decompress(self, data):
+        return data[len(RAW_MARKER):]
+
+CODECS = {
+    'zstd': Zstd,
+    'gzip': Gzip,
+    'none': NoCompression
+}
+
+def get_codec(cache):
+    """ The codec selected in the cache section of the job definition """
+    return CODECS[cache.get('compression', 'gzip')](cache.get('compression_level', None))
+
+def detect_stream(head):
+    """ The codec of a tar stream by its first bytes """
+    if head.startswith(ZSTD_MAGIC):
+        return Zstd()
+
+    if head.startswith(GZIP_MAGIC):
+        return Gzip()
+
+    return NoCompression()
+
+def detect_chunk(data):
+    """ The codec of a cache chunk by its first bytes """
+    if data.startswith(ZSTD_MAGIC):
+        return Zstd()
+
+    if data.startswith(RAW_MARKER):
+        return NoCompression()
+
+    return Gzip()
@@ -2,10 +2,13 @@ import os
 import sys
 import copy
 import time
+import threading
 import requests
 
 from infrabox_job.process import Failure
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 class Job(object):
     def __init__(self):
         self.api_server = os.environ.get("INFRABOX_JOB_API_URL", None)
@@ -18,6 +21,11 @@ class Job(object):
             print "INFRABOX_JOB_API_URL not set"
             sys.exit(1)
 
+        # shared by all threads uploading and downloading files
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=16))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=16))
+
         self.job = None
         self.project = None
         self.build = None
@@ -33,13 +41,13 @@ class Job(object):
         self.registries = None
 
     def load_data(self):
+        delay = 0.5
         while True:
             try:
                 r = requests.get("%s/job" % self.api_server,
                                  headers=self.get_headers(),
                                  timeout=10,
                                  verify=self.verify)
-                time.sleep(1)
 
                 if r.status_code == 409:
                     sys.exit(0)
@@ -54,14 +62,15 @@ class Job(object):
                     raise Failure(msg)
                 elif r.status_code == 200:
                     break
-                else:
-                    # Retry on any other error
-                    continue
             except Failure:
                 raise
             except Exception as e:
                 print e
 
+            # Retry on any other error
+            time.sleep(delay)
+            delay = min(delay * 2, 10)
+
         data = r.json()
         self.job = data['job']
         self.project = data['project']
@@ -124,6 +133,27 @@ class Job(object):
 
     def set_running(self):
         self.post_api_server('setrunning')
+        self.start_heartbeat()
+
+    def start_heartbeat(self):
+        # lets the scheduler notice if the job's pod or node dies
+        interval = int(os.environ.get('INFRABOX_JOB_HEARTBEAT_INTERVAL', '30'))
+
+        t = threading.Thread(target=self.send_heartbeats, args=(interval,))
+        t.daemon = True
+        t.start()
+
+    def send_heartbeats(self, interval):
+        while True:
+            time.sleep(interval)
+
+            try:
+                requests.post("%s/heartbeat" % self.api_server,
+                              headers=self.get_headers(),
+                              timeout=10,
+                              verify=self.verify)
+            except Exception as e:
+                print e
 
     def set_finished(self, state, message):
         payload = {
@@ -140,12 +170,13 @@ class Job(object):
 
         self.post_api_server('stats', data=payload)
 
-    def get_file_from_api_server(self, url, path):
-        r = requests.get("%s%s" % (self.api_server, url),
-                         headers=self.get_headers(),
-                         timeout=600, stream=True, verify=self.verify)
+    def get_stream_from_api_server(self, url):
+        """ Returns the streamed response or None if there is no such file """
+        r = self.session.get("%s%s" % (self.api_server, url),
+                             headers=self.get_headers(),
+                             timeout=600, stream=True, verify=self.verify)
         if r.status_code == 404:
-            return
+            return None
 
         if r.status_code != 200:
             msg = r.text
@@ -157,8 +188,15 @@ class Job(object):
 
             raise Failure('Failed to download file: %s' % msg)
 
+        return r
+
+    def get_file_from_api_server(self, url, path):
+        r = self.get_stream_from_api_server(url)
+        if r is None:
+            return
+
         with open(path, 'wb') as  f:
-            for chunk in r.iter_content(chunk_size=1024):
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
                 if chunk:
                     f.write(chunk)
 
@@ -171,9 +209,9 @@ class Job(object):
         for _ in xrange(0, 5):
             files = {filename: open(path)}
             try:
-                r = requests.post("%s%s" % (self.api_server, url),
-                                  headers=self.get_headers(),
-                                  files=files, timeout=600, verify=self.verify)
+                r = self.session.post("%s%s" % (self.api_server, url),
+                                      headers=self.get_headers(),
+                                      files=files, timeout=600, verify=self.verify)
             except Exception as e:
                 message = str(e)
                 time.sleep(5)
@@ -0,0 +1,107 @@
+import threading
+import time
+
+from infrabox_job.process import BufferedConsole
+
+class Pipeline(object):
+    """ Runs stages on a pool of threads, each as soon as the stages it
+    depends on are done. The output of a stage is buffered and written to
+    the console in one piece once the stage is done, unless the stage is
+    live. Every stage reports the time it took.
+
+    A failed stage doesn't stop the others, but the stages depending on it
+    are skipped. run() raises the error of the first stage which failed. """
+
+    def __init__(self, console, workers=4):
+        self.console = console
+        self.workers = workers
+        self.stages = []
+        self.cond = threading.Condition()
+
+    def add(self, name, fn, depends_on=None, live=False):
+        """ fn is called with the console the stage should write to. The
+        output of live stages isn't buffered, for stages which take long
+        and whose output should be seen while they run. """
+        self.stages.append({
+            'name': name,
+            'fn': fn,
+            'depends_on': depends_on or [],
+            'live': live,
+            'state': 'pending'
+        })
+
+    def next_stage(self):
+        # called with self.cond held
+        states = dict((s['name'], s['state']) for s in self.stages)
+
+        for s in self.stages:
+            if s['state'] != 'pending':
+                continue
+
+            deps = [states[d] for d in s['depends_on']]
+
+            if any(d in ('failed', 'skipped') for d in deps):
+                s['state'] = 'skipped'
+                self.console.collect("%s skipped\n" % s['name'], show=True)
+                self.cond.notify_all()
+                return self.next_stage()
+
+            if all(d == 'done' for d in deps):
+                s['state'] = 'running'
+                return s
+
+        return None
+
+    def is_finished(self):
+        return all(s['state'] in ('done', 'failed', 'skipped') for s in self.stages)
+
+    def run_stage(self, s):
+        c = self.console if s['live'] else BufferedConsole()
+        start = time.time()
+        error = None
+
+        try:
+            s['fn'](c)
+        except Exception as e:
+            c.collect("%s\n" % e, show=True)
+            error = e
+
+        with self.cond:
+            if not s['live']:
+                c.replay(self.console)
+
+            self.console.collect("%s %s in %.2fs\n" % (s['name'], 'failed' if error else 'done',
+                                                       time.time() - start), show=True)
+
+            s['state'] = 'failed' if error else 'done'
+            s['error'] = error
+            s['finished'] = time.time()
+            self.cond.notify_all()
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.is_finished():
+                        return
+
+                    s = self.next_stage()
+                    if s:
+                        break
+
+                    self.cond.wait()
+
+            self.run_stage(s)
+
+    def run(self):
+        threads = [threading.Thread(target=self.worker) for _ in range(min(self.workers, len(self.stages)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        failed = [s for s in self.stages if s['state'] == 'failed']
+        if failed:
+            raise min(failed, key=lambda s: s['finished'])['error']
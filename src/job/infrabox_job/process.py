@@ -1,19 +1,52 @@
 import subprocess
 import sys
 import os
+import gzip
+import json
+import threading
+import time
+from collections import deque
 from datetime import datetime
+from StringIO import StringIO
 
 import requests
 
+# lines waiting to be sent, the oldest are dropped if the api can't keep up
+MAX_QUEUED_LINES = 100000
+
+# upper bound of the uncompressed size of one console update,
+# the api rejects updates larger than 4 MiB
+MAX_BATCH_SIZE = 1024 * 1024
+
+# longer lines are truncated, so no line can exceed the limit of the api
+MAX_LINE_LENGTH = 64 * 1024
+
+FLUSH_INTERVAL = 1.0
+MAX_RETRY_DELAY = 30.0
+
+# lines of a failed command which end up in the error message
+ERROR_TAIL_LINES = 100
+
 class Failure(Exception):
     def __init__(self, message):
         super(Failure, self).__init__(message)
         self.message = message
 
 class ApiConsole(object):
+    """ Sends the shown output to the api.
+
+    The lines are queued and sent by a background thread in gzip compressed
+    batches, so a slow api never blocks the command whose output is read.
+    If the queue is full the oldest lines are dropped and replaced by a
+    note saying how many are missing. """
+
     def __init__(self):
-        self.output = []
-        self.last_send = datetime.now()
+        self.queue = deque(maxlen=MAX_QUEUED_LINES)
+        self.dropped = 0
+        self.sending = False
+        self.cond = threading.Condition()
+        self.shipper = None
+        self.session = None
         self.is_finish = False
         self.enable_logging = False
 
@@ -26,19 +59,32 @@ class ApiConsole(object):
             sys.stdout.write(line)
             sys.stdout.flush()
 
-        if show:
-            line = line.strip("\r\n")
-            line = "%s|%s" % (datetime.now().strftime("%H:%M:%S"), line)
-            self.output.append(line)
+        if not show:
+            return
 
-        diff = datetime.now() - self.last_send
-        seconds = diff.seconds + diff.microseconds / 1E6
+        if isinstance(line, str):
+            # commands may print anything, it must still be valid json
+            line = line.decode('utf-8', 'replace')
 
-        if seconds < 1.0:
-            # we wait some more
-            return
+        line = line.strip("\r\n")
+        if len(line) > MAX_LINE_LENGTH:
+            line = line[:MAX_LINE_LENGTH] + u"... (line truncated)"
 
-        self.flush()
+        line = u"%s|%s" % (datetime.now().strftime("%H:%M:%S"), line)
+
+        with self.cond:
+            if self.is_finish:
+                return
+
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+
+            self.queue.append(line)
+
+            if not self.shipper:
+                self.shipper = threading.Thread(target=self.ship)
+                self.shipper.daemon = True
+                self.shipper.start()
 
     def execute(self, command, cwd=None, show=False, env=None, background=False, ignore_error=False):
         self.collect(' '.join(command) + '\n', show=show)
@@ -52,14 +98,14 @@ class ApiConsole(object):
             return
 
         # Poll process for new output until finished
-        msg = ""
+        tail = deque(maxlen=ERROR_TAIL_LINES)
         while True:
             line = process.stdout.readline()
             if not line:
                 break
 
             line = line.rstrip()
-            msg += line
+            tail.append(line)
             self.collect(line, show=show)
 
         process.wait()
@@ -70,10 +116,14 @@ class ApiConsole(object):
         self.flush()
         exitCode = process.returncode
         if exitCode != 0:
-            raise Exception(msg)
+            raise Exception('\n'.join(tail))
 
     def finish(self):
-        self.is_finish = True
+        self.flush()
+
+        with self.cond:
+            self.is_finish = True
+            self.cond.notify_all()
 
     def header(self, h, show=False):
         h = "\n## " + h + '\n'
@@ -81,34 +131,132 @@ class ApiConsole(object):
         self.collect(h, show=show)
         self.collect(('=' * len(h)) + "\n", show=False)
 
-    def flush(self):
-        try:
-            if self.is_finish:
-                return
+    def flush(self, timeout=60):
+        """ Waits until the queued lines are sent, or the timeout passed """
+        deadline = time.time() + timeout
 
-            if not self.output:
-                return
+        with self.cond:
+            self.cond.notify_all()
+
+            while self.queue or self.sending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
 
-            buf = ""
-            for l in self.output:
-                buf += l.rstrip() + "\n"
+                self.cond.wait(remaining)
 
-            payload = {
-                "output": buf
-            }
+    def next_batch(self):
+        # called with self.cond held
+        lines = []
+        size = 0
 
-            api_server = os.environ["INFRABOX_JOB_API_URL"]
+        if self.dropped:
+            lines.append("%s|... %s lines dropped, the output was too fast to send ..."
+                         % (datetime.now().strftime("%H:%M:%S"), self.dropped))
+            self.dropped = 0
 
-            headers = {
-                'Authorization': 'token ' + os.environ['INFRABOX_JOB_TOKEN']
-            }
+        while self.queue and size < MAX_BATCH_SIZE:
+            l = self.queue.popleft()
+            lines.append(l)
+            # as it is sent, escaped characters take up to six bytes
+            size += len(json.dumps(l))
 
-            requests.post("%s/consoleupdate" % api_server,
-                          headers=headers,
-                          verify=self.verify,
-                          json=payload).json()
+        return lines, size >= MAX_BATCH_SIZE
+
+    def send(self, lines):
+        """ Returns False if the api failed and the batch should be sent again """
+        try:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+                f.write(json.dumps({"output": "".join(l.rstrip() + "\n" for l in lines)}))
         except Exception as e:
+            # sending it again wouldn't help
             print e
+            return True
+
+        headers = {
+            'Authorization': 'token ' + os.environ['INFRABOX_JOB_TOKEN'],
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip'
+        }
+
+        try:
+            if not self.session:
+                self.session = requests.Session()
+
+            r = self.session.post("%s/consoleupdate" % os.environ["INFRABOX_JOB_API_URL"],
+                                  headers=headers,
+                                  verify=self.verify,
+                                  data=buf.getvalue(),
+                                  timeout=60)
+        except Exception as e:
+            print e
+            return False
+
+        if r.status_code == 200:
+            return True
+
+        print r.text
+
+        # the output was rejected, e.g. because there is too much of it
+        return 400 <= r.status_code < 500
+
+    def ship(self):
+        # nothing would send the output anymore if the thread died
+        while True:
+            try:
+                self.ship_batches()
+                return
+            except Exception as e:
+                print e
+                time.sleep(FLUSH_INTERVAL)
+
+    def ship_batches(self):
+        lines = []
+        full = False
+        delay = FLUSH_INTERVAL
+
+        while True:
+            with self.cond:
+                # a batch which failed is still pending until it's sent again
+                self.sending = bool(lines)
+                self.cond.notify_all()
+
+                if not lines:
+                    if self.is_finish and not self.queue:
+                        return
+
+                    if not full and not self.is_finish:
+                        # collect some more lines, unless somebody flushes
+                        self.cond.wait(FLUSH_INTERVAL)
+
+                    lines, full = self.next_batch()
+                    if not lines:
+                        continue
+
+                    self.sending = True
+
+            if self.send(lines):
+                lines = []
+                delay = FLUSH_INTERVAL
+            else:
+                # keep the batch and give the api some time
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                time.sleep(delay)
+
+class BufferedConsole(ApiConsole):
+    """ Keeps the output to write it to another console later in one piece """
+
+    def __init__(self):
+        super(BufferedConsole, self).__init__()
+        self.lines = []
+
+    def collect(self, line, show=False):
+        self.lines.append((line, show))
+
+    def flush(self, timeout=60):
+        pass
 
-        self.last_send = datetime.now()
-        self.output = []
+    def replay(self, console):
+        for line, show in self.lines:
+            console.collect(line, show=show)
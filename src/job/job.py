@@ -1,21 +1,32 @@
 #!/usr/bin/python
 #pylint: disable=too-many-lines,attribute-defined-outside-init,too-many-public-methods,too-many-locals
 import os
+import re
+import copy
 import shutil
 import time
 import json
+import gzip
+import hashlib
 import subprocess
+import tempfile
+import threading
+import Queue
 import uuid
 import base64
 import traceback
+from StringIO import StringIO
 import requests
 
-from pyinfrabox.infrabox import validate_json
+from pyinfrabox.infrabox import validate_json, rewrite_depends_on
 from pyinfrabox.docker_compose import create_from
 
 from infrabox_job.stats import StatsCollector
-from infrabox_job.process import ApiConsole, Failure
-from infrabox_job.job import Job
+from infrabox_job.process import ApiConsole, BufferedConsole, Failure
+from infrabox_job.job import Job, DOWNLOAD_CHUNK_SIZE
+from infrabox_job.cache import ChunkedCache, run_parallel
+from infrabox_job.codec import get_codec, detect_stream, Gzip
+from infrabox_job.pipeline import Pipeline
 
 from pyinfraboxutils.testresult import Parser as TestresultParser
 from pyinfraboxutils.coverage import Parser as CoverageParser
@@ -23,10 +34,58 @@ from pyinfraboxutils import get_env, print_stackdriver
 from pyinfraboxutils import get_logger
 logger = get_logger('scheduler')
 
+# parents whose outputs are synced at the same time
+INPUT_WORKERS = 4
+
+# seconds the docker daemon may take to start
+DOCKER_START_TIMEOUT = 60
+
+# the last line of the output of the clone service
+CLONE_RESULT_PREFIX = '##infrabox-clone-result '
+
+# a clone which writes nothing for that long is stuck
+CLONE_IDLE_TIMEOUT = 600
+
+# repositories included with git jobs which are loaded at the same time
+INCLUDE_WORKERS = 4
+
+COMMIT_SHA = re.compile(r'^[0-9a-f]{40}$')
+
 def makedirs(path):
     os.makedirs(path)
     os.chmod(path, 0o777)
 
+def wait_until(ready, timeout=None, max_delay=1.0):
+    """ Polls ready() with a growing delay, False if it timed out """
+    deadline = time.time() + timeout if timeout else None
+    delay = 0.05
+
+    while not ready():
+        if deadline and time.time() > deadline:
+            return False
+
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+    return True
+
+def get_include_key(job):
+    # the definitions of a repository are keyed by their normalized path
+    infrabox_file = os.path.normpath(job.get('infrabox_file', 'infrabox.json'))
+    return (job['clone_url'], job['commit'], infrabox_file)
+
+def get_include_hash(key):
+    return hashlib.sha256('\n'.join(key).encode('utf-8')).hexdigest()
+
+def get_git_includes(definitions):
+    keys = []
+    for data in definitions.values():
+        for job in data['jobs']:
+            if job['type'] == 'git':
+                keys.append(get_include_key(job))
+
+    return keys
+
 def get_registry_name():
     n = os.environ['INFRABOX_ROOT_URL'].replace('https://', '')
     n = n.replace('http://', '')
@@ -129,13 +188,10 @@ class RunJob(Job):
     def flush(self):
         self.console.flush()
 
-    def compress(self, source, output):
-        subprocess.check_call("tar cf - --directory %s . | pigz -n > %s" % (source, output), shell=True)
-
-    def uncompress(self, source, output, c):
-        cmd = "pigz -dc %s | tar x -C %s" % (source, output)
-        c.collect(cmd, show=True)
-        subprocess.check_call(cmd, shell=True)
+    def compress(self, source, output, codec):
+        subprocess.check_call("set -o pipefail; tar cf - --directory %s . | %s > %s"
+                              % (source, codec.compress_command(), output),
+                              shell=True, executable='/bin/bash')
 
     def get_files_in_dir(self, d, ending=None):
         result = []
@@ -149,43 +205,72 @@ class RunJob(Job):
 
         return result
 
-    def clone_repo(self, commit, clone_url, branch, ref, clone_all, sub_path=None, submodules=True):
+    def clone_repo(self, c, commit, clone_url, branch, ref, clone_all, sub_path=None, submodules=True,
+                   sparse_checkout=None):
         git_server = os.environ["INFRABOX_JOB_GIT_URL"]
 
-        while True:
+        def git_server_ready():
             try:
                 r = requests.get('%s/ping' % git_server, timeout=5)
 
                 if r.status_code == 200:
-                    break
-                else:
-                    self.console.collect(r.text, show=True)
+                    return True
+
+                c.collect(r.text, show=True)
             except Exception as e:
                 print e
 
-            time.sleep(1)
+            return False
 
+        # usually up already, it starts together with the job
+        wait_until(git_server_ready)
+
+        clone_id = str(uuid.uuid4())
         d = {
+            'id': clone_id,
             'commit': commit,
             'clone_url': clone_url,
             'branch': branch,
             'ref': ref,
             'clone_all': clone_all,
             'sub_path': sub_path,
-            'submodules': submodules
+            'submodules': submodules,
+            'sparse_checkout': sparse_checkout
         }
 
-        r = requests.post('%s/clone_repo' % git_server, json=d, timeout=1800)
+        # the output is written while git runs
+        r = None
+        result = None
+        try:
+            r = requests.post('%s/clone_repo' % git_server, json=d, stream=True,
+                              timeout=(10, CLONE_IDLE_TIMEOUT))
 
-        for l in r.text.split('\\n'):
-            self.console.collect(l, show=True)
+            if r.status_code != 200:
+                c.collect(r.text, show=True)
+                raise Failure('Failed to clone repository')
 
-        if r.status_code != 200:
-            raise Failure('Failed to clone repository')
+            for l in r.iter_lines():
+                if l.startswith(CLONE_RESULT_PREFIX):
+                    result = l[len(CLONE_RESULT_PREFIX):]
+                else:
+                    c.collect(l, show=True)
+        except requests.exceptions.RequestException as e:
+            c.collect("%s\n" % e, show=True)
+        finally:
+            if r is not None:
+                r.close()
 
-    def get_source(self):
-        c = self.console
+            if result is None:
+                # the clone service would carry on otherwise
+                try:
+                    requests.post('%s/cancel' % git_server, json={'id': clone_id}, timeout=10)
+                except Exception as e:
+                    print e
+
+        if result != 'ok':
+            raise Failure('Failed to clone repository')
 
+    def get_source(self, c):
         if self.job['repo']:
             repo = self.job['repo']
             clone_url = repo['clone_url']
@@ -202,6 +287,7 @@ class RunJob(Job):
             def_repo = definition.get('repository', {})
             repo_clone = def_repo.get('clone', True)
             repo_submodules = def_repo.get('submodules', True)
+            repo_sparse_checkout = def_repo.get('sparse_checkout', None)
 
             commit = repo['commit']
 
@@ -215,7 +301,8 @@ class RunJob(Job):
                 clone_url = clone_url.replace('github.com',
                                               '%s@github.com' % self.repository['github_api_token'])
 
-            self.clone_repo(commit, clone_url, branch, ref, clone_all, submodules=repo_submodules)
+            self.clone_repo(c, commit, clone_url, branch, ref, clone_all, submodules=repo_submodules,
+                            sparse_checkout=repo_sparse_checkout)
         elif self.project['type'] == 'upload':
             c.collect("Downloading Source")
             storage_source_zip = os.path.join(self.storage_dir, 'source.zip')
@@ -243,11 +330,10 @@ class RunJob(Job):
             raise Failure("infrabox.json not found")
 
         c.header("Parsing infrabox.json", show=True)
-        data = self.parse_infrabox_json(ib_json)
-        self.check_file_exist(data, self.mount_repo_dir)
+        definitions = self.resolve_includes(c, 'infrabox.json')
 
         c.header("Creating jobs", show=True)
-        jobs = self.get_job_list(data, c, self.job['repo'], infrabox_paths={ib_json: True})
+        jobs = self.get_job_list(definitions, None, 'infrabox.json', c, self.job['repo'])
 
         if jobs:
             self.create_jobs(jobs)
@@ -268,8 +354,10 @@ class RunJob(Job):
                 f.write("started")
 
     def main(self):
+        start = time.time()
         self.update_status('running')
         self.load_data()
+        self.console.collect("Loaded job in %.2fs\n" % (time.time() - start), show=True)
 
         # Show environment
         self.console.collect("Environment:\n", show=True)
@@ -299,10 +387,9 @@ class RunJob(Job):
                 self.console.collect("%s\n" % d['host'], show=True)
             self.console.collect("\n", show=True)
 
-        self.get_source()
-        self.create_infrabox_directories()
-
         if self.job['type'] == 'create_job_matrix':
+            self.get_source(self.console)
+            self.create_infrabox_directories()
             self.main_create_jobs()
         else:
             self.main_run_job()
@@ -312,8 +399,7 @@ class RunJob(Job):
         r = parser.parse(self.infrabox_badge_dir)
         return r
 
-    def upload_archive(self):
-        c = self.console
+    def upload_archive(self, c):
 
         if os.path.exists(self.infrabox_archive_dir):
             files = self.get_files_in_dir(self.infrabox_archive_dir)
@@ -334,8 +420,7 @@ class RunJob(Job):
                     c.collect("%s\n" % f, show=True)
 
 
-    def upload_coverage_results(self):
-        c = self.console
+    def upload_coverage_results(self, c):
         if not os.path.exists(self.infrabox_coverage_dir):
             return
 
@@ -360,8 +445,7 @@ class RunJob(Job):
 
         return out
 
-    def upload_test_results(self):
-        c = self.console
+    def upload_test_results(self, c):
         if not os.path.exists(self.infrabox_testresult_dir):
             return
 
@@ -371,18 +455,17 @@ class RunJob(Job):
             c.collect("%s\n" % f, show=True)
             converted_result = self.convert_test_result(f)
 
-            r = requests.post("%s/testresult" % self.api_server,
-                              headers=self.get_headers(),
-                              verify=self.verify,
-                              files={"data": open(converted_result)}, timeout=10)
+            r = self.session.post("%s/testresult" % self.api_server,
+                                  headers=self.get_headers(),
+                                  verify=self.verify,
+                                  files={"data": open(converted_result)}, timeout=10)
 
             if r.status_code != 200:
                 c.collect("%s\n" % r.text, show=True)
 
             self.post_file_to_api_server("/archive", f, filename=f.replace(self.infrabox_upload_dir, ''))
 
-    def upload_markdown_files(self):
-        c = self.console
+    def upload_markdown_files(self, c):
         if not os.path.exists(self.infrabox_markdown_dir):
             return
 
@@ -391,16 +474,15 @@ class RunJob(Job):
             c.collect("%s\n" % f, show=True)
 
             file_name = os.path.basename(f)
-            r = requests.post("%s/markdown" % self.api_server,
-                              headers=self.get_headers(),
-                              verify=self.verify,
-                              files={file_name: open(f)}, timeout=10)
+            r = self.session.post("%s/markdown" % self.api_server,
+                                  headers=self.get_headers(),
+                                  verify=self.verify,
+                                  files={file_name: open(f)}, timeout=10)
 
             if r.status_code != 200:
                 c.collect("%s\n" % r.text, show=True)
 
-    def upload_markup_files(self):
-        c = self.console
+    def upload_markup_files(self, c):
         if not os.path.exists(self.infrabox_markup_dir):
             return
 
@@ -409,16 +491,15 @@ class RunJob(Job):
             c.collect("%s\n" % f, show=True)
 
             file_name = os.path.basename(f)
-            r = requests.post("%s/markup" % self.api_server,
-                              headers=self.get_headers(),
-                              verify=self.verify,
-                              files={file_name: open(f)}, timeout=10)
+            r = self.session.post("%s/markup" % self.api_server,
+                                  headers=self.get_headers(),
+                                  verify=self.verify,
+                                  files={file_name: open(f)}, timeout=10)
 
             if r.status_code != 200:
                 c.collect("%s\n" % r.text, show=True)
 
-    def upload_badge_files(self):
-        c = self.console
+    def upload_badge_files(self, c):
         if not os.path.exists(self.infrabox_badge_dir):
             return
 
@@ -428,26 +509,22 @@ class RunJob(Job):
             c.collect("%s\n" % f, show=True)
 
             file_name = os.path.basename(f)
-            r = requests.post("%s/badge" % self.api_server,
-                              headers=self.get_headers(),
-                              verify=self.verify,
-                              files={file_name: open(f)}, timeout=10)
+            r = self.session.post("%s/badge" % self.api_server,
+                                  headers=self.get_headers(),
+                                  verify=self.verify,
+                                  files={file_name: open(f)}, timeout=10)
 
             if r.status_code != 200:
                 c.collect("%s\n" % r.text, show=True)
 
-    def create_dynamic_jobs(self):
-        c = self.console
+    def create_dynamic_jobs(self, c):
         infrabox_json_path = os.path.join(self.infrabox_output_dir, 'infrabox.json')
-        infrabox_context = os.path.dirname(infrabox_json_path)
 
         if os.path.exists(infrabox_json_path):
             c.header("Creating jobs", show=True)
-            data = self.parse_infrabox_json(infrabox_json_path)
-            self.check_file_exist(data, infrabox_context)
-            jobs = self.get_job_list(data, c, self.job['repo'],
-                                     infrabox_paths={infrabox_json_path: True},
-                                     infrabox_context=infrabox_context)
+            path = os.path.relpath(infrabox_json_path, self.mount_repo_dir)
+            definitions = self.resolve_includes(c, path)
+            jobs = self.get_job_list(definitions, None, path, c, self.job['repo'])
             c.collect(json.dumps(jobs, indent=4), show=True)
 
             if jobs:
@@ -464,86 +541,112 @@ class RunJob(Job):
                 total_size += os.path.getsize(fp)
         return total_size
 
-    def main_run_job(self):
-        c = self.console
-        self.create_jobs_json()
+    def sync_input(self, dep):
+        """ Streams the output of a parent job straight into the extractor.
+        Returns the size and duration of the download or None if the
+        parent has no output. """
+        start = time.time()
 
-        # base dir for inputs
-        storage_inputs_dir = os.path.join(self.storage_dir, 'inputs')
+        r = self.get_stream_from_api_server('/output/%s' % dep['id'])
+        if r is None:
+            return None
 
-        # Sync deps
-        c.collect("Syncing inputs:", show=True)
-        for dep in self.parents:
-            storage_input_file_dir = os.path.join(storage_inputs_dir, dep['id'])
-            os.makedirs(storage_input_file_dir)
+        infrabox_input_dir = os.path.join(self.infrabox_inputs_dir, dep['name'].split('/')[-1])
+        os.makedirs(infrabox_input_dir)
 
-            storage_input_file_tar = os.path.join(storage_input_file_dir, 'output.tar.gz')
-            self.get_file_from_api_server('/output/%s' % dep['id'], storage_input_file_tar)
+        try:
+            # outputs are gzip, but may have been written with another codec
+            # by jobs of an older version, the first bytes tell which
+            chunks = r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+            head = next(chunks, '')
+            codec = detect_stream(head)
+
+            with tempfile.TemporaryFile() as errors:
+                p = subprocess.Popen("set -o pipefail; %s | tar x -C %s"
+                                     % (codec.decompress_command(), infrabox_input_dir),
+                                     shell=True, executable='/bin/bash',
+                                     stdin=subprocess.PIPE, stdout=errors, stderr=subprocess.STDOUT)
 
-            if os.path.isfile(storage_input_file_tar):
-                c.collect("output found for %s\n" % dep['name'], show=True)
-                infrabox_input_dir = os.path.join(self.infrabox_inputs_dir, dep['name'].split('/')[-1])
-                os.makedirs(infrabox_input_dir)
-                self.uncompress(storage_input_file_tar, infrabox_input_dir, c)
-                c.execute(['ls', '-alh', infrabox_input_dir], show=True)
-                os.remove(storage_input_file_tar)
-            else:
-                c.collect("no output found for %s\n" % dep['name'], show=True)
-        c.collect("\n", show=True)
+                try:
+                    size = len(head)
+                    try:
+                        p.stdin.write(head)
+                        for chunk in chunks:
+                            size += len(chunk)
+                            p.stdin.write(chunk)
+                    except IOError:
+                        # the extractor failed, its output tells why
+                        pass
+                    finally:
+                        p.stdin.close()
+
+                    if p.wait() != 0:
+                        errors.seek(0)
+                        raise Failure('Failed to unpack output of %s: %s' % (dep['name'], errors.read()))
+                finally:
+                    # e.g. the download failed
+                    if p.poll() is None:
+                        p.kill()
+                        p.wait()
+        finally:
+            r.close()
 
-        # <storage_dir>/cache is synced with the corresponding
-        # Storage path which stores the compressed cache
-        storage_cache_dir = os.path.join(self.storage_dir, 'cache')
-        os.makedirs(storage_cache_dir)
+        return size, time.time() - start
 
-        storage_cache_tar = os.path.join(storage_cache_dir, 'cache.tar.gz')
+    def sync_inputs(self, c):
+        """ Syncs the outputs of all parents with a pool of workers """
+        parents = Queue.Queue()
+        for dep in self.parents:
+            parents.put(dep)
 
-        c.collect("Syncing cache:", show=True)
-        if not self.job['definition'].get('cache', {}).get('data', True):
-            c.collect("Not downloading cache, because cache.data has been set to false", show=True)
-        else:
-            self.get_file_from_api_server("/cache", storage_cache_tar)
+        results = Queue.Queue()
 
-            if os.path.isfile(storage_cache_tar):
-                c.collect("Unpacking cache", show=True)
+        def worker():
+            while True:
                 try:
-                    c.execute(['time', 'tar', '-zxf', storage_cache_tar, '-C', self.infrabox_cache_dir], show=True)
-                except:
-                    c.collect("Failed to unpack cache\n", show=True)
-                os.remove(storage_cache_tar)
-            else:
-                c.collect("no cache found\n", show=True)
-        c.collect("\n", show=True)
+                    dep = parents.get_nowait()
+                except Queue.Empty:
+                    return
 
-        try:
-            if self.job['definition']['type'] == 'docker':
-                self.run_job_docker(c)
-            elif self.job['definition']['type'] == 'docker-image':
-                self.run_job_docker_image(c)
-            elif self.job['definition']['type'] == 'docker-compose':
-                self.run_job_docker_compose(c)
+                try:
+                    results.put((dep, self.sync_input(dep), None))
+                except Exception as e:
+                    results.put((dep, None, e))
+
+        for _ in range(min(INPUT_WORKERS, len(self.parents))):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+
+        # the console is only used from here, in the order the parents finish
+        error = None
+        for _ in self.parents:
+            dep, result, e = results.get()
+
+            if e:
+                c.collect("failed to sync output of %s: %s\n" % (dep['name'], e), show=True)
+                error = error or e
+            elif result:
+                size, duration = result
+                c.collect("output found for %s: %s kb in %.2fs\n" % (dep['name'], size / 1024, duration),
+                          show=True)
+                infrabox_input_dir = os.path.join(self.infrabox_inputs_dir, dep['name'].split('/')[-1])
+                c.execute(['ls', '-alh', infrabox_input_dir], show=True)
             else:
-                raise Exception('Unknown job type: %s' % self.job['type'])
-        except:
-            raise
-        finally:
-            self.upload_coverage_results()
-            self.upload_test_results()
-            self.upload_markdown_files()
-            self.upload_markup_files()
-            self.upload_badge_files()
-            self.upload_archive()
+                c.collect("no output found for %s\n" % dep['name'], show=True)
 
-        self.create_dynamic_jobs()
+        if error:
+            raise error
 
-        # Compressing output
+    def upload_output(self, c):
         c.collect("Uploading /infrabox/output", show=True)
         if os.path.isdir(self.infrabox_output_dir) and os.listdir(self.infrabox_output_dir):
             storage_output_dir = os.path.join(self.storage_dir, self.job['id'])
             os.makedirs(storage_output_dir)
 
             storage_output_tar = os.path.join(storage_output_dir, 'output.tar.gz')
-            self.compress(self.infrabox_output_dir, storage_output_tar)
+            # always tar.gz, which is what the api serves it as
+            self.compress(self.infrabox_output_dir, storage_output_tar, Gzip())
             file_size = os.stat(storage_output_tar).st_size
 
             max_output_size = os.environ['INFRABOX_JOB_MAX_OUTPUT_SIZE']
@@ -555,28 +658,137 @@ class RunJob(Job):
         else:
             c.collect("Output is empty", show=True)
 
-        c.collect("\n", show=True)
-
-        # Compressing cache
+    def upload_cache(self, c, codec, cache_manifest):
         c.collect("Uploading /infrabox/cache", show=True)
         if not self.job['definition'].get('cache', {}).get('data', True):
             c.collect("Not updating cache, because cache.data has been set to false", show=True)
         else:
             if os.path.isdir(self.infrabox_cache_dir) and os.listdir(self.infrabox_cache_dir):
-                self.compress(self.infrabox_cache_dir, storage_cache_tar)
+                ChunkedCache(self, c, codec).save(self.infrabox_cache_dir, cache_manifest)
+            else:
+                c.collect("Cache is empty", show=True)
+
+    def finalize(self, c, codec, cache_manifest, succeeded):
+        """ Uploads everything the job produced, the stages which don't
+        depend on each other run at the same time. Reports are always
+        uploaded, output, cache and dynamic jobs only if the job succeeded. """
+        c.collect("\n", show=True)
+
+        p = Pipeline(c)
 
-                file_size = os.stat(storage_cache_tar).st_size
+        if succeeded:
+            p.add('output', self.upload_output)
+            p.add('cache', lambda sc: self.upload_cache(sc, codec, cache_manifest))
+            p.add('dynamic jobs', self.create_dynamic_jobs)
 
-                max_output_size = os.environ['INFRABOX_JOB_MAX_OUTPUT_SIZE']
-                c.collect("Output size: %s kb" % (file_size / 1024), show=True)
-                if file_size > max_output_size:
-                    raise Failure("Output too large")
+        p.add('coverage', self.upload_coverage_results)
+        p.add('test results', self.upload_test_results)
+        p.add('markdown', self.upload_markdown_files)
+        p.add('markup', self.upload_markup_files, depends_on=['coverage'])
+        p.add('badges', self.upload_badge_files, depends_on=['coverage', 'test results'])
+        p.add('archive', self.upload_archive)
+        p.run()
 
-                self.post_file_to_api_server('/cache', storage_cache_tar)
+        c.collect("\n", show=True)
+
+    def wait_for_docker(self, c):
+        """ The daemon is started by the entrypoint and comes up while the
+        job is being prepared """
+        with open(os.devnull, 'w') as devnull:
+            def docker_ready():
+                return subprocess.call(['docker', 'version'], stdout=devnull, stderr=devnull) == 0
+
+            if not wait_until(docker_ready, DOCKER_START_TIMEOUT):
+                raise Failure("Docker daemon not started")
+
+        c.collect("Docker daemon is ready\n", show=True)
+
+    def restore_cache(self, c, codec):
+        """ Restores /infrabox/cache from the chunked cache, caches of older
+        versions are still downloaded as one tar.gz. Returns the manifest of
+        the restored chunked cache. """
+        if not self.job['definition'].get('cache', {}).get('data', True):
+            c.collect("Not downloading cache, because cache.data has been set to false", show=True)
+            return None
+
+        cache_manifest = None
+        try:
+            cache_manifest = ChunkedCache(self, c, codec).restore(self.infrabox_cache_dir)
+        except Exception as e:
+            c.collect("Failed to restore cache: %s\n" % e, show=True)
+            shutil.rmtree(self.infrabox_cache_dir, True)
+            makedirs(self.infrabox_cache_dir)
+
+        if cache_manifest is None:
+            storage_cache_dir = os.path.join(self.storage_dir, 'cache')
+            os.makedirs(storage_cache_dir)
+
+            storage_cache_tar = os.path.join(storage_cache_dir, 'cache.tar.gz')
+            self.get_file_from_api_server("/cache", storage_cache_tar)
+
+            if os.path.isfile(storage_cache_tar):
+                c.collect("Unpacking cache", show=True)
+                try:
+                    c.execute(['bash', '-c', 'set -o pipefail; pigz -dc %s | tar x -C %s'
+                               % (storage_cache_tar, self.infrabox_cache_dir)],
+                              show=True)
+                except:
+                    c.collect("Failed to unpack cache\n", show=True)
+                os.remove(storage_cache_tar)
             else:
-                c.collect("Cache is empty", show=True)
+                c.collect("no cache found\n", show=True)
+
+        return cache_manifest
+
+    def prepare(self, c, codec):
+        """ Gets everything the job needs. The data directory is inside of
+        the repository, so the source comes first. Then the inputs and the
+        cache are restored at the same time. The docker daemon starts
+        meanwhile. Returns the manifest of the restored cache. """
+        start = time.time()
+        restored = {}
+
+        def create_directories(_):
+            self.create_infrabox_directories()
+            self.create_jobs_json()
+
+        def restore_cache(sc):
+            restored['manifest'] = self.restore_cache(sc, codec)
+
+        p = Pipeline(c)
+        p.add('docker', self.wait_for_docker)
+        p.add('source', self.get_source, live=True)
+        p.add('directories', create_directories, depends_on=['source'])
+        p.add('inputs', self.sync_inputs, depends_on=['directories'])
+        p.add('cache', restore_cache, depends_on=['directories'])
+        p.run()
+
+        c.collect("Prepared job in %.2fs\n" % (time.time() - start), show=True)
         c.collect("\n", show=True)
 
+        return restored.get('manifest', None)
+
+    def main_run_job(self):
+        c = self.console
+
+        codec = get_codec(self.job['definition'].get('cache', {}))
+        cache_manifest = self.prepare(c, codec)
+
+        try:
+            if self.job['definition']['type'] == 'docker':
+                self.run_job_docker(c)
+            elif self.job['definition']['type'] == 'docker-image':
+                self.run_job_docker_image(c)
+            elif self.job['definition']['type'] == 'docker-compose':
+                self.run_job_docker_compose(c)
+            else:
+                raise Exception('Unknown job type: %s' % self.job['type'])
+        except:
+            self.finalize(c, codec, cache_manifest, False)
+            raise
+
+        self.finalize(c, codec, cache_manifest, True)
+
         shutil.rmtree(self.mount_data_dir, True)
         shutil.rmtree(self.infrabox_cache_dir, True)
 
@@ -1020,12 +1232,12 @@ class RunJob(Job):
         finally:
             self.logout_docker_registry()
 
-    def parse_infrabox_json(self, path):
+    def parse_infrabox_json(self, path, c):
         with open(path, 'r') as f:
             data = None
             try:
                 data = json.load(f)
-                self.console.collect(json.dumps(data, indent=4), show=True)
+                c.collect(json.dumps(data, indent=4), show=True)
                 validate_json(data)
             except Exception as e:
                 raise Failure(e.__str__())
@@ -1055,32 +1267,145 @@ class RunJob(Job):
                 if not os.path.exists(p):
                     raise Failure("%s does not exist" % p)
 
-    def rewrite_depends_on(self, data):
-        for job in data['jobs']:
-            for i in range(0, len(job.get('depends_on', []))):
-                d = job['depends_on'][i]
+    def get_source_dir(self, source):
+        """ Where the repository of a source is cloned to """
+        if source is None:
+            return self.mount_repo_dir
 
-                if not isinstance(d, dict):
-                    job['depends_on'][i] = {"job": d, "on": ["finished"]}
-                    continue
+        return os.path.join(self.mount_repo_dir, '.infrabox', 'tmp', get_include_hash(source)[:16])
 
-                on = d['on']
-                for n in range(0, len(on)):
-                    if on[n] == "*":
-                        d['on'] = ["finished", "error", "failure", "skipped"]
-                        break
+    def load_definitions(self, c, source, path):
+        """ The definition in path and the workflows it includes from the
+        same repository, parsed and validated, by their path in the
+        repository """
+        source_dir = self.get_source_dir(source)
+        definitions = {}
+        pending = [os.path.normpath(path)]
 
-    def get_job_list(self, data, c, repo, parent_name="",
-                     infrabox_context=None, infrabox_paths=None):
-        #pylint: disable=too-many-locals
+        while pending:
+            p = pending.pop()
+            if p in definitions:
+                continue
 
-        if not infrabox_context:
-            infrabox_context = self.mount_repo_dir
+            full_path = os.path.join(source_dir, p)
+            data = self.parse_infrabox_json(full_path, c)
+            self.check_file_exist(data, os.path.dirname(full_path))
+            definitions[p] = data
 
-        if not infrabox_paths:
-            infrabox_paths = {}
+            for job in data['jobs']:
+                if job['type'] == 'workflow':
+                    pending.append(os.path.normpath(os.path.join(os.path.dirname(p), job['infrabox_file'])))
 
-        self.rewrite_depends_on(data)
+        return definitions
+
+    def get_cached_definitions(self, key):
+        try:
+            r = self.session.get("%s/cache/definitions/%s" % (self.api_server, get_include_hash(key)),
+                                 headers=self.get_headers(), timeout=60, verify=self.verify)
+
+            if r.status_code != 200:
+                return None
+
+            return json.loads(gzip.GzipFile(fileobj=StringIO(r.content)).read())
+        except Exception as e:
+            print e
+            return None
+
+    def cache_definitions(self, key, definitions):
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            json.dump(definitions, f)
+
+        try:
+            r = self.session.post("%s/cache/definitions/%s" % (self.api_server, get_include_hash(key)),
+                                  headers=self.get_headers(), files={'definitions.json.gz': buf.getvalue()},
+                                  timeout=60, verify=self.verify)
+
+            if r.status_code != 200:
+                print r.text
+        except Exception as e:
+            print e
+
+    def load_include(self, c, key):
+        """ The definitions of a repository included with a git job. Those
+        of a fixed commit never change, they are cached and the repository
+        is only cloned once. """
+        clone_url, commit, infrabox_file = key
+        pinned = COMMIT_SHA.match(commit) is not None
+
+        if pinned:
+            definitions = self.get_cached_definitions(key)
+
+            if definitions is not None:
+                c.collect("Using the cached definitions of %s at %s\n" % (clone_url, commit), show=True)
+                return definitions
+
+        c.header("Clone repo %s" % clone_url, show=True)
+        source_dir = self.get_source_dir(key)
+        shutil.rmtree(source_dir, True)
+        os.makedirs(source_dir)
+
+        self.clone_repo(c, commit, clone_url, None, None, False, os.path.relpath(source_dir, self.mount_repo_dir))
+
+        c.header("Parsing %s" % infrabox_file, show=True)
+        definitions = self.load_definitions(c, key, infrabox_file)
+
+        # the api only takes them from the job creating the jobs
+        if pinned and self.job['type'] == 'create_job_matrix':
+            self.cache_definitions(key, definitions)
+
+        return definitions
+
+    def resolve_includes(self, c, path):
+        """ Loads the definitions of the build's repository, which is the
+        source None, and of all repositories included with git jobs, keyed
+        by their include. The includes are resolved level by level, the
+        repositories of a level are loaded at the same time. """
+        definitions = {None: self.load_definitions(c, None, path)}
+        level = get_git_includes(definitions[None])
+
+        while level:
+            level = sorted(set(k for k in level if k not in definitions))
+            consoles = dict((k, BufferedConsole()) for k in level)
+            results = {}
+            errors = {}
+
+            def load(key):
+                try:
+                    results[key] = self.load_include(consoles[key], key)
+                except Exception as e:
+                    errors[key] = e
+
+            run_parallel(load, level, INCLUDE_WORKERS)
+
+            for k in level:
+                consoles[k].replay(c)
+
+            for k in level:
+                if k in errors:
+                    raise errors[k]
+
+            next_level = []
+            for k in level:
+                definitions[k] = results[k]
+                next_level += get_git_includes(results[k])
+
+            level = next_level
+
+        return definitions
+
+    def get_job_list(self, definitions, source, path, c, repo, parent_name="", includes=None):
+        """ The jobs of the definition in path of a source, with the jobs of
+        everything it includes. includes are the definitions which include
+        this one, to detect recursion. """
+        #pylint: disable=too-many-locals
+        includes = includes or [(source, path)]
+
+        data = copy.deepcopy(definitions[source][path])
+        source_dir = self.get_source_dir(source)
+        infrabox_context = os.path.dirname(os.path.join(source_dir, path))
+
+        rewrite_depends_on(data)
 
         jobs = []
         for job in data['jobs']:
@@ -1102,65 +1427,38 @@ class RunJob(Job):
                 continue
 
             if job['type'] == "git":
-                c.header("Clone repo %s" % job['clone_url'], show=True)
-                clone_url = job['clone_url']
+                key = get_include_key(job)
+                include = (key, key[2])
 
-                sub_path = os.path.join('.infrabox', 'tmp', job_name)
-                new_repo_path = os.path.join(self.mount_repo_dir, sub_path)
-                c.execute(['rm', '-rf', new_repo_path])
-                os.makedirs(new_repo_path)
-
-                self.clone_repo(job['commit'], clone_url, None, None, False, sub_path)
-
-                c.header("Parsing infrabox.json", show=True)
-                ib_file = job.get('infrabox_file', 'infrabox.json')
-                ib_path = os.path.join(new_repo_path, ib_file)
-
-                if ib_path in infrabox_paths:
+                if include in includes:
                     raise Failure("Recursive include detected")
 
-                infrabox_paths[ib_path] = True
-                c.collect("file: %s" % ib_path)
-                yml = self.parse_infrabox_json(ib_path)
-
                 git_repo = {
                     "clone_url": job['clone_url'],
                     "commit": job['commit'],
-                    "infrabox_file": ib_file
+                    "infrabox_file": key[2]
                 }
 
-                new_infrabox_context = os.path.dirname(ib_path)
-
-                self.check_file_exist(yml, new_infrabox_context)
-                sub = self.get_job_list(yml, c, git_repo,
+                sub = self.get_job_list(definitions, key, include[1], c, git_repo,
                                         parent_name=job_name,
-                                        infrabox_context=new_infrabox_context,
-                                        infrabox_paths=infrabox_paths)
+                                        includes=includes + [include])
 
+                new_repo_path = self.get_source_dir(key)
                 for s in sub:
-                    s['infrabox_context'] = s['infrabox_context'].replace(new_repo_path, self.mount_repo_dir)
-
-                del infrabox_paths[ib_path]
+                    # wait jobs have no context
+                    if 'infrabox_context' in s:
+                        s['infrabox_context'] = s['infrabox_context'].replace(new_repo_path, self.mount_repo_dir)
 
             if job['type'] == 'workflow':
-                c.header("Parsing infrabox.json", show=True)
-                p = os.path.join(infrabox_context, job['infrabox_file'])
-                c.collect("file: %s\n" % p)
+                p = os.path.normpath(os.path.join(os.path.dirname(path), job['infrabox_file']))
+                include = (source, p)
 
-                if p in infrabox_paths:
+                if include in includes:
                     raise Failure("Recursive include detected")
 
-                infrabox_paths[p] = True
-
-                yml = self.parse_infrabox_json(p)
-                new_infrabox_context = os.path.dirname(p)
-                self.check_file_exist(yml, new_infrabox_context)
-
-                sub = self.get_job_list(yml, c, repo,
+                sub = self.get_job_list(definitions, source, p, c, repo,
                                         parent_name=job_name,
-                                        infrabox_context=new_infrabox_context)
-
-                del infrabox_paths[p]
+                                        includes=includes + [include])
 
             # every sub job which does not have a parent
             # should be a child of the current job
@@ -1218,8 +1516,8 @@ def main():
     try:
         j = RunJob(console)
         j.main()
-        j.console.flush()
         j.console.header('Finished', show=True)
+        j.console.flush()
         j.update_status('finished', message='Successfully finished')
     except Failure as e:
         j.console.header('Failure', show=True)
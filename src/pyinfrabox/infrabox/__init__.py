@@ -13,7 +13,7 @@ def check_name(n, path):
         raise ValidationError(path, "'%s' not a valid value" % n)
 
 def parse_repository(d, path):
-    check_allowed_properties(d, path, ('clone', 'submodules'))
+    check_allowed_properties(d, path, ('clone', 'submodules', 'sparse_checkout'))
 
     if 'clone' in d:
         check_boolean(d['clone'], path + ".clone")
@@ -21,6 +21,9 @@ def parse_repository(d, path):
     if 'submodules' in d:
         check_boolean(d['submodules'], path + ".submodules")
 
+    if 'sparse_checkout' in d:
+        check_string_array(d['sparse_checkout'], path + ".sparse_checkout")
+
 def parse_cluster(d, path):
     check_allowed_properties(d, path, ('selector',))
 
@@ -110,7 +113,7 @@ def parse_environment(e, path):
                 raise ValidationError(p, "must be a string or object")
 
 def parse_cache(d, path):
-    check_allowed_properties(d, path, ("data", "image", "after_image"))
+    check_allowed_properties(d, path, ("data", "image", "after_image", "compression", "compression_level"))
 
     if 'data' in d:
         check_boolean(d['data'], path + ".data")
@@ -121,6 +124,21 @@ def parse_cache(d, path):
     if 'after_image' in d:
         check_boolean(d['after_image'], path + ".after_image")
 
+    if 'compression' in d:
+        if d['compression'] not in ('zstd', 'gzip', 'none'):
+            raise ValidationError(path + ".compression", "not a valid value")
+
+    if 'compression_level' in d:
+        level = d['compression_level']
+
+        # booleans are ints as well
+        if isinstance(level, bool) or not isinstance(level, int):
+            raise ValidationError(path + ".compression_level", "must be an integer")
+
+        max_level = 9 if d.get('compression', 'gzip') == 'gzip' else 19
+        if level < 1 or level > max_level:
+            raise ValidationError(path + ".compression_level", "must be between 1 and %s" % max_level)
+
 def parse_git(d, path):
     check_allowed_properties(d, path, ("type", "name", "commit", "clone_url",
                                        "depends_on", "environment", "infrabox_file"))
@@ -522,3 +540,15 @@ def validate_json(d):
             deps[parent_name] = True
 
     return True
+
+def rewrite_depends_on(d):
+    """ Brings the depends_on of all jobs of a validated document into
+    the form {"job": <name>, "on": [<states>]}, "*" stands for all states """
+    for job in d['jobs']:
+        deps = job.get('depends_on', [])
+
+        for i in range(0, len(deps)):
+            if not isinstance(deps[i], dict):
+                deps[i] = {"job": deps[i], "on": ["finished"]}
+            elif "*" in deps[i]['on']:
+                deps[i]['on'] = ["finished", "error", "failure", "skipped"]
@@ -1,7 +1,7 @@
 import unittest
 
 from pyinfrabox import ValidationError
-from pyinfrabox.infrabox import validate_json
+from pyinfrabox.infrabox import validate_json, rewrite_depends_on
 
 class TestDockerCompose(unittest.TestCase):
     def raises_expect(self, data, expected):
@@ -344,6 +344,83 @@ class TestDockerCompose(unittest.TestCase):
 
         validate_json(d)
 
+    def test_rewrite_depends_on(self):
+        d = {
+            "version": 1,
+            "jobs": [{
+                "type": "wait",
+                "name": "a"
+            }, {
+                "type": "wait",
+                "name": "b",
+                "depends_on": ["a", {"job": "a", "on": ["*"]}, {"job": "a", "on": ["error"]}]
+            }]
+        }
+
+        rewrite_depends_on(d)
+
+        self.assertNotIn('depends_on', d['jobs'][0])
+        self.assertEqual(d['jobs'][1]['depends_on'], [
+            {"job": "a", "on": ["finished"]},
+            {"job": "a", "on": ["finished", "error", "failure", "skipped"]},
+            {"job": "a", "on": ["error"]}
+        ])
+
+    def test_cache_compression(self):
+        d = {
+            "version": 1,
+            "jobs": [{
+                "type": "docker",
+                "name": "test",
+                "docker_file": "Dockerfile",
+                "resources": {"limits": {"cpu": 1, "memory": 1024}},
+                "cache": {"compression": "lz4"}
+            }]
+        }
+
+        self.raises_expect(d, "#jobs[0].cache.compression: not a valid value")
+
+        d['jobs'][0]['cache'] = {'compression': 'zstd', 'compression_level': '3'}
+        self.raises_expect(d, "#jobs[0].cache.compression_level: must be an integer")
+
+        d['jobs'][0]['cache'] = {'compression': 'zstd', 'compression_level': 3.5}
+        self.raises_expect(d, "#jobs[0].cache.compression_level: must be an integer")
+
+        d['jobs'][0]['cache'] = {'compression': 'zstd', 'compression_level': True}
+        self.raises_expect(d, "#jobs[0].cache.compression_level: must be an integer")
+
+        d['jobs'][0]['cache'] = {'compression_level': 12}
+        self.raises_expect(d, "#jobs[0].cache.compression_level: must be between 1 and 9")
+
+        d['jobs'][0]['cache'] = {'compression': 'zstd', 'compression_level': 20}
+        self.raises_expect(d, "#jobs[0].cache.compression_level: must be between 1 and 19")
+
+        d['jobs'][0]['cache'] = {'compression': 'zstd', 'compression_level': 19}
+        validate_json(d)
+
+        d['jobs'][0]['cache'] = {'compression': 'none'}
+        validate_json(d)
+
+    def test_repository_sparse_checkout(self):
+        d = {
+            "version": 1,
+            "jobs": [{
+                "type": "docker",
+                "name": "test",
+                "docker_file": "Dockerfile",
+                "resources": {"limits": {"cpu": 1, "memory": 1024}},
+                "repository": {"sparse_checkout": "src/"}
+            }]
+        }
+
+        self.raises_expect(d, "#jobs[0].repository.sparse_checkout: must be an array")
+
+        d['jobs'][0]['repository'] = {'sparse_checkout': []}
+        self.raises_expect(d, "#jobs[0].repository.sparse_checkout: must not be empty")
+
+        d['jobs'][0]['repository'] = {'sparse_checkout': ['src/', 'Dockerfile']}
+        validate_json(d)
+
     def test_valid(self):
         d = {
             "version": 1,
@@ -0,0 +1,483 @@
+""" Creation of the jobs of a build.
+
+insert_jobs inserts the jobs a job created, usually the "Create Jobs" job
+from the build's infrabox.json.
+
+Most builds have a single infrabox.json whose jobs neither include other
+definitions nor refer to files which may be generated. create_jobs creates
+their jobs right away from the infrabox.json at the build's commit, which
+saves scheduling a pod which only clones the repository to read it.
+Otherwise, or if anything goes wrong, the "Create Jobs" job stays queued
+and creates the jobs as before. The api and the triggers use it when
+they start a build. """
+
+import copy
+import json
+import os
+import uuid
+import zipfile
+from datetime import datetime
+
+import requests
+
+from pyinfrabox.infrabox import validate_json, rewrite_depends_on
+from pyinfraboxutils import get_env, get_logger
+from pyinfraboxutils.placement import get_placement_policy, matches_selector
+from pyinfraboxutils.rightsizing import rightsize_jobs
+
+logger = get_logger('jobgraph')
+
+class InvalidJobsError(Exception):
+    """ The jobs can't be created, e.g. a secret doesn't exist """
+    pass
+
+# the priority of the jobs on the critical path of a build
+MAX_PRIORITY = 1000
+
+def compute_priorities(jobs, jobname_id):
+    # The priority of a job is the expected duration of the longest
+    # path from it to the end of the build (critical path), so the
+    # scheduler can start the jobs everything else waits for first.
+    # It is relative to the build's critical path, so a build with
+    # long jobs doesn't overtake older builds, which go first on ties.
+    children = {}
+    for j in jobs:
+        for d in j.get('depends_on', []):
+            parent_id = jobname_id.get(d['job'], None)
+
+            if parent_id:
+                children.setdefault(parent_id, []).append(j['id'])
+
+    jobs_by_id = dict((j['id'], j) for j in jobs)
+    remaining = {}
+
+    # children before their parents, without recursion, builds may have long chains
+    for j in jobs:
+        stack = [(j['id'], False)]
+
+        while stack:
+            job_id, visited = stack.pop()
+
+            if visited:
+                r = max([remaining[c] for c in children.get(job_id, [])] or [0])
+                remaining[job_id] = int(jobs_by_id[job_id].get('avg_duration', None) or 0) + r
+                continue
+
+            if job_id in remaining:
+                continue
+
+            # cycles are rejected by the validation, this only guards against them
+            remaining[job_id] = 0
+            stack.append((job_id, True))
+            for child_id in children.get(job_id, []):
+                if child_id not in remaining:
+                    stack.append((child_id, False))
+
+    critical_path = max(remaining.values() or [0])
+
+    for j in jobs:
+        if critical_path:
+            j['priority'] = int(round(float(MAX_PRIORITY) * remaining[j['id']] / critical_path))
+        else:
+            j['priority'] = 0
+
+def find_leaf_jobs(jobs):
+    parent_jobs = {}
+    leaf_jobs = []
+
+    for j in jobs:
+        for d in j.get('depends_on', []):
+            parent_jobs[d['job']] = True
+
+    for j in jobs:
+        if not parent_jobs.get(j['name'], False):
+            leaf_jobs.append(j)
+
+    return leaf_jobs
+
+def assign_cluster(db, jobs):
+    # current load of each cluster, the same numbers as in the admin view
+    clusters = db.execute_many_dict('''
+        SELECT c.name, c.labels, c.active, c.cpu_capacity, c.memory_capacity,
+               COALESCE(SUM(j.cpu), 0) cpu, COALESCE(SUM(j.memory), 0) memory
+        FROM cluster c
+        LEFT JOIN job j
+        ON j.cluster_name = c.name
+        AND j.state IN ('queued', 'scheduled', 'running')
+        GROUP BY c.name
+    ''')
+
+    policy = get_placement_policy(os.environ.get('INFRABOX_API_CLUSTER_PLACEMENT', 'first'),
+                                  clusters)
+    assigned_clusters = {}
+
+    for j in jobs:
+        if 'cluster' not in j:
+            j['cluster'] = {}
+
+        cluster_selector = j['cluster'].get('selector', None)
+        candidates = [c for c in clusters if matches_selector(c, cluster_selector)]
+
+        parent_clusters = [assigned_clusters.get(d['job'], 'master') for d in j.get('depends_on', [])]
+
+        if candidates:
+            target_cluster = policy.place(j, candidates, parent_clusters)
+        elif cluster_selector:
+            raise InvalidJobsError('Could not find a cluster which could satisfy the selector: %s' %
+                                   json.dumps(cluster_selector))
+        else:
+            # no scheduler registered a cluster yet
+            target_cluster = 'master'
+
+        assigned_clusters[j['name']] = target_cluster
+        j['cluster']['name'] = target_cluster
+
+def insert_jobs(db, parent_job_id, parent_job_name, jobs):
+    """ Inserts the jobs created by a job, raises InvalidJobsError if they are invalid """
+    # Check if capabilities are set and allowed
+    if get_env('INFRABOX_JOB_SECURITY_CONTEXT_CAPABILITIES_ENABLED') != 'true':
+        for job in jobs:
+            sc = job.get('security_context', None)
+            if not sc:
+                continue
+
+            if sc.get('capabilities', None):
+                raise InvalidJobsError('Capabilities are disabled')
+
+    result = db.execute_one("SELECT env_var, build_id FROM job WHERE id = %s", [parent_job_id])
+    base_env_var = result[0]
+    build_id = result[1]
+
+    # Get some project info
+    result = db.execute_one("""
+        SELECT co.user_id, b.build_number, j.project_id FROM collaborator co
+        INNER JOIN job j
+            ON j.project_id = co.project_id
+            AND co.owner = true
+            AND j.id = %s
+        INNER JOIN build b
+            ON b.id = j.build_id
+    """, [parent_job_id])
+
+    build_number = result[1]
+    project_id = result[2]
+
+    # name->id mapping
+    jobname_id = {}
+    for job in jobs:
+        name = job["name"]
+        job_id = job['id']
+        jobname_id[name] = job_id
+
+    # average durations of the last builds
+    durations = db.execute_many("""
+        SELECT j.name, EXTRACT(EPOCH FROM avg(j.end_date - j.start_date))
+        FROM job j
+        INNER JOIN build b
+            ON b.id = j.build_id
+            AND j.project_id = %s
+            AND b.project_id = %s
+            AND b.build_number between %s and %s
+            AND j.name = ANY(%s)
+            AND j.state = 'finished'
+        GROUP BY j.name
+    """, [project_id, project_id, build_number - 10, build_number,
+          [job['name'] for job in jobs if job['type'] != "wait"]])
+    durations = dict((d[0], d[1]) for d in durations)
+
+    for job in jobs:
+        job['env_var_refs'] = None
+        job['env_vars'] = copy.deepcopy(base_env_var)
+
+        if job['type'] == "wait":
+            continue
+
+        job['avg_duration'] = durations.get(job['name'], None)
+
+        # Handle environment vars
+        if 'environment' in job:
+            for ename in job['environment']:
+                value = job['environment'][ename]
+
+                if isinstance(value, dict):
+                    env_var_ref_name = value['$secret']
+                    result = db.execute_many("""
+                                SELECT value FROM secret WHERE name = %s and project_id = %s
+                                """, [env_var_ref_name, project_id])
+
+                    if not result:
+                        raise InvalidJobsError("Secret '%s' not found" % env_var_ref_name)
+
+                    if not job['env_var_refs']:
+                        job['env_var_refs'] = {}
+
+                    job['env_var_refs'][ename] = env_var_ref_name
+                else:
+                    if not job['env_vars']:
+                        job['env_vars'] = {}
+
+                    job['env_vars'][ename] = value
+
+    compute_priorities(jobs, jobname_id)
+    jobs.sort(key=lambda k: k['priority'], reverse=True)
+
+    if parent_job_name != 'Create Jobs':
+        # depends_on refers to the names without the prefix
+        leaf_jobs = find_leaf_jobs(jobs)
+
+        # Update names, prefix with parent names
+        for j in jobs:
+            j['name'] = parent_job_name + '/' + j['name']
+
+        for j in leaf_jobs:
+            wait_job = {
+                'job': j['name'],
+                'job-id': j['id'],
+                'on': ['finished']
+            }
+
+            # Update direct children of this job to now wait for the leaf jobs
+            db.execute('''
+                UPDATE job
+                SET dependencies = dependencies || %s::jsonb
+                WHERE id IN (
+                    SELECT id parent_id
+                    FROM job, jsonb_array_elements(job.dependencies) as deps
+                    WHERE (deps->>'job-id')::uuid = %s
+                        AND build_id = %s
+                        AND project_id = %s
+                )
+            ''', [json.dumps(wait_job), parent_job_id, build_id, project_id])
+
+    if os.environ.get('INFRABOX_API_RIGHTSIZING_ENABLED', 'false') == 'true':
+        rightsize_jobs(db, project_id, jobs)
+
+    assign_cluster(db, jobs)
+
+    for job in jobs:
+        name = job["name"]
+
+        job_type = job["type"]
+        job_id = job['id']
+
+        build_only = job.get("build_only", True)
+        depends_on = job.get("depends_on", [])
+
+        if depends_on:
+            for dep in depends_on:
+                dep['job-id'] = jobname_id[dep['job']]
+        else:
+            depends_on = [{"job": parent_job_name, "job-id": parent_job_id, "on": ["finished"]}]
+
+        if job_type == "docker":
+            f = job['docker_file']
+            t = 'run_project_container'
+        elif job_type == "docker-image":
+            f = None
+            t = 'run_project_container'
+        elif job_type == "docker-compose":
+            f = job['docker_compose_file']
+            t = 'run_docker_compose'
+        elif job_type == "wait":
+            f = None
+            t = 'wait'
+        else:
+            raise InvalidJobsError("Unknown job type: %s" % job_type)
+
+        limits_cpu = 1
+        limits_memory = 1024
+        timeout = job.get('timeout', 3600)
+
+        if 'resources' in job and 'limits' in job['resources']:
+            limits_cpu = job['resources']['limits']['cpu']
+            limits_memory = job['resources']['limits']['memory']
+
+        # Create external git repo if necessary
+        repo = job.get('repo', None)
+        if repo:
+            repo['clone_all'] = False
+            repo = json.dumps(repo)
+
+        # Handle build arguments
+        build_arguments = None
+        if 'build_arguments' in job:
+            build_arguments = json.dumps(job['build_arguments'])
+
+        # Handle Deployments
+        deployments = None
+        if 'deployments' in job:
+            deployments = json.dumps(job['deployments'])
+
+        # Handle env vars
+        env_vars = None
+        if 'env_vars' in job:
+            env_vars = json.dumps(job['env_vars'])
+
+        # Handle env var refs
+        env_var_refs = None
+        if 'env_var_refs' in job:
+            env_var_refs = json.dumps(job['env_var_refs'])
+
+        # Handle resources
+        resources = None
+        if 'resources' in job:
+            resources = json.dumps(job['resources'])
+
+        if 'services' in job:
+            for s in job['services']:
+                if 'labels' not in s['metadata']:
+                    s['metadata']['labels'] = {}
+
+                s['metadata']['labels']['service.infrabox.net/id'] = str(uuid.uuid4())
+
+        # Create job
+        db.execute("""
+                     INSERT INTO job (id, state, build_id, type, dockerfile, name,
+                         project_id, dependencies, build_only,
+                         created_at, repo,
+                         env_var_ref, env_var, build_arg, deployment, cpu, memory,
+                         timeout, resources, definition, cluster_name, priority)
+                     VALUES (%s, 'queued', %s, %s, %s, %s, %s, %s, %s, %s, %s,
+                             %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+                     """, [job_id, build_id, t, f, name,
+                           project_id,
+                           json.dumps(depends_on), build_only, datetime.now(),
+                           repo, env_var_refs, env_vars,
+                           build_arguments, deployments, limits_cpu, limits_memory, timeout,
+                           resources, json.dumps(job), job['cluster']['name'], job['priority']])
+
+# where the jobs find the repository
+REPO_MOUNT_PATH = os.environ.get('INFRABOX_JOB_REPO_MOUNT_PATH', '/repo')
+
+MAX_DEFINITION_SIZE = 1024 * 1024
+
+# the others include more definitions or read files of the repository
+SIMPLE_JOB_TYPES = ('docker', 'docker-image', 'wait')
+
+def is_enabled():
+    return os.environ.get('INFRABOX_API_FAST_JOB_CREATION_ENABLED', 'false') == 'true'
+
+def get_github_definition(db, project_id, commit):
+    """ The infrabox.json of a github project at a commit """
+    r = db.execute_one('''
+        SELECT r.github_owner, r.name, u.github_api_token
+        FROM repository r
+        INNER JOIN collaborator co
+            ON co.project_id = r.project_id
+            AND co.owner = true
+        INNER JOIN "user" u
+            ON u.id = co.user_id
+        WHERE r.project_id = %s
+    ''', [project_id])
+
+    if not r or not r[2]:
+        return None
+
+    url = '%s/repos/%s/%s/contents/infrabox.json' % (os.environ['INFRABOX_GITHUB_API_URL'], r[0], r[1])
+    headers = {
+        "Authorization": "token " + r[2],
+        "User-Agent": "InfraBox",
+        "Accept": "application/vnd.github.v3.raw"
+    }
+
+    verify = os.environ.get('INFRABOX_GENERAL_DONT_CHECK_CERTIFICATES', 'false') != 'true'
+    result = requests.get(url, params={'ref': commit}, headers=headers, timeout=10, verify=verify)
+
+    if result.status_code != 200 or len(result.content) > MAX_DEFINITION_SIZE:
+        return None
+
+    return result.content
+
+def get_upload_definition(f):
+    """ The infrabox.json of an uploaded source archive """
+    try:
+        z = zipfile.ZipFile(f)
+        info = z.getinfo('infrabox.json')
+    except (KeyError, zipfile.BadZipfile):
+        return None
+
+    if info.file_size > MAX_DEFINITION_SIZE:
+        return None
+
+    return z.read(info)
+
+def get_job_list(data, repo):
+    """ The jobs of an infrabox.json as the "Create Jobs" job would create
+    them, None if they can't be created without the repository """
+    for job in data['jobs']:
+        if job['type'] not in SIMPLE_JOB_TYPES:
+            return None
+
+    rewrite_depends_on(data)
+
+    jobs = []
+    for job in data['jobs']:
+        job['id'] = str(uuid.uuid4())
+        job['avg_duration'] = 0
+        job['repo'] = copy.deepcopy(repo)
+        job['infrabox_context'] = REPO_MOUNT_PATH
+        jobs.append(job)
+
+    return jobs
+
+def create_jobs(db, job_id, definition, repo=None):
+    """ Creates the jobs of the "Create Jobs" job job_id from the build's
+    infrabox.json and finishes the job. Returns False if the job has to
+    create them itself. Doesn't commit. """
+    if definition is None:
+        return False
+
+    try:
+        data = json.loads(definition)
+        validate_json(data)
+    except Exception as e:
+        # the job reports it
+        logger.info('Invalid infrabox.json: %s', e)
+        return False
+
+    console = "Created the jobs from infrabox.json:\n%s\n" % json.dumps(data, indent=4)
+    jobs = get_job_list(data, repo)
+    if jobs is None:
+        return False
+
+    db.execute('SAVEPOINT create_jobs')
+
+    try:
+        if jobs:
+            insert_jobs(db, job_id, 'Create Jobs', jobs)
+    except Exception as e:
+        # e.g. a secret which doesn't exist, the job reports it
+        logger.info('Failed to create the jobs of %s: %s', job_id, e)
+        db.execute('ROLLBACK TO SAVEPOINT create_jobs')
+        return False
+
+    db.execute('RELEASE SAVEPOINT create_jobs')
+
+    db.execute('''
+        UPDATE job
+        SET state = 'finished', start_date = now(), end_date = now(), console = %s
+        WHERE id = %s
+    ''', [console, job_id])
+
+    return True
+
+def fetch_github_definition(db, project_id, commit):
+    """ The infrabox.json for create_jobs of a build of a github project,
+    None if the job has to create the jobs itself. Call it before writing
+    anything, github may take a while to answer. """
+    if not is_enabled():
+        return None
+
+    try:
+        return get_github_definition(db, project_id, commit)
+    except Exception as e:
+        logger.warn('Failed to get infrabox.json from github: %s', e)
+        return None
+
+def create_upload_jobs(db, job_id, f):
+    """ create_jobs for a build of an uploaded source archive """
+    if not is_enabled():
+        return False
+
+    f.seek(0)
+    return create_jobs(db, job_id, get_upload_definition(f))
@@ -0,0 +1,93 @@
+""" Placement of jobs on clusters.
+
+A policy gets all clusters together with their current load and picks
+one for each job out of the clusters matching the job's selector. """
+
+# bonus for a cluster which already runs the job's parents,
+# their outputs don't have to be forwarded to another cluster then
+LOCALITY_BONUS = 0.25
+
+def matches_selector(cluster, selector):
+    for s in selector or []:
+        if s not in cluster['labels']:
+            return False
+
+    return True
+
+class FirstMatchPlacement(object):
+    """ First cluster matching the selector. Without selector the
+    cluster of the first parent or master. """
+
+    def __init__(self, clusters):
+        self.clusters = clusters
+
+    def place(self, job, candidates, parent_clusters):
+        if job['cluster'].get('selector', None):
+            return candidates[0]['name']
+
+        if parent_clusters:
+            return parent_clusters[0]
+
+        return 'master'
+
+class LoadAwarePlacement(object):
+    """ Active cluster with the most room left after its scheduled,
+    running and queued jobs, preferring the clusters of the parents. """
+
+    def __init__(self, clusters):
+        self.clusters = clusters
+
+        # jobs placed by us, not yet in the database
+        self.placed = dict((c['name'], {'cpu': 0, 'memory': 0}) for c in clusters)
+
+    def utilization(self, cluster, cpu, memory):
+        """ Share of the cluster in use once the job is added """
+        placed = self.placed[cluster['name']]
+        cpu += cluster['cpu'] + placed['cpu']
+        memory += cluster['memory'] + placed['memory']
+
+        u = 1.0
+        if cluster['cpu_capacity']:
+            u = float(cpu) / cluster['cpu_capacity']
+
+        if cluster['memory_capacity']:
+            # memory_capacity is in Ki, jobs request Mi
+            u = max(u, float(memory) * 1024 / cluster['memory_capacity'])
+
+        return u
+
+    def score(self, cluster, cpu, memory, parent_clusters):
+        score = 1.0 - self.utilization(cluster, cpu, memory)
+
+        if parent_clusters:
+            local = len([p for p in parent_clusters if p == cluster['name']])
+            score += LOCALITY_BONUS * local / len(parent_clusters)
+
+        return score
+
+    def place(self, job, candidates, parent_clusters):
+        active = [c for c in candidates if c['active']] or candidates
+
+        limits = (job.get('resources') or {}).get('limits') or {}
+        cpu = limits.get('cpu', 1)
+        memory = limits.get('memory', 1024)
+
+        # ties go to master, then by name to keep it stable
+        active = sorted(active, key=lambda c: (c['name'] != 'master', c['name']))
+        best = max(active, key=lambda c: self.score(c, cpu, memory, parent_clusters))
+
+        self.placed[best['name']]['cpu'] += cpu
+        self.placed[best['name']]['memory'] += memory
+
+        return best['name']
+
+POLICIES = {
+    'first': FirstMatchPlacement,
+    'load': LoadAwarePlacement
+}
+
+def get_placement_policy(name, clusters):
+    if name not in POLICIES:
+        raise Exception('Unknown cluster placement policy: %s' % name)
+
+    return POLICIES[name](clusters)
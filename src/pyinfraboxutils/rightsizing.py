@@ -0,0 +1,96 @@
+""" Resource recommendations from the stats the jobs collect.
+
+Every job posts cpu (in percent of one core) and memory (in MiB) samples
+of all its containers. The samples of the last finished runs of a job
+are aggregated to peak and p95 usage, from which a recommendation for
+the job's cpu and memory is derived. """
+
+import math
+import os
+
+# finished runs of a job which are looked at
+HISTORY = 10
+
+# no recommendation with fewer runs
+MIN_JOBS = 3
+
+def get_usage(db, project_id, names=None):
+    """ Peak and p95 usage of the jobs of a project, cpu in cores """
+    return db.execute_many_dict('''
+        WITH recent AS (
+            SELECT id, name, cpu, memory, stats, r FROM (
+                SELECT j.id, j.name, j.cpu, j.memory, j.stats,
+                       ROW_NUMBER() OVER (PARTITION BY j.name ORDER BY j.end_date DESC) r
+                FROM job j
+                WHERE j.project_id = %s
+                    AND j.state = 'finished'
+                    AND j.stats IS NOT NULL
+                    AND (%s::text[] IS NULL OR j.name = ANY(%s::text[]))
+            ) jobs
+            WHERE r <= %s
+        ), samples AS (
+            -- all containers of a job at the same time
+            SELECT r.id, r.name, SUM((s->>'cpu')::float) / 100 cpu, SUM((s->>'mem')::float) mem
+            FROM recent r
+            CROSS JOIN jsonb_each(r.stats::jsonb) c
+            CROSS JOIN jsonb_array_elements(c.value) s
+            GROUP BY r.id, r.name, s->>'date'
+        )
+        SELECT s.name,
+               COUNT(DISTINCT s.id) jobs,
+               MAX(l.cpu) requested_cpu,
+               MAX(l.memory) requested_memory,
+               MAX(s.cpu) cpu_peak,
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY s.cpu) cpu_p95,
+               MAX(s.mem) memory_peak,
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY s.mem) memory_p95
+        FROM samples s
+        INNER JOIN recent l
+            ON l.name = s.name
+            AND l.r = 1
+        GROUP BY s.name
+    ''', [project_id, names, names, HISTORY])
+
+def recommend(usage, headroom, min_memory):
+    """ cpu by the p95 usage, a bit of throttling is fine.
+    memory by the peak usage, running out of it kills the job. """
+    if usage['jobs'] < MIN_JOBS:
+        return None
+
+    cpu = int(math.ceil(usage['cpu_p95'] * headroom))
+    memory = int(math.ceil(usage['memory_peak'] * headroom / 64) * 64)
+
+    return {
+        'cpu': max(cpu, 1),
+        'memory': max(memory, min_memory)
+    }
+
+def get_recommendations(db, project_id, names=None):
+    headroom = float(os.environ.get('INFRABOX_API_RIGHTSIZING_HEADROOM', 1.5))
+    min_memory = int(os.environ.get('INFRABOX_API_RIGHTSIZING_MIN_MEMORY', 512))
+
+    result = []
+    for u in get_usage(db, project_id, names):
+        u['recommendation'] = recommend(u, headroom, min_memory)
+        result.append(u)
+
+    return result
+
+def rightsize_jobs(db, project_id, jobs):
+    """ Lowers the requested resources of the jobs to the recommendation,
+    never raises them above what the job definition asks for. """
+    names = [j['name'] for j in jobs if j['type'] != 'wait']
+    if not names:
+        return
+
+    recommendations = dict((r['name'], r['recommendation'])
+                           for r in get_recommendations(db, project_id, names))
+
+    for j in jobs:
+        r = recommendations.get(j['name'], None)
+        if not r:
+            continue
+
+        limits = j.setdefault('resources', {}).setdefault('limits', {'cpu': 1, 'memory': 1024})
+        limits['cpu'] = min(limits['cpu'], r['cpu'])
+        limits['memory'] = min(limits['memory'], r['memory'])
@@ -0,0 +1,55 @@
+from pyinfraboxutils import get_logger
+
+logger = get_logger('infrabox')
+
+def abort_superseded_builds(conn, project_id, build_id, branch=None, pull_request_id=None, change_url=None):
+    """ Aborts the unfinished jobs of older builds of the same pull request,
+    gerrit change or branch, if the project has cancel_superseded_builds set.
+    The older builds are marked as superseded by build_id. """
+    if pull_request_id:
+        condition = 'c.pull_request_id = %s'
+        value = pull_request_id
+    elif change_url:
+        condition = 'c.url = %s'
+        value = change_url
+    elif branch:
+        condition = 'c.branch = %s AND c.pull_request_id IS NULL AND c.tag IS NULL'
+        value = branch
+    else:
+        return []
+
+    cursor = conn.cursor()
+    cursor.execute('''
+        WITH superseded AS (
+            UPDATE build b
+            SET superseded_by = %s
+            FROM "commit" c, project p, build new
+            WHERE b.project_id = %s
+            AND p.id = b.project_id
+            AND p.cancel_superseded_builds
+            AND new.id = %s
+            AND b.build_number < new.build_number
+            AND b.superseded_by IS NULL
+            AND c.id = b.commit_id
+            AND c.project_id = b.project_id
+            AND ''' + condition + '''
+            AND EXISTS (
+                SELECT 1 FROM job j
+                WHERE j.build_id = b.id
+                AND j.state IN ('queued', 'scheduled', 'running')
+            )
+            RETURNING b.id
+        )
+        INSERT INTO abort (job_id)
+        SELECT j.id FROM job j
+        WHERE j.build_id IN (SELECT id FROM superseded)
+        AND j.state IN ('queued', 'scheduled', 'running')
+        RETURNING job_id
+    ''', [build_id, project_id, build_id, value])
+    aborted = cursor.fetchall()
+    cursor.close()
+
+    if aborted:
+        logger.info('Build %s superseded older builds, aborting %s jobs', build_id, len(aborted))
+
+    return [r[0] for r in aborted]
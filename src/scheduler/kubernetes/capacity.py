@@ -0,0 +1,101 @@
+def parse_cpu(q):
+    """ Converts a kubernetes cpu quantity (e.g. '4' or '3920m') to cores """
+    q = str(q)
+    if q.endswith('m'):
+        return float(q[:-1]) / 1000
+
+    return float(q)
+
+MEMORY_SUFFIXES = (
+    ('Ki', 1024),
+    ('Mi', 1024 ** 2),
+    ('Gi', 1024 ** 3),
+    ('Ti', 1024 ** 4),
+    ('k', 1000),
+    ('M', 1000 ** 2),
+    ('G', 1000 ** 3),
+    ('T', 1000 ** 4),
+)
+
+def parse_memory(q):
+    """ Converts a kubernetes memory quantity (e.g. '16424684Ki') to MiB """
+    q = str(q)
+    for suffix, factor in MEMORY_SUFFIXES:
+        if q.endswith(suffix):
+            return float(q[:-len(suffix)]) * factor / 1024 / 1024
+
+    return float(q) / 1024 / 1024
+
+class Node(object):
+    def __init__(self, name, cpu, memory):
+        self.name = name
+        self.cpu = cpu
+        self.memory = memory
+        self.free_cpu = cpu
+        self.free_memory = memory
+
+    def fits(self, cpu, memory):
+        return self.free_cpu >= cpu and self.free_memory >= memory
+
+    def waste(self, cpu, memory):
+        # fraction of the node left unused if the job was placed on it
+        return (self.free_cpu - cpu) / self.cpu + (self.free_memory - memory) / self.memory
+
+    def reserve(self, cpu, memory):
+        self.free_cpu -= cpu
+        self.free_memory -= memory
+
+class CapacityModel(object):
+    """ Tracks the allocatable resources of the cluster minus the
+    requests of all scheduled and running jobs and places jobs on
+    nodes with a best-fit policy. """
+
+    def __init__(self, nodes, overcommit_ratio=1.0):
+        self.nodes = []
+
+        for n in nodes:
+            self.nodes.append(Node(n['name'],
+                                   n['cpu'] * overcommit_ratio,
+                                   n['memory'] * overcommit_ratio))
+
+    def best_fit(self, cpu, memory):
+        best = None
+        for n in self.nodes:
+            if not n.fits(cpu, memory):
+                continue
+
+            if not best or n.waste(cpu, memory) < best.waste(cpu, memory):
+                best = n
+
+        return best
+
+    def fits_any_node(self, cpu, memory):
+        for n in self.nodes:
+            if n.cpu >= cpu and n.memory >= memory:
+                return True
+
+        return False
+
+    def add_running(self, jobs):
+        """ Accounts for the (cpu, memory) requests of jobs already on the cluster.
+        We don't know on which node they are, so they are packed the same way. """
+        for cpu, memory in sorted(jobs, reverse=True):
+            node = self.best_fit(cpu, memory)
+
+            if not node:
+                if not self.nodes:
+                    return
+
+                node = max(self.nodes, key=lambda n: n.free_cpu)
+
+            node.reserve(cpu, memory)
+
+    def admit(self, cpu, memory):
+        """ Reserves room for the job, returns False if it has to wait """
+        node = self.best_fit(cpu, memory)
+
+        if not node:
+            return False
+
+        node.reserve(cpu, memory)
+        return True
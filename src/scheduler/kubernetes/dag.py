@@ -0,0 +1,104 @@
+from collections import OrderedDict
+
+# A job can only be decided once none of its parents is in one of these states
+PENDING_STATES = ('running', 'scheduled', 'queued')
+
+class BuildGraph(object):
+    """ In-memory dependency graph of the queued jobs of one build """
+
+    def __init__(self, build_id):
+        self.build_id = build_id
+        self.jobs = OrderedDict()
+        self.states = {}
+        self.parents = {}
+        self.children = {}
+        self.conditions = {}
+
+    def add_job(self, job, parents):
+        """ Adds a queued job together with the (id, state) pairs of its parents """
+        job_id = job['id']
+        self.jobs[job_id] = job
+        self.states[job_id] = 'queued'
+        self.parents[job_id] = []
+        self.conditions[job_id] = {}
+
+        for dep in job['dependencies'] or []:
+            self.conditions[job_id][dep['job-id']] = set(dep['on'])
+
+        for parent_id, parent_state in parents:
+            self.parents[job_id].append(parent_id)
+            self.children.setdefault(parent_id, []).append(job_id)
+
+            # queued parents of this build are tracked as part of the graph
+            if parent_id not in self.jobs:
+                self.states[parent_id] = parent_state
+
+    def decide(self, job_id):
+        """ Returns 'wait', 'skip', 'finish' or 'schedule' for a queued job """
+        for parent_id in self.parents[job_id]:
+            if self.states[parent_id] in PENDING_STATES:
+                return 'wait'
+
+        for parent_id in self.parents[job_id]:
+            if self.states[parent_id] not in self.conditions[job_id].get(parent_id, ()):
+                return 'skip'
+
+        if self.jobs[job_id]['type'] == 'wait':
+            return 'finish'
+
+        return 'schedule'
+
+    def resolve(self):
+        """ Decides all jobs of the build at once.
+
+        Skipped jobs and finished wait jobs change the state of their
+        parent within the graph, so their queued children get decided
+        in the same pass instead of waiting for the next one.
+        """
+        to_schedule = []
+        to_skip = []
+        to_finish = []
+
+        pending = list(self.jobs.keys())
+        while pending:
+            job_id = pending.pop(0)
+
+            if self.states[job_id] != 'queued':
+                continue
+
+            decision = self.decide(job_id)
+
+            if decision == 'wait':
+                continue
+            elif decision == 'schedule':
+                # stays queued in the graph, children have to wait for it anyway
+                self.states[job_id] = 'scheduled'
+                to_schedule.append(self.jobs[job_id])
+                continue
+            elif decision == 'skip':
+                self.states[job_id] = 'skipped'
+                to_skip.append(job_id)
+            else:
+                self.states[job_id] = 'finished'
+                to_finish.append(job_id)
+
+            for child_id in self.children.get(job_id, []):
+                if child_id in self.jobs:
+                    pending.append(child_id)
+
+        return to_schedule, to_skip, to_finish
+
+def build_graphs(jobs):
+    """ Groups the queued jobs by build. Each job must contain a 'parents'
+    list of (id, state) pairs. """
+    graphs = OrderedDict()
+
+    for j in jobs:
+        build_id = j['build_id']
+
+        if build_id not in graphs:
+            graphs[build_id] = BuildGraph(build_id)
+
+        graphs[build_id].add_job(j, j['parents'])
+
+    return graphs
@@ -0,0 +1,80 @@
+class FairShare(object):
+    """ Orders the jobs of different projects by how much of the cluster
+    each project already uses relative to its weight (deficit based),
+    and enforces the optional per project quotas. """
+
+    def __init__(self, projects, usage):
+        # projects: id -> {'weight', 'quota_cpu', 'quota_memory', 'quota_jobs'}
+        # usage: id -> {'cpu', 'memory', 'jobs'} of the scheduled and running jobs
+        self.projects = projects
+        self.usage = usage
+
+    def get_usage(self, project_id):
+        if project_id not in self.usage:
+            self.usage[project_id] = {'cpu': 0, 'memory': 0, 'jobs': 0}
+
+        return self.usage[project_id]
+
+    def share(self, project_id):
+        weight = self.projects.get(project_id, {}).get('weight', 1) or 1
+        u = self.get_usage(project_id)
+        return (float(u['cpu']) / weight, float(u['jobs']) / weight)
+
+    def exceeds_quota(self, job):
+        """ Whether the job alone needs more than its project's quota,
+        it could never be admitted """
+        p = self.projects.get(job['project_id'], None)
+
+        if not p:
+            return False
+
+        if p['quota_cpu'] is not None and job['cpu'] > p['quota_cpu']:
+            return True
+
+        if p['quota_memory'] is not None and job['memory'] > p['quota_memory']:
+            return True
+
+        if p['quota_jobs'] is not None and p['quota_jobs'] < 1:
+            return True
+
+        return False
+
+    def within_quota(self, job):
+        p = self.projects.get(job['project_id'], None)
+
+        if not p:
+            return True
+
+        u = self.get_usage(job['project_id'])
+
+        if p['quota_cpu'] is not None and u['cpu'] + job['cpu'] > p['quota_cpu']:
+            return False
+
+        if p['quota_memory'] is not None and u['memory'] + job['memory'] > p['quota_memory']:
+            return False
+
+        if p['quota_jobs'] is not None and u['jobs'] + 1 > p['quota_jobs']:
+            return False
+
+        return True
+
+    def add(self, job):
+        u = self.get_usage(job['project_id'])
+        u['cpu'] += job['cpu']
+        u['memory'] += job['memory']
+        u['jobs'] += 1
+
+    def order(self, jobs):
+        """ Yields the jobs, always the next one of the project with the
+        lowest share. The order within a project is kept. Call add() for
+        every admitted job so the shares are up to date. """
+        queues = {}
+        for j in jobs:
+            queues.setdefault(j['project_id'], []).append(j)
+
+        while queues:
+            project_id = min(queues, key=self.share)
+            yield queues[project_id].pop(0)
+
+            if not queues[project_id]:
+                del queues[project_id]
@@ -0,0 +1,126 @@
+import json
+import threading
+import time
+
+class Informer(object):
+    """ Keeps a local cache of kubernetes objects: one initial list,
+    then a watch from the list's resourceVersion. The names of objects
+    which changed since the last call are returned by pop_changed(). """
+
+    def __init__(self, kube, path, logger, label_selector=None, watch_timeout=300):
+        self.kube = kube
+        self.path = path
+        self.logger = logger
+        self.label_selector = label_selector
+        self.watch_timeout = watch_timeout
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.changed = set()
+        self.resource_version = None
+        self.synced = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                if not self.resource_version:
+                    self.list()
+
+                self.watch()
+            except Exception as e:
+                self.logger.exception(e)
+                time.sleep(1)
+
+    def get_params(self):
+        p = {}
+        if self.label_selector:
+            p['labelSelector'] = self.label_selector
+
+        return p
+
+    def list(self):
+        r = self.kube.get(self.path, params=self.get_params(), timeout=30)
+
+        if r.status_code != 200:
+            raise Exception('Failed to list %s: %s' % (self.path, r.text))
+
+        data = r.json()
+        items = {}
+        for i in data.get('items', []):
+            items[i['metadata']['name']] = i
+
+        with self.lock:
+            # everything which appeared, disappeared or changed while we were not watching
+            for name in set(items.keys()) | set(self.cache.keys()):
+                old = self.cache.get(name, None)
+                new = items.get(name, None)
+
+                if not old or not new or \
+                   old['metadata']['resourceVersion'] != new['metadata']['resourceVersion']:
+                    self.changed.add(name)
+
+            self.cache = items
+            self.resource_version = data['metadata']['resourceVersion']
+            self.synced = True
+
+    def watch(self):
+        p = self.get_params()
+        p['watch'] = 'true'
+        p['resourceVersion'] = self.resource_version
+        p['timeoutSeconds'] = self.watch_timeout
+
+        r = self.kube.get(self.path, params=p, stream=True, timeout=(10, self.watch_timeout + 30))
+
+        if r.status_code != 200:
+            self.resource_version = None
+            raise Exception('Failed to watch %s: %s' % (self.path, r.text))
+
+        # watches are sent chunked, chunk_size=None hands out every
+        # chunk right away instead of waiting for a full buffer
+        for line in r.iter_lines(chunk_size=None):
+            if not line:
+                continue
+
+            event = json.loads(line)
+
+            if event['type'] == 'ERROR':
+                # most likely our resourceVersion is too old, start over
+                self.logger.info('Watch of %s expired: %s', self.path, event['object'].get('message', None))
+                self.resource_version = None
+                return
+
+            obj = event['object']
+            name = obj['metadata']['name']
+
+            with self.lock:
+                if event['type'] == 'DELETED':
+                    self.cache.pop(name, None)
+                else:
+                    self.cache[name] = obj
+
+                self.changed.add(name)
+                self.resource_version = obj['metadata']['resourceVersion']
+
+    def has_synced(self):
+        return self.synced
+
+    def items(self):
+        with self.lock:
+            return list(self.cache.values())
+
+    def find(self, fn):
+        with self.lock:
+            return [o for o in self.cache.values() if fn(o)]
+
+    def pop_changed(self):
+        """ Returns the cached objects which changed since the last call,
+        deleted objects are not returned. """
+        with self.lock:
+            changed = self.changed
+            self.changed = set()
+            return [self.cache[n] for n in changed if n in self.cache]
@@ -0,0 +1,88 @@
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+ID_PATTERN = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+class KubeClient(object):
+    """ Kubernetes API client shared by the scheduler. It keeps the
+    connections alive, retries idempotent requests on connection errors
+    and 5xx responses and runs calls concurrently on a bounded pool. """
+
+    def __init__(self, api_server, token, logger, workers=10, retries=3, backoff=0.2):
+        self.api_server = api_server
+        self.token = token
+        self.logger = logger
+
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=(500, 502, 503, 504))
+
+        # one connection per worker, the informer watches and the main thread
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers + 4, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': 'Bearer %s' % token})
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.metrics_lock = threading.Lock()
+        self.metrics = {}
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', 10)
+
+        start = time.time()
+        try:
+            return self.session.request(method, self.api_server + path, **kwargs)
+        finally:
+            self.record(method, path, time.time() - start)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request('PATCH', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def submit(self, fn, *args):
+        """ Runs fn on the worker pool, returns a future """
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self._log_exception)
+        return future
+
+    def _log_exception(self, future):
+        e = future.exception()
+        if e:
+            self.logger.error('Kubernetes call failed: %s', e)
+
+    def record(self, method, path, duration):
+        key = '%s %s' % (method, ID_PATTERN.sub('{id}', path))
+
+        with self.metrics_lock:
+            m = self.metrics.setdefault(key, {'count': 0, 'total': 0.0, 'max': 0.0})
+            m['count'] += 1
+            m['total'] += duration
+            m['max'] = max(m['max'], duration)
+
+    def pop_metrics(self):
+        with self.metrics_lock:
+            metrics = self.metrics
+            self.metrics = {}
+
+        return metrics
+
+    def log_metrics(self):
+        for key, m in sorted(self.pop_metrics().items()):
+            self.logger.info('%s: %s calls, avg %.3fs, max %.3fs',
+                             key, m['count'], m['total'] / m['count'], m['max'])
@@ -0,0 +1,340 @@
+import threading
+import time
+import uuid
+import collections
+import calendar
+
+ROLE = {
+    'kind': 'Role',
+    'apiVersion': 'rbac.authorization.k8s.io/v1beta1',
+    'metadata': {
+        'name': 'infrabox'
+    },
+    'rules': [{
+        'apiGroups': ['', 'extensions', 'apps', 'batch'],
+        'resources': ['*'],
+        'verbs': ['*']
+    }, {
+        'apiGroups': ['rbac.authorization.k8s.io'],
+        'resources': ['roles', 'rolebindings'],
+        'verbs': ['*']
+    }, {
+        'apiGroups': ['policy'],
+        'resources': ['poddisruptionbudgets'],
+        'verbs': ['*']
+    }]
+}
+
+# when a job claimed the namespace, for the size of the pool
+CLAIMED_AT = 'infrabox.net/claimed-at'
+
+def create_namespace(kube, namespace_name, labels, logger):
+    """ Creates the namespace together with the Role and RoleBindings
+    for its default service account. Returns False on failure, the
+    namespace is deleted again if it has been created. """
+    ns = {
+        "apiVersion": "v1",
+        "kind": "Namespace",
+        "metadata": {
+            "name": namespace_name,
+            "labels": labels
+        }
+    }
+
+    r = kube.post('/api/v1/namespaces', json=ns)
+
+    if r.status_code != 201:
+        logger.warn("Failed to create Namespace: %s", r.text)
+        return False
+
+    if not create_rbac(kube, namespace_name, logger):
+        delete_namespace(kube, namespace_name)
+        return False
+
+    return True
+
+def delete_namespace(kube, namespace_name):
+    p = {"gracePeriodSeconds": 0}
+    kube.delete('/api/v1/namespaces/%s' % namespace_name, params=p)
+
+def create_rbac(kube, namespace_name, logger):
+    role = dict(ROLE)
+    role['metadata'] = {'name': 'infrabox', 'namespace': namespace_name}
+
+    r = kube.post('/apis/rbac.authorization.k8s.io/v1beta1/namespaces/%s/roles' % namespace_name,
+                  json=role)
+
+    if r.status_code != 201:
+        logger.warn("Failed to create Role: %s", r.text)
+        return False
+
+    rb = {
+        "kind": "RoleBinding",
+        "apiVersion": "rbac.authorization.k8s.io/v1beta1",
+        "metadata": {
+            "name": namespace_name
+        },
+        "subjects": [{
+            "kind": "ServiceAccount",
+            "name": "default",
+            "namespace": namespace_name
+        }],
+        "roleRef": {
+            "kind": "Role",
+            "name": "infrabox",
+            "apiGroup": "rbac.authorization.k8s.io"
+        }
+    }
+
+    r = kube.post('/apis/rbac.authorization.k8s.io/v1beta1/namespaces/%s/rolebindings' % namespace_name,
+                  json=rb)
+
+    if r.status_code != 201:
+        logger.warn("Failed to create RoleBinding: %s", r.text)
+        return False
+
+    rb = {
+        "kind": "RoleBinding",
+        "apiVersion": "rbac.authorization.k8s.io/v1beta1",
+        "metadata": {
+            "name": namespace_name + '-discovery'
+        },
+        "subjects": [{
+            "kind": "ServiceAccount",
+            "name": "default",
+            "namespace": namespace_name
+        }],
+        "roleRef": {
+            "kind": "ClusterRole",
+            "name": "system:discover",
+            "apiGroup": "rbac.authorization.k8s.io"
+        }
+    }
+
+    r = kube.post('/apis/rbac.authorization.k8s.io/v1beta1/namespaces/%s/rolebindings' % namespace_name,
+                  json=rb)
+
+    if r.status_code != 201:
+        logger.warn("Failed to create RoleBinding for discovery: %s", r.text)
+        return False
+
+    return True
+
+def parse_timestamp(t):
+    return calendar.timegm(time.strptime(t, '%Y-%m-%dT%H:%M:%SZ'))
+
+def get_service_account_secret(kube, namespace_name):
+    """ Returns the token secret of the default service account or None
+    if the token controller did not create it yet. """
+    r = kube.get('/api/v1/namespaces/%s/secrets' % namespace_name, timeout=5)
+
+    if r.status_code != 200:
+        return None
+
+    for secret in r.json().get('items', []):
+        if secret.get('type', None) == 'kubernetes.io/service-account-token':
+            return secret
+
+    return None
+
+def get_secret_env(kube, secret):
+    return [
+        {"name": "INFRABOX_RESOURCES_KUBERNETES_CA_CRT", "value": secret['data']['ca.crt']},
+        {"name": "INFRABOX_RESOURCES_KUBERNETES_TOKEN", "value":  secret['data']['token']},
+        {"name": "INFRABOX_RESOURCES_KUBERNETES_NAMESPACE", "value": secret['data']['namespace']},
+        {"name": "INFRABOX_RESOURCES_KUBERNETES_MASTER_URL", "value": kube.api_server}
+    ]
+
+class NamespacePool(object):
+    """ Keeps a number of namespaces with RBAC already in place, so jobs
+    requesting kubernetes resources don't have to wait for the setup.
+
+    Free namespaces are labeled with infrabox-pool=free, a job claims one
+    by labeling it with its id. The pool is refilled by a background
+    thread, its size follows the number of jobs which got a namespace in
+    the last minutes. With several scheduler replicas all of them claim
+    namespaces, only the one for which can_refill is true adds them.
+    A namespace is labeled infrabox-pool=pending until its RBAC is in
+    place. Claimed namespaces are never put back, their jobs had the
+    token of the service account.
+    """
+
+    def __init__(self, kube, logger, max_size, interval=5, demand_window=600, pending_timeout=300,
+                 can_refill=lambda: True):
+        self.kube = kube
+        self.logger = logger
+        self.max_size = max_size
+        self.interval = interval
+        self.demand_window = demand_window
+        self.pending_timeout = pending_timeout
+        self.can_refill = can_refill
+        self.lock = threading.Lock()
+        self.free = collections.OrderedDict()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.refill()
+            except Exception as e:
+                self.logger.exception(e)
+
+            time.sleep(self.interval)
+
+    def target_size(self):
+        """ Counts the namespaces of jobs which were claimed from the pool,
+        or created because it was empty, in the last minutes """
+        r = self.kube.get('/api/v1/namespaces', params={'labelSelector': 'infrabox-job-id'})
+
+        if r.status_code != 200:
+            return 0
+
+        deadline = time.time() - self.demand_window
+        demand = 0
+
+        for n in r.json().get('items', []):
+            metadata = n['metadata']
+            claimed_at = metadata.get('annotations', {}).get(CLAIMED_AT, None)
+
+            if claimed_at:
+                t = float(claimed_at)
+            else:
+                t = parse_timestamp(metadata['creationTimestamp'])
+
+            if t > deadline:
+                demand += 1
+
+        return min(self.max_size, max(1, demand))
+
+    def list_pool(self, state):
+        """ The active namespaces of the pool with the given state """
+        r = self.kube.get('/api/v1/namespaces', params={'labelSelector': 'infrabox-pool=%s' % state})
+
+        if r.status_code != 200:
+            return None
+
+        return [n for n in r.json().get('items', [])
+                if n['status'].get('phase', 'Active') == 'Active']
+
+    def list_free(self):
+        namespaces = self.list_pool('free')
+
+        if namespaces is None:
+            return None
+
+        return {n['metadata']['name']: n['metadata']['resourceVersion'] for n in namespaces}
+
+    def delete_stale_pending(self):
+        """ Deletes the namespaces whose setup has been interrupted,
+        e.g. by a restart of the scheduler """
+        namespaces = self.list_pool('pending')
+
+        if not namespaces:
+            return
+
+        deadline = time.time() - self.pending_timeout
+
+        for n in namespaces:
+            if parse_timestamp(n['metadata']['creationTimestamp']) < deadline:
+                self.logger.info('Deleting pending namespace %s', n['metadata']['name'])
+                delete_namespace(self.kube, n['metadata']['name'])
+
+    def add(self, name):
+        """ Creates a namespace and only then marks it free """
+        labels = {
+            "infrabox-resource": "kubernetes",
+            "infrabox-pool": "pending"
+        }
+
+        if not create_namespace(self.kube, name, labels, self.logger):
+            return False
+
+        h = {'Content-Type': 'application/merge-patch+json'}
+        patch = {'metadata': {'labels': {'infrabox-pool': 'free'}}}
+
+        r = self.kube.patch('/api/v1/namespaces/%s' % name, headers=h, json=patch)
+
+        if r.status_code != 200:
+            self.logger.warn('Failed to add namespace %s to the pool: %s', name, r.text)
+            delete_namespace(self.kube, name)
+            return False
+
+        return True
+
+    def refill(self):
+        free = self.list_free()
+
+        if free is None:
+            return
+
+        # sync with the cluster, namespaces may have been claimed by someone else
+        with self.lock:
+            for name in list(self.free.keys()):
+                if name not in free:
+                    del self.free[name]
+
+            for name, resource_version in free.items():
+                if name not in self.free:
+                    self.free[name] = {'name': name, 'secret': None}
+
+                self.free[name]['resource_version'] = resource_version
+
+            missing_secret = [n for n in self.free.values() if not n['secret']]
+            size = len(self.free)
+
+        for n in missing_secret:
+            n['secret'] = get_service_account_secret(self.kube, n['name'])
+
+        if not self.can_refill():
+            return
+
+        self.delete_stale_pending()
+
+        for _ in range(size, self.target_size()):
+            name = 'ib-%s' % uuid.uuid4()
+
+            self.logger.info('Adding namespace %s to the pool', name)
+            if not self.add(name):
+                return
+
+    def claim(self, job_id):
+        """ Labels a free namespace with the job id and returns the
+        environment for the job, None if no namespace is ready. """
+        while True:
+            with self.lock:
+                ready = [n for n in self.free.values() if n['secret']]
+
+                if not ready:
+                    return None
+
+                n = ready[0]
+                del self.free[n['name']]
+
+            h = {'Content-Type': 'application/merge-patch+json'}
+
+            # the resourceVersion makes sure nobody else claimed it in between
+            patch = {
+                'metadata': {
+                    'resourceVersion': n['resource_version'],
+                    'labels': {
+                        'infrabox-pool': 'claimed',
+                        'infrabox-job-id': job_id
+                    },
+                    'annotations': {
+                        CLAIMED_AT: str(time.time())
+                    }
+                }
+            }
+
+            r = self.kube.patch('/api/v1/namespaces/%s' % n['name'], headers=h, json=patch)
+
+            if r.status_code == 200:
+                self.logger.info('Claimed namespace %s for job %s', n['name'], job_id)
+                return get_secret_env(self.kube, n['secret'])
+
+            self.logger.info('Failed to claim namespace %s: %s', n['name'], r.text)
@@ -2,13 +2,26 @@ import logging
 import argparse
 import time
 import os
-import requests
+import json
+import select
+import uuid
+import socket
 import psycopg2
 import psycopg2.extensions
 
+from concurrent.futures import wait
+
 from pyinfraboxutils import get_logger, get_env, print_stackdriver
 from pyinfraboxutils.db import connect_db
 
+from dag import build_graphs
+from capacity import CapacityModel, parse_cpu, parse_memory
+from fairshare import FairShare
+from informer import Informer
+from kube import KubeClient
+from shard import ShardManager
+from namespace import NamespacePool, create_namespace, get_service_account_secret, get_secret_env
+
 def gerrit_enabled():
     return os.environ['INFRABOX_GERRIT_ENABLED'] == 'true'
 
@@ -18,7 +31,16 @@ def use_host_docker_daemon():
 class Scheduler(object):
     def __init__(self, conn, args):
         self.conn = conn
+        self.listen_conn = None
+        self.shards = None
         self.args = args
+        self.nodes = []
+        self.waiting_for_capacity = False
+        self.namespace_pool = None
+
+        # dead jobs are only detected once heartbeats arrived for a whole timeout,
+        # after a start or after an outage of the api the jobs must get the time to report
+        self.heartbeats_since = time.time()
         self.namespace = get_env("INFRABOX_GENERAL_WORKER_NAMESPACE")
         self.logger = get_logger("scheduler")
 
@@ -29,25 +51,31 @@ class Scheduler(object):
         else:
             self.logger.setLevel(logging.INFO)
 
+        self.kube = KubeClient(self.args.api_server, self.args.token, self.logger,
+                               workers=self.args.kubernetes_workers,
+                               retries=self.args.kubernetes_retries)
 
-    def kube_delete_namespace(self, job_id):
-        h = {'Authorization': 'Bearer %s' % self.args.token}
-        namespace_name = "ib-%s" % job_id
+        self.job_informer = Informer(self.kube,
+                                     '/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibjobs' % self.namespace,
+                                     self.logger)
+        self.namespace_informer = Informer(self.kube, '/api/v1/namespaces', self.logger,
+                                           label_selector='infrabox-job-id')
+
+        if self.args.namespace_pool_size > 0:
+            # only the housekeeper adds namespaces, all replicas claim them
+            self.namespace_pool = NamespacePool(self.kube, self.logger, self.args.namespace_pool_size,
+                                                can_refill=lambda: self.shards.is_housekeeper())
 
+    def kube_delete_namespace(self, namespace_name):
         # delete the namespace
         p = {"gracePeriodSeconds": 0}
-        requests.delete(self.args.api_server + '/api/v1/namespaces/%s' % (namespace_name,),
-                        headers=h, params=p, timeout=10)
-
+        self.kube.delete('/api/v1/namespaces/%s' % (namespace_name,), params=p)
 
     def kube_delete_job(self, job_id):
-        h = {'Authorization': 'Bearer %s' % self.args.token}
-        requests.delete(self.args.api_server +
-                        '/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibjobs/%s' % (self.namespace, job_id,),
-                        headers=h, timeout=5)
+        self.kube.delete('/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibjobs/%s' % (self.namespace, job_id,),
+                         timeout=5)
 
     def kube_job(self, job_id, cpu, mem, additional_env=None, services=None):
-        h = {'Authorization': 'Bearer %s' % self.args.token}
         job = {
             'apiVersion': 'core.infrabox.net/v1alpha1',
             'kind': 'IBJob',
@@ -66,8 +94,13 @@ class Scheduler(object):
             }
         }
 
-        r = requests.post(self.args.api_server + '/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibjobs' % self.namespace,
-                          headers=h, json=job, timeout=10)
+        r = self.kube.post('/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibjobs' % self.namespace,
+                           json=job)
+
+        if r.status_code == 409:
+            # the IBJob of the previous run of a requeued job is still being deleted
+            self.logger.info('IBJob %s still exists, retrying later', job_id)
+            return False
 
         if r.status_code != 201:
             self.logger.info('API Server response')
@@ -77,163 +110,44 @@ class Scheduler(object):
         return True
 
     def create_kube_namespace(self, job_id, _k8s_resources):
-        self.logger.info("Provisioning kubernetes namespace")
-        h = {'Authorization': 'Bearer %s' % self.args.token}
-
-        namespace_name = "ib-%s" % job_id
-        ns = {
-            "apiVersion": "v1",
-            "kind": "Namespace",
-            "metadata": {
-                "name": namespace_name,
-                "labels": {
-                    "infrabox-resource": "kubernetes",
-                    "infrabox-job-id": job_id,
-                }
-            }
-        }
-
-        r = requests.post(self.args.api_server + '/api/v1/namespaces',
-                          headers=h, json=ns, timeout=10)
-
-        if r.status_code != 201:
-            self.logger.warn("Failed to create Namespace: %s", r.text)
-            return False
-
-#        rq = {
-#            "apiVersion": "v1",
-#            "kind": "ResourceQuota",
-#            "metadata": {
-#                "name": "compute-resources",
-#                "namespace": namespace_name
-#            },
-#            "spec": {
-#                "hard": {
-#                    "limits.cpu": k8s_resources['limits']['cpu'],
-#                    "limits.memory": k8s_resources['limits']['memory']
-#                }
-#            }
-#        }
-#
-#        #r = requests.post(self.args.api_server + '/api/v1/namespaces/' + namespace_name + '/resourcequotas',
-#        #                  headers=h, json=rq, timeout=10)
-#
-#        if r.status_code != 201:
-#            self.logger.warn("Failed to create ResourceQuota: %s" % r.text)
-#            return False
-
-        role = {
-            'kind': 'Role',
-            'apiVersion': 'rbac.authorization.k8s.io/v1beta1',
-            'metadata': {
-                'name': 'infrabox',
-                'namespace': namespace_name
-            },
-            'rules': [{
-                'apiGroups': ['', 'extensions', 'apps', 'batch'],
-                'resources': ['*'],
-                'verbs': ['*']
-            }, {
-                'apiGroups': ['rbac.authorization.k8s.io'],
-                'resources': ['roles', 'rolebindings'],
-                'verbs': ['*']
-            }, {
-                'apiGroups': ['policy'],
-                'resources': ['poddisruptionbudgets'],
-                'verbs': ['*']
-            }]
-        }
-
-        r = requests.post(self.args.api_server +
-                          '/apis/rbac.authorization.k8s.io/v1beta1/namespaces/%s/roles' % namespace_name,
-                          headers=h, json=role, timeout=10)
-
-        if r.status_code != 201:
-            self.logger.warn("Failed to create Role: %s", r.text)
-            return False
-
-        rb = {
-            "kind": "RoleBinding",
-            "apiVersion": "rbac.authorization.k8s.io/v1beta1",
-            "metadata": {
-                "name": namespace_name
-            },
-            "subjects": [{
-                "kind": "ServiceAccount",
-                "name": "default",
-                "namespace": namespace_name
-            }],
-            "roleRef": {
-                "kind": "Role",
-                "name": "infrabox",
-                "apiGroup": "rbac.authorization.k8s.io"
-            }
-        }
+        if self.namespace_pool:
+            env = self.namespace_pool.claim(job_id)
 
-        r = requests.post(self.args.api_server +
-                          '/apis/rbac.authorization.k8s.io/v1beta1/namespaces/%s/rolebindings' % namespace_name,
-                          headers=h, json=rb, timeout=10)
+            if env:
+                return env
 
-        if r.status_code != 201:
-            self.logger.warn("Failed to create RoleBinding: %s", r.text)
-            return False
+        self.logger.info("Provisioning kubernetes namespace")
 
-        rb = {
-            "kind": "RoleBinding",
-            "apiVersion": "rbac.authorization.k8s.io/v1beta1",
-            "metadata": {
-                "name": namespace_name + '-discovery'
-            },
-            "subjects": [{
-                "kind": "ServiceAccount",
-                "name": "default",
-                "namespace": namespace_name
-            }],
-            "roleRef": {
-                "kind": "ClusterRole",
-                "name": "system:discover",
-                "apiGroup": "rbac.authorization.k8s.io"
-            }
+        namespace_name = "ib-%s" % job_id
+        labels = {
+            "infrabox-resource": "kubernetes",
+            "infrabox-job-id": job_id,
         }
 
-        r = requests.post(self.args.api_server +
-                          '/apis/rbac.authorization.k8s.io/v1beta1/namespaces/%s/rolebindings' % namespace_name,
-                          headers=h, json=rb, timeout=10)
-
-        if r.status_code != 201:
-            self.logger.warn("Failed to create RoleBinding for discovery: %s", r.text)
-            return False
-
-        # find secret
-        r = requests.get(self.args.api_server + '/api/v1/namespaces/%s/secrets' % namespace_name,
-                         headers=h, timeout=5)
-
-        if r.status_code != 200:
-            self.logger.warn("Failed to get service account secret: %s", r.text)
+        if not create_namespace(self.kube, namespace_name, labels, self.logger):
             return False
 
-        data = r.json()
-        secret = data['items'][0]
+        # the token controller creates the secret asynchronously
+        for _ in range(0, 20):
+            secret = get_service_account_secret(self.kube, namespace_name)
 
-        env = [
-            {"name": "INFRABOX_RESOURCES_KUBERNETES_CA_CRT", "value": secret['data']['ca.crt']},
-            {"name": "INFRABOX_RESOURCES_KUBERNETES_TOKEN", "value":  secret['data']['token']},
-            {"name": "INFRABOX_RESOURCES_KUBERNETES_NAMESPACE", "value": secret['data']['namespace']},
-            {"name": "INFRABOX_RESOURCES_KUBERNETES_MASTER_URL", "value": self.args.api_server}
-        ]
+            if secret:
+                return get_secret_env(self.kube, secret)
 
-        return env
+            time.sleep(0.5)
 
-    def schedule_job(self, job_id, cpu, memory):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT j.type, build_id, resources, definition FROM job j WHERE j.id = %s
-        ''', (job_id,))
-        j = cursor.fetchone()
-        cursor.close()
+        self.logger.warn("Failed to get service account secret")
+        return False
 
-        resources = j[2]
-        definition = j[3]
+    def schedule_job(self, job):
+        """ Creates the namespace and the IBJob for a job. Runs on the
+        kubernetes worker pool, so it must not touch the database.
+        Returns 'scheduled', 'failed' or 'namespace_error'. """
+        job_id = job['id']
+        cpu = job['cpu']
+        memory = job['memory']
+        resources = job['resources']
+        definition = job['definition']
 
         cpu -= 0.2
 
@@ -243,16 +157,10 @@ class Scheduler(object):
             additional_env = self.create_kube_namespace(job_id, k8s)
 
             if not additional_env:
-                self.logger.warn('Failed to create kubernetes namespace')
-                cursor = self.conn.cursor()
-                cursor.execute('''
-                    UPDATE job
-                    SET state = 'error', console = 'Failed to create kubernetes namespace'
-                    WHERE id = %s''', [job_id])
-                cursor.close()
-                return
+                self.logger.warn('Failed to create kubernetes namespace for job %s', job_id)
+                return 'namespace_error'
 
-        self.logger.info("Scheduling job to kubernetes")
+        self.logger.info("Scheduling job %s to kubernetes", job_id)
 
         services = None
 
@@ -260,236 +168,457 @@ class Scheduler(object):
             services = definition['services']
 
         if not self.kube_job(job_id, cpu, memory, additional_env=additional_env, services=services):
-            return
+            return 'failed'
+
+        return 'scheduled'
+
+    def schedule_jobs(self, jobs):
+        """ Schedules the jobs concurrently and updates their states
+        at once. Returns the jobs which have been scheduled. """
+        futures = [(j, self.kube.submit(self.schedule_job, j)) for j in jobs]
+
+        scheduled = []
+        namespace_errors = []
+        for j, f in futures:
+            try:
+                status = f.result()
+            except Exception:
+                # already logged by the client, the job stays queued
+                continue
+
+            if status == 'scheduled':
+                scheduled.append(j)
+            elif status == 'namespace_error':
+                namespace_errors.append(j['id'])
 
         cursor = self.conn.cursor()
-        cursor.execute("UPDATE job SET state = 'scheduled' WHERE id = %s", [job_id])
+        if scheduled:
+            cursor.execute('''
+                UPDATE job SET state = 'scheduled' WHERE id = ANY(%s::uuid[]) AND state = 'queued'
+            ''', [[j['id'] for j in scheduled]])
+
+        if namespace_errors:
+            cursor.execute('''
+                UPDATE job
+                SET state = 'error', console = 'Failed to create kubernetes namespace'
+                WHERE id = ANY(%s::uuid[])
+            ''', [namespace_errors])
         cursor.close()
 
-        self.logger.info("Finished scheduling job")
-        self.logger.info("")
+        self.logger.info("Scheduled %s of %s jobs", len(scheduled), len(jobs))
+        return scheduled
 
-    def schedule(self):
-        # find jobs
+    def get_queued_jobs(self, job_ids=None):
+        # find jobs together with the states of their parents,
+        # if job_ids is set only the given jobs and their direct children are considered.
+        # Only builds of the partitions we own, so replicas never schedule the same job
+        partitions = self.shards.get_partitions()
         cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT j.id, j.cpu, j.type, j.memory, j.dependencies
+            SELECT j.id, j.build_id, j.project_id, j.cpu, j.type, j.memory, j.dependencies,
+                j.resources, j.definition,
+                (SELECT coalesce(json_agg(json_build_array(p.id, p.state)), '[]'::json)
+                 FROM job p
+                 WHERE p.id IN (
+                    SELECT (deps->>'job-id')::uuid
+                    FROM jsonb_array_elements(j.dependencies) as deps
+                 )) parents
             FROM job j
             WHERE j.state = 'queued' and cluster_name = %s
-            ORDER BY j.created_at
-        ''', [os.environ['INFRABOX_CLUSTER_NAME']])
-        jobs = cursor.fetchall()
+            AND mod(hashtext(j.build_id::text) & 2147483647, %s) = ANY(%s::int[])
+            AND (%s::uuid[] IS NULL OR j.id = ANY(%s::uuid[]) OR EXISTS (
+                SELECT 1 FROM jsonb_array_elements(j.dependencies) as deps
+                WHERE (deps->>'job-id')::uuid = ANY(%s::uuid[])
+            ))
+            ORDER BY j.type = 'create_job_matrix' DESC, j.priority DESC, j.created_at
+        ''', [os.environ['INFRABOX_CLUSTER_NAME'], self.args.partitions, partitions,
+              job_ids, job_ids, job_ids])
+        rows = cursor.fetchall()
+        cursor.close()
+
+        jobs = []
+        for r in rows:
+            jobs.append({
+                'id': r[0],
+                'build_id': r[1],
+                'project_id': r[2],
+                'cpu': r[3],
+                'type': r[4],
+                'memory': r[5],
+                'dependencies': r[6],
+                'resources': r[7],
+                'definition': r[8],
+                'parents': r[9]
+            })
+
+        return jobs
+
+    def get_active_jobs(self):
+        # all scheduled and running jobs, on all clusters because project quotas are global
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT cpu, memory, project_id, cluster_name
+            FROM job
+            WHERE state IN ('scheduled', 'running')
+            AND type != 'wait'
+        ''')
+        rows = cursor.fetchall()
+        cursor.close()
+
+        return rows
+
+    def get_capacity_model(self, active_jobs):
+        if not self.nodes:
+            # no node information yet, don't limit anything
+            return None
+
+        cluster_name = os.environ['INFRABOX_CLUSTER_NAME']
+        used = [(r[0], r[1]) for r in active_jobs if r[3] == cluster_name]
+
+        capacity = CapacityModel(self.nodes, self.args.overcommit_ratio)
+        capacity.add_running(used)
+        return capacity
+
+    def get_fair_share(self, jobs, active_jobs):
+        project_ids = list(set(j['project_id'] for j in jobs))
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT id, scheduler_weight, quota_cpu, quota_memory, quota_jobs
+            FROM project
+            WHERE id = ANY(%s::uuid[])
+        ''', [project_ids])
+        rows = cursor.fetchall()
         cursor.close()
 
+        projects = {}
+        for r in rows:
+            projects[r[0]] = {
+                'weight': r[1],
+                'quota_cpu': r[2],
+                'quota_memory': r[3],
+                'quota_jobs': r[4]
+            }
+
+        fair_share = FairShare(projects, {})
+        for r in active_jobs:
+            fair_share.add({'cpu': r[0], 'memory': r[1], 'project_id': r[2]})
+
+        return fair_share
+
+    def schedule(self, job_ids=None):
+        if not self.shards.get_partitions():
+            # standby replica
+            return
+
+        jobs = self.get_queued_jobs(job_ids)
+
         if not jobs:
             # No queued job
             return
 
-        # check dependecies
-        for j in jobs:
-            job_id = j[0]
-            cpu = j[1]
-            job_type = j[2]
-            memory = j[3]
-            dependencies = j[4]
-
-            self.logger.info("")
-            self.logger.info("Starting to schedule job: %s", job_id)
-            self.logger.info("Dependencies: %s", dependencies)
+        # decide all jobs of a build at once
+        to_schedule = []
+        to_skip = []
+        to_finish = []
+        for graph in build_graphs(jobs).values():
+            s, sk, f = graph.resolve()
+            to_schedule += s
+            to_skip += sk
+            to_finish += f
+
+        if to_skip:
+            self.logger.info("Conditions not met, skipping jobs: %s", to_skip)
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                UPDATE job SET state = 'skipped' WHERE id = ANY(%s::uuid[]) AND state = 'queued'
+            ''', [to_skip])
+            cursor.close()
 
+        if to_finish:
+            self.logger.info("Wait jobs done: %s", to_finish)
             cursor = self.conn.cursor()
             cursor.execute('''
-		SELECT id, state
-		FROM job
-		WHERE id IN (
-                    SELECT (deps->>'job-id')::uuid
-                    FROM job, jsonb_array_elements(job.dependencies) as deps
-                    WHERE id = %s
-                )
-            ''', (job_id,))
-            result = cursor.fetchall()
+                UPDATE job SET state = 'finished', start_date = now(), end_date = now()
+                WHERE id = ANY(%s::uuid[]) AND state = 'queued'
+            ''', [to_finish])
             cursor.close()
 
-            self.logger.info("Parent states: %s", result)
+        # keep the order of the queue across builds: "Create Jobs" jobs first,
+        # they unlock whole builds, then by critical path length
+        order = dict((j['id'], i) for i, j in enumerate(jobs))
+        to_schedule.sort(key=lambda j: order[j['id']])
 
-            # check if there's still some parent running
-            parents_running = False
-            for r in result:
-                parent_state = r[1]
-                if parent_state in ('running', 'scheduled', 'queued'):
-                    # dependencies not ready
-                    parents_running = True
-                    break
+        if job_ids is None:
+            self.waiting_for_capacity = False
 
-            if parents_running:
-                self.logger.info("A parent is still running, not scheduling job")
-                continue
+        # a requeued job's IBJob has the same name as before,
+        # the old one must be gone before the new one can be created
+        deleting = self.get_deleting_jobs()
+        to_schedule = [j for j in to_schedule if j['id'] not in deleting]
 
-            # check if conditions are met
-            skipped = False
-            for r in result:
-                on = None
-                parent_id = r[0]
-                parent_state = r[1]
-                for dep in dependencies:
-                    if dep['job-id'] == parent_id:
-                        on = dep['on']
-
-                assert on
-
-                self.logger.info("Checking parent %s with state %s", parent_id, parent_state)
-                self.logger.info("Condition is %s", on)
-
-                if parent_state not in on:
-                    self.logger.info("Condition is not met, skipping job")
-                    skipped = True
-                    # dependency error, don't run this job_id
-                    cursor = self.conn.cursor()
-                    cursor.execute(
-                        "UPDATE job SET state = 'skipped' WHERE id = (%s)", (job_id,))
-                    cursor.close()
-                    break
+        if not to_schedule:
+            return
 
-            if skipped:
+        # the other replicas must see what we admit before they admit anything
+        self.shards.lock_admission()
+        try:
+            self.admit(to_schedule)
+        finally:
+            self.shards.unlock_admission()
+
+    def admit(self, to_schedule):
+        """ Schedules the jobs which are within their project's quota
+        and for which the cluster has capacity """
+        active_jobs = self.get_active_jobs()
+        capacity = self.get_capacity_model(active_jobs)
+        fair_share = self.get_fair_share(to_schedule, active_jobs)
+
+        admitted = []
+        too_large = []
+        for j in fair_share.order(to_schedule):
+            if fair_share.exceeds_quota(j):
+                self.logger.info("Job %s requests more than its project's quota", j['id'])
+                too_large.append(j['id'])
                 continue
 
-            # If it's a wait job we are done here
-            if job_type == "wait":
-                self.logger.info("Wait job, we are done")
-                cursor = self.conn.cursor()
-                cursor.execute('''
-                    UPDATE job SET state = 'finished', start_date = now(), end_date = now() WHERE id = %s;
-                ''', (job_id,))
-                cursor.close()
+            if not fair_share.within_quota(j):
+                self.logger.info("Project quota exceeded for job %s, keeping it queued", j['id'])
+                self.waiting_for_capacity = True
                 continue
 
-            self.schedule_job(job_id, cpu, memory)
+            if capacity and capacity.fits_any_node(j['cpu'], j['memory']):
+                if not capacity.admit(j['cpu'], j['memory']):
+                    self.logger.info("Not enough capacity for job %s, keeping it queued", j['id'])
+                    self.waiting_for_capacity = True
+                    continue
+            elif capacity:
+                self.logger.warn("Job %s requests more resources than any node has", j['id'])
+
+            # account for it right away, the kubernetes calls happen in parallel below
+            fair_share.add(j)
+            admitted.append(j)
+
+        if too_large:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+                UPDATE job
+                SET state = 'error', end_date = current_timestamp,
+                    message = 'Job requests more resources than the quota of the project allows',
+                    console = 'Job requests more resources than the quota of the project allows'
+                WHERE id = ANY(%s::uuid[]) AND state = 'queued'
+            ''', [too_large])
+            cursor.close()
+
+        if admitted:
+            self.schedule_jobs(admitted)
+
+    def collect_console(self, job_ids, suffix=''):
+        # the console output of all jobs at once, after their IBJobs are deleted,
+        # so they can't write any more of it
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            UPDATE job j
+            SET console = coalesce((SELECT string_agg(c.output, '' ORDER BY c.date)
+                                    FROM console c WHERE c.job_id = j.id), '') || %s
+            WHERE j.id = ANY(%s::uuid[])
+        ''', [suffix, job_ids])
+        cursor.close()
 
     def handle_aborts(self):
+        # kill all aborted jobs at once
         cursor = self.conn.cursor()
         cursor.execute('''
             WITH all_aborts AS (
                 DELETE FROM "abort" RETURNING job_id
             ), jobs_to_abort AS (
-                SELECT j.id, j.state FROM all_aborts
-                JOIN job j
-                    ON all_aborts.job_id = j.id
-                    AND j.state not in ('finished', 'failure', 'error', 'killed')
-            ), jobs_not_started_yet AS (
-                UPDATE job SET state = 'killed'
-                WHERE id in (SELECT id FROM jobs_to_abort WHERE state in ('queued'))
+                SELECT j.id, j.state FROM job j
+                WHERE j.id IN (SELECT job_id FROM all_aborts)
+                AND j.state IN ('scheduled', 'running', 'queued')
             )
-
-            SELECT id FROM jobs_to_abort WHERE state in ('scheduled', 'running', 'queued')
+            UPDATE job j
+            SET state = 'killed', end_date = current_timestamp
+            FROM jobs_to_abort a
+            WHERE j.id = a.id
+            RETURNING j.id, a.state
         ''')
-
         aborts = cursor.fetchall()
         cursor.close()
 
-        for abort in aborts:
-            job_id = abort[0]
-            self.kube_delete_job(job_id)
-
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT output FROM console WHERE job_id = %s ORDER BY date", (job_id,))
-            lines = cursor.fetchall()
-
-            output = ""
-            for line in lines:
-                output += line[0]
+        if not aborts:
+            return
 
-            # Update state
-            cursor.execute("""
-                UPDATE job SET state = 'killed', console = %s, end_date = current_timestamp
-                WHERE id = %s AND state IN ('scheduled', 'running', 'queued')""", (output, job_id,))
+        # queued jobs are not on the cluster yet
+        wait([self.kube.submit(self.kube_delete_job, job_id)
+              for job_id, state in aborts if state != 'queued'])
 
-            cursor.close()
+        self.collect_console([job_id for job_id, _ in aborts])
+        self.logger.info("Killed %s jobs", len(aborts))
 
     def handle_timeouts(self):
         cursor = self.conn.cursor()
         cursor.execute('''
-            SELECT j.id FROM job j
+            UPDATE job j
+            SET state = 'error', end_date = current_timestamp
             WHERE j.start_date < (NOW() - (j.timeout * INTERVAL '1' SECOND))
             AND j.state = 'running'
+            RETURNING j.id
         ''')
-        aborts = cursor.fetchall()
+        aborts = [r[0] for r in cursor.fetchall()]
         cursor.close()
 
-        for abort in aborts:
-            job_id = abort[0]
-            self.kube_delete_job(job_id)
+        if not aborts:
+            return
 
-            cursor = self.conn.cursor()
-            cursor.execute("SELECT output FROM console WHERE job_id = %s ORDER BY date", (job_id,))
-            lines = cursor.fetchall()
+        wait([self.kube.submit(self.kube_delete_job, job_id) for job_id in aborts])
 
-            output = ""
-            for line in lines:
-                output += line[0]
+        self.collect_console(aborts, 'Aborted due to timeout')
+        self.logger.info("%s jobs timed out", len(aborts))
 
-            output += "Aborted due to timeout"
+    def get_deleting_jobs(self):
+        if not self.job_informer.has_synced():
+            return set()
 
-            # Update state
-            cursor.execute("""
-                UPDATE job SET state = 'error', console = %s, end_date = current_timestamp
-                WHERE id = %s""", (output, job_id,))
+        return set(o['metadata']['name'] for o in
+                   self.job_informer.find(lambda o: 'deletionTimestamp' in o.get('metadata', {})))
 
-            cursor.close()
+    def heartbeats_arrive(self):
+        """ Whether the api records heartbeats. If none of the running jobs
+        sent one for the whole timeout it is much more likely that the api
+        or the database were down than that all jobs died at once. A single
+        running job can't tell, it is treated as dead. """
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT count(*), count(*) FILTER (WHERE h.last_seen >= NOW() - (%s * INTERVAL '1' SECOND))
+            FROM job j
+            JOIN job_heartbeat h ON h.job_id = j.id
+            WHERE j.state = 'running'
+        ''', [self.args.heartbeat_timeout])
+        running, alive = cursor.fetchone()
+        cursor.close()
 
-    def handle_orphaned_namespaces(self):
-        h = {'Authorization': 'Bearer %s' % self.args.token}
-        r = requests.get(self.args.api_server + '/api/v1/namespaces', headers=h, timeout=10)
-        data = r.json()
+        if running > 1 and alive == 0:
+            self.logger.warn("None of the %s running jobs sent a heartbeat, not declaring any dead", running)
+            self.heartbeats_since = None
+            return False
+
+        if self.heartbeats_since is None:
+            self.heartbeats_since = time.time()
 
-        if 'items' not in data:
-            self.logger.warn('No data returned')
+        return time.time() - self.heartbeats_since >= self.args.heartbeat_timeout
+
+    def handle_dead_jobs(self):
+        # running jobs which stopped sending heartbeats, e.g. because their node is gone.
+        # Jobs with kubernetes resources are never requeued, their namespace is still around
+        if not self.heartbeats_arrive():
             return
 
-        for j in data['items']:
-            metadata = j.get('metadata', None)
-            if not metadata:
-                continue
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            WITH dead AS (
+                SELECT j.id FROM job j
+                JOIN job_heartbeat h ON h.job_id = j.id
+                WHERE j.state = 'running'
+                AND h.last_seen < (NOW() - (%s * INTERVAL '1' SECOND))
+            ), requeued AS (
+                UPDATE job j
+                SET state = 'queued', start_date = NULL, requeue_count = j.requeue_count + 1
+                WHERE j.id IN (SELECT id FROM dead)
+                AND j.requeue_count < %s
+                AND (j.resources IS NULL OR j.resources->'kubernetes' IS NULL)
+                RETURNING j.id, true
+            ), failed AS (
+                UPDATE job j
+                SET state = 'error', end_date = current_timestamp,
+                    message = 'Job stopped sending heartbeats',
+                    console = coalesce((SELECT string_agg(c.output, '' ORDER BY c.date)
+                                        FROM console c WHERE c.job_id = j.id), '')
+                              || 'Job stopped sending heartbeats'
+                WHERE j.id IN (SELECT id FROM dead)
+                AND j.id NOT IN (SELECT id FROM requeued)
+                RETURNING j.id, false
+            ), heartbeats AS (
+                DELETE FROM job_heartbeat WHERE job_id IN (SELECT id FROM dead)
+            )
+            SELECT * FROM requeued UNION ALL SELECT * FROM failed
+        ''', [self.args.heartbeat_timeout, self.args.heartbeat_requeue])
+        dead = cursor.fetchall()
 
-            labels = metadata.get('labels', None)
-            if not labels:
+        # heartbeats of jobs which ended some other way
+        cursor.execute('''
+            DELETE FROM job_heartbeat h USING job j
+            WHERE h.job_id = j.id AND j.state NOT IN ('scheduled', 'running')
+        ''')
+        cursor.close()
+
+        for job_id, requeued in dead:
+            if requeued:
+                self.logger.info("Job %s stopped sending heartbeats, requeued it", job_id)
+            else:
+                self.logger.info("Job %s stopped sending heartbeats", job_id)
+
+            self.kube.submit(self.kube_delete_job, job_id)
+
+    def get_job_states(self, job_ids):
+        # state of all given jobs in one query
+        valid_ids = []
+        for job_id in job_ids:
+            try:
+                uuid.UUID(job_id)
+                valid_ids.append(job_id)
+            except ValueError:
                 continue
 
-            for key in labels:
-                if key != 'infrabox-job-id':
-                    continue
+        if not valid_ids:
+            return {}
 
-                job_id = labels[key]
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT id, state FROM job WHERE id = ANY(%s::uuid[])
+        ''', [valid_ids])
+        result = cursor.fetchall()
+        cursor.close()
 
-                cursor = self.conn.cursor()
-                cursor.execute('''SELECT state FROM job where id = %s''', (job_id,))
-                result = cursor.fetchall()
-                cursor.close()
+        return dict((r[0], r[1]) for r in result)
 
-                if len(result) != 1:
-                    continue
+    def handle_orphaned_namespaces(self, namespaces):
+        namespaces = [n for n in namespaces if n.get('metadata', {}).get('labels', {}).get('infrabox-job-id', None)]
 
-                state = result[0][0]
+        if not namespaces:
+            return
 
-                if state in ('queued', 'scheduled', 'running'):
-                    continue
+        states = self.get_job_states([n['metadata']['labels']['infrabox-job-id'] for n in namespaces])
 
-                self.logger.info('Deleting orphaned namespace ib-%s', job_id)
-                self.kube_delete_namespace(job_id)
+        for n in namespaces:
+            metadata = n['metadata']
+            labels = metadata['labels']
+            job_id = labels['infrabox-job-id']
+            namespace_name = metadata['name']
 
-    def handle_orphaned_jobs(self):
-        h = {'Authorization': 'Bearer %s' % self.args.token}
-        r = requests.get(self.args.api_server + '/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibjobs' % self.namespace,
-                         headers=h,
-                         timeout=10)
-        data = r.json()
+            if 'deletionTimestamp' in metadata:
+                # Already marked for deletion
+                continue
 
-        if 'items' not in data:
-            return
+            if job_id not in states:
+                continue
 
-        for j in data['items']:
-            if 'metadata' not in j:
+            state = states[job_id]
+
+            if state in ('queued', 'scheduled', 'running'):
                 continue
 
+            self.logger.info('Deleting orphaned namespace %s', namespace_name)
+            self.kube.submit(self.kube_delete_namespace, namespace_name)
+
+    def handle_orphaned_jobs(self, jobs):
+        jobs = [j for j in jobs if 'metadata' in j]
+
+        if not jobs:
+            return
+
+        states = self.get_job_states([j['metadata']['name'] for j in jobs])
+
+        for j in jobs:
             if 'deletionTimestamp' in j['metadata']:
                 # Already marked for deletion
                 continue
@@ -498,20 +627,15 @@ class Scheduler(object):
             name = metadata['name']
             job_id = name
 
-            cursor = self.conn.cursor()
-            cursor.execute('''SELECT state FROM job where id = %s''', (job_id,))
-            result = cursor.fetchall()
-            cursor.close()
-
-            if not result:
+            if job_id not in states:
                 self.logger.info('Deleting orphaned job %s', job_id)
-                self.kube_delete_job(job_id)
+                self.kube.submit(self.kube_delete_job, job_id)
                 continue
 
-            state = result[0][0]
+            state = states[job_id]
             if state in ('queued', 'scheduled', 'running'):
                 status = j.get('status', {}).get('status', None)
-                self.logger.error(j)
+                self.logger.debug(j)
 
                 if not status:
                     continue
@@ -532,7 +656,21 @@ class Scheduler(object):
                     continue
 
             self.logger.info('Deleting orphaned job %s', job_id)
-            self.kube_delete_job(job_id)
+            self.kube.submit(self.kube_delete_job, job_id)
+
+    def reconcile(self, job_ids=None):
+        # only the objects which changed in kubernetes
+        # and the ones of jobs which changed in the database
+        jobs = self.job_informer.pop_changed()
+        namespaces = self.namespace_informer.pop_changed()
+
+        if job_ids:
+            jobs += self.job_informer.find(lambda o: o['metadata']['name'] in job_ids)
+            namespaces += self.namespace_informer.find(
+                lambda o: o['metadata']['labels'].get('infrabox-job-id', None) in job_ids)
+
+        self.handle_orphaned_jobs(jobs)
+        self.handle_orphaned_namespaces(namespaces)
 
     def update_cluster_state(self):
         cluster_name = os.environ['INFRABOX_CLUSTER_NAME']
@@ -543,25 +681,35 @@ class Scheduler(object):
 
         root_url = os.environ['INFRABOX_ROOT_URL']
 
-        h = {'Authorization': 'Bearer %s' % self.args.token}
-        r = requests.get(self.args.api_server + '/api/v1/nodes',
-                         headers=h,
-                         timeout=10)
+        r = self.kube.get('/api/v1/nodes')
         data = r.json()
 
         memory = 0
         cpu = 0
         nodes = 0
+        schedulable_nodes = []
 
         items = data.get('items', [])
 
         for i in items:
             nodes += 1
-            cpu += int(i['status']['capacity']['cpu'])
+            cpu += int(parse_cpu(i['status']['capacity']['cpu']))
             mem = i['status']['capacity']['memory']
             mem = mem.replace('Ki', '')
             memory += int(mem)
 
+            if i.get('spec', {}).get('unschedulable', False):
+                continue
+
+            allocatable = i['status'].get('allocatable', i['status']['capacity'])
+            schedulable_nodes.append({
+                'name': i['metadata']['name'],
+                'cpu': parse_cpu(allocatable['cpu']),
+                'memory': parse_memory(allocatable['memory'])
+            })
+
+        self.nodes = schedulable_nodes
+
         cursor = self.conn.cursor()
         cursor.execute("""
             INSERT INTO cluster (name, labels, root_url, nodes, cpu_capacity, memory_capacity, active)
@@ -586,12 +734,22 @@ class Scheduler(object):
 
     def handle(self):
         self.update_cluster_state()
+        self.kube.log_metrics()
 
         try:
-            self.handle_timeouts()
             self.handle_aborts()
-            self.handle_orphaned_jobs()
-            self.handle_orphaned_namespaces()
+
+            if self.shards.is_housekeeper():
+                self.handle_timeouts()
+
+                if self.args.heartbeat_timeout > 0:
+                    self.handle_dead_jobs()
+
+                if self.job_informer.has_synced():
+                    self.handle_orphaned_jobs(self.job_informer.items())
+
+                if self.namespace_informer.has_synced():
+                    self.handle_orphaned_namespaces(self.namespace_informer.items())
         except Exception as e:
             self.logger.exception(e)
 
@@ -602,10 +760,97 @@ class Scheduler(object):
 
         self.schedule()
 
+    def listen(self):
+        self.listen_conn = connect_db()
+        self.listen_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = self.listen_conn.cursor()
+        cursor.execute("LISTEN job_update")
+        cursor.execute("LISTEN job_abort")
+        cursor.close()
+
+    def wait_for_events(self, timeout):
+        # Returns the ids of jobs which got queued or finished
+        # and whether new aborts have been requested
+        job_ids = set()
+        aborts = False
+
+        if select.select([self.listen_conn], [], [], timeout) == ([], [], []):
+            return job_ids, aborts
+
+        self.listen_conn.poll()
+        while self.listen_conn.notifies:
+            n = self.listen_conn.notifies.pop()
+            event = json.loads(n.payload)
+
+            if n.channel == 'job_abort':
+                aborts = True
+                continue
+
+            # scheduled and running jobs can't unblock anything
+            if event['state'] in ('scheduled', 'running'):
+                continue
+
+            job_ids.add(event['job_id'])
+
+        return job_ids, aborts
+
+    def handle_events(self, job_ids, aborts):
+        try:
+            if aborts:
+                self.handle_aborts()
+
+            if self.shards.is_housekeeper():
+                self.reconcile(job_ids)
+        except Exception as e:
+            self.logger.exception(e)
+
+        if not job_ids:
+            return
+
+        if self._inactive():
+            return
+
+        if self.waiting_for_capacity:
+            # finished jobs may have freed up room for any queued job
+            self.schedule()
+        else:
+            self.schedule(list(job_ids))
+
     def run(self):
+        self.listen()
+
+        # session level advisory locks live as long as this connection
+        shard_conn = connect_db()
+        shard_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.shards = ShardManager(shard_conn, os.environ['INFRABOX_CLUSTER_NAME'],
+                                   socket.gethostname(), self.args.partitions, self.logger)
+        self.shards.update()
+
+        self.job_informer.start()
+        self.namespace_informer.start()
+
+        if self.namespace_pool:
+            self.namespace_pool.start()
+
+        # job_update and job_abort notifications trigger scheduling right away,
+        # the full sweep only runs periodically to catch anything we missed
+        last_sweep = 0
+        last_shard_update = time.time()
         while True:
-            self.handle()
-            time.sleep(2)
+            if time.time() - last_shard_update > 10:
+                self.shards.update()
+                last_shard_update = time.time()
+
+            remaining = last_sweep + self.args.reconcile_interval - time.time()
+
+            if remaining <= 0:
+                self.handle()
+                last_sweep = time.time()
+                continue
+
+            # wake up regularly to reconcile changes seen by the informers
+            job_ids, aborts = self.wait_for_events(min(remaining, 1))
+            self.handle_events(job_ids, aborts)
 
 def main():
     # Arguments
@@ -634,6 +879,15 @@ def main():
     get_env('INFRABOX_JOB_MOUNT_DOCKER_SOCKET')
     get_env('INFRABOX_JOB_SECURITY_CONTEXT_CAPABILITIES_ENABLED')
 
+    args.reconcile_interval = int(get_env('INFRABOX_SCHEDULER_RECONCILE_INTERVAL'))
+    args.overcommit_ratio = float(get_env('INFRABOX_SCHEDULER_OVERCOMMIT_RATIO'))
+    args.namespace_pool_size = int(get_env('INFRABOX_SCHEDULER_NAMESPACE_POOL_SIZE'))
+    args.kubernetes_workers = int(get_env('INFRABOX_SCHEDULER_KUBERNETES_WORKERS'))
+    args.kubernetes_retries = int(get_env('INFRABOX_SCHEDULER_KUBERNETES_RETRIES'))
+    args.partitions = int(get_env('INFRABOX_SCHEDULER_PARTITIONS'))
+    args.heartbeat_timeout = int(get_env('INFRABOX_SCHEDULER_HEARTBEAT_TIMEOUT'))
+    args.heartbeat_requeue = int(get_env('INFRABOX_SCHEDULER_HEARTBEAT_REQUEUE'))
+
     if get_env('INFRABOX_GERRIT_ENABLED') == 'true':
         get_env('INFRABOX_GERRIT_USERNAME')
         get_env('INFRABOX_GERRIT_HOSTNAME')
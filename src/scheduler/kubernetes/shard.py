@@ -0,0 +1,107 @@
+import math
+
+class ShardManager(object):
+    """ Splits the queue of a cluster between several scheduler replicas.
+
+    Builds are hashed into a fixed number of partitions. Every replica
+    announces itself in the leader_election table and holds session level
+    advisory locks for its share of the partitions. If a replica dies its
+    locks are released with its connection and its heartbeat expires after
+    30 seconds, the remaining replicas then take over its partitions.
+
+    The replica holding partition 0 also does the cluster wide housekeeping.
+
+    Capacity and project quotas are computed from the jobs in the database,
+    so replicas admit jobs one at a time with the admission lock. It is
+    shared by all clusters, because project quotas are global.
+    """
+
+    ADMISSION_LOCK = 'infrabox-scheduler-admission'
+
+    def __init__(self, conn, cluster_name, member_id, partitions, logger):
+        self.conn = conn
+        self.prefix = 'scheduler-%s/' % cluster_name
+        self.service_name = self.prefix + member_id
+        self.lock_name = 'infrabox-scheduler-%s' % cluster_name
+        self.partitions = partitions
+        self.logger = logger
+        self.owned = set()
+
+    def heartbeat(self):
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            INSERT INTO leader_election (service_name, last_seen_active)
+            VALUES (%s, now())
+            ON CONFLICT (service_name)
+            DO UPDATE SET last_seen_active = now()
+        """, [self.service_name])
+
+        # replicas which went away for good, e.g. after a rollout
+        cursor.execute("""
+            DELETE FROM leader_election
+            WHERE service_name LIKE %s
+            AND last_seen_active < now() - interval '30 second'
+        """, [self.prefix + '%'])
+
+        cursor.execute("""
+            SELECT count(*) FROM leader_election
+            WHERE service_name LIKE %s
+            AND last_seen_active > now() - interval '30 second'
+        """, [self.prefix + '%'])
+        members = cursor.fetchone()[0]
+        cursor.close()
+
+        return max(members, 1)
+
+    def try_lock(self, partition):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s), %s)", [self.lock_name, partition])
+        locked = cursor.fetchone()[0]
+        cursor.close()
+        return locked
+
+    def unlock(self, partition):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT pg_advisory_unlock(hashtext(%s), %s)", [self.lock_name, partition])
+        cursor.close()
+
+    def lock_admission(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT pg_advisory_lock(hashtext(%s))", [self.ADMISSION_LOCK])
+        cursor.close()
+
+    def unlock_admission(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT pg_advisory_unlock(hashtext(%s))", [self.ADMISSION_LOCK])
+        cursor.close()
+
+    def update(self):
+        """ Refreshes our heartbeat and rebalances the partitions """
+        members = self.heartbeat()
+        target = int(math.ceil(float(self.partitions) / members))
+
+        # give up partitions if new replicas joined, but never partition 0 first
+        for p in sorted(self.owned, reverse=True):
+            if len(self.owned) <= target:
+                break
+
+            self.unlock(p)
+            self.owned.discard(p)
+
+        for p in range(self.partitions):
+            if len(self.owned) >= target:
+                break
+
+            if p in self.owned:
+                continue
+
+            if self.try_lock(p):
+                self.owned.add(p)
+
+        self.logger.debug('%s replicas, owning partitions %s', members, sorted(self.owned))
+
+    def get_partitions(self):
+        return sorted(self.owned)
+
+    def is_housekeeper(self):
+        return 0 in self.owned
@@ -0,0 +1,73 @@
+import unittest
+
+from capacity import CapacityModel, parse_cpu, parse_memory
+
+def nodes(*sizes):
+    return [{'name': 'node%s' % i, 'cpu': cpu, 'memory': memory}
+            for i, (cpu, memory) in enumerate(sizes)]
+
+class TestCapacity(unittest.TestCase):
+    def test_parse_cpu(self):
+        self.assertEqual(parse_cpu('4'), 4)
+        self.assertEqual(parse_cpu('3920m'), 3.92)
+        self.assertEqual(parse_cpu(2), 2)
+
+    def test_parse_memory(self):
+        self.assertEqual(parse_memory('1024Ki'), 1)
+        self.assertEqual(parse_memory('2Gi'), 2048)
+        self.assertEqual(parse_memory('1048576'), 1)
+        self.assertAlmostEqual(parse_memory('1M'), 1000 ** 2 / 1024.0 / 1024)
+
+    def test_admit(self):
+        c = CapacityModel(nodes((4, 4096)))
+
+        self.assertTrue(c.admit(2, 2048))
+        self.assertTrue(c.admit(2, 2048))
+        self.assertFalse(c.admit(1, 1))
+
+    def test_admit_does_not_split_jobs(self):
+        c = CapacityModel(nodes((2, 2048), (2, 2048)))
+
+        # 4 cpus are free in total, but not on one node
+        self.assertFalse(c.admit(3, 1024))
+
+    def test_best_fit(self):
+        c = CapacityModel(nodes((8, 8192), (2, 2048)))
+
+        # the small node fits it without waste, the big one stays free
+        self.assertTrue(c.admit(2, 2048))
+        self.assertTrue(c.admit(8, 8192))
+
+    def test_overcommit(self):
+        c = CapacityModel(nodes((2, 2048)), overcommit_ratio=2.0)
+        self.assertTrue(c.admit(4, 4096))
+        self.assertFalse(c.admit(1, 1))
+
+    def test_fits_any_node(self):
+        c = CapacityModel(nodes((2, 2048), (4, 1024)))
+
+        self.assertTrue(c.fits_any_node(4, 1024))
+        self.assertFalse(c.fits_any_node(4, 2048))
+
+        # independent of what is running
+        c.admit(4, 1024)
+        self.assertTrue(c.fits_any_node(4, 1024))
+
+    def test_add_running(self):
+        c = CapacityModel(nodes((4, 4096)))
+        c.add_running([(3, 1024)])
+
+        self.assertFalse(c.admit(2, 1024))
+        self.assertTrue(c.admit(1, 1024))
+
+    def test_add_running_more_than_capacity(self):
+        c = CapacityModel(nodes((2, 2048)))
+        c.add_running([(2, 2048), (2, 2048)])
+        self.assertFalse(c.admit(1, 1))
+
+    def test_no_nodes(self):
+        c = CapacityModel([])
+        c.add_running([(1, 1024)])
+
+        self.assertFalse(c.fits_any_node(1, 1))
+        self.assertFalse(c.admit(1, 1))
@@ -0,0 +1,84 @@
+import unittest
+
+from dag import build_graphs
+
+def job(job_id, parents=(), on=('finished',), job_type='docker', build_id='b1'):
+    return {
+        'id': job_id,
+        'build_id': build_id,
+        'type': job_type,
+        'dependencies': [{'job-id': p, 'on': list(on)} for p, _ in parents],
+        'parents': list(parents)
+    }
+
+def resolve(jobs):
+    to_schedule = []
+    to_skip = []
+    to_finish = []
+
+    for graph in build_graphs(jobs).values():
+        s, sk, f = graph.resolve()
+        to_schedule += [j['id'] for j in s]
+        to_skip += sk
+        to_finish += f
+
+    return to_schedule, to_skip, to_finish
+
+class TestDag(unittest.TestCase):
+    def test_no_parents(self):
+        self.assertEqual(resolve([job('a')]), (['a'], [], []))
+
+    def test_parent_pending(self):
+        for state in ('queued', 'scheduled', 'running'):
+            self.assertEqual(resolve([job('a', [('p', state)])]), ([], [], []))
+
+    def test_parent_finished(self):
+        self.assertEqual(resolve([job('a', [('p', 'finished')])]), (['a'], [], []))
+
+    def test_condition_not_met(self):
+        self.assertEqual(resolve([job('a', [('p', 'failure')])]), ([], ['a'], []))
+
+    def test_condition_on_failure(self):
+        jobs = [job('a', [('p', 'failure')], on=('failure', 'error'))]
+        self.assertEqual(resolve(jobs), (['a'], [], []))
+
+    def test_queued_parent_in_build(self):
+        # b waits for a, which is scheduled in the same pass
+        jobs = [job('a'), job('b', [('a', 'queued')])]
+        self.assertEqual(resolve(jobs), (['a'], [], []))
+
+    def test_skip_cascades(self):
+        jobs = [
+            job('a', [('p', 'failure')]),
+            job('b', [('a', 'queued')]),
+            job('c', [('b', 'queued')], on=('skipped',))
+        ]
+
+        self.assertEqual(resolve(jobs), (['c'], ['a', 'b'], []))
+
+    def test_wait_job(self):
+        jobs = [
+            job('w', [('p', 'finished')], job_type='wait'),
+            job('a', [('w', 'queued')])
+        ]
+
+        self.assertEqual(resolve(jobs), (['a'], [], ['w']))
+
+    def test_children_in_any_order(self):
+        jobs = [
+            job('c', [('b', 'queued')]),
+            job('b', [('a', 'queued')], job_type='wait'),
+            job('a', [('p', 'finished')], job_type='wait')
+        ]
+
+        self.assertEqual(resolve(jobs), (['c'], [], ['a', 'b']))
+
+    def test_builds_are_separate(self):
+        jobs = [
+            job('a', build_id='b1'),
+            job('b', [('x', 'running')], build_id='b2')
+        ]
+
+        graphs = build_graphs(jobs)
+        self.assertEqual(list(graphs.keys()), ['b1', 'b2'])
+        self.assertEqual(resolve(jobs), (['a'], [], []))
@@ -0,0 +1,79 @@
+import unittest
+
+from fairshare import FairShare
+
+def job(project_id, cpu=1, memory=1024):
+    return {'project_id': project_id, 'cpu': cpu, 'memory': memory}
+
+def project(weight=1, quota_cpu=None, quota_memory=None, quota_jobs=None):
+    return {
+        'weight': weight,
+        'quota_cpu': quota_cpu,
+        'quota_memory': quota_memory,
+        'quota_jobs': quota_jobs
+    }
+
+class TestFairShare(unittest.TestCase):
+    def test_order_alternates_projects(self):
+        f = FairShare({}, {})
+        jobs = [job('a'), job('a'), job('a'), job('b'), job('b')]
+
+        order = []
+        for j in f.order(jobs):
+            f.add(j)
+            order.append(j['project_id'])
+
+        self.assertEqual(order, ['a', 'b', 'a', 'b', 'a'])
+
+    def test_order_prefers_low_usage(self):
+        f = FairShare({}, {'a': {'cpu': 4, 'memory': 0, 'jobs': 4}})
+        order = [j['project_id'] for j in f.order([job('a'), job('b')])]
+        self.assertEqual(order, ['b', 'a'])
+
+    def test_order_by_weight(self):
+        f = FairShare({'a': project(weight=3), 'b': project()}, {})
+        jobs = [job('a') for _ in range(4)] + [job('b') for _ in range(4)]
+
+        order = []
+        for j in f.order(jobs):
+            f.add(j)
+            order.append(j['project_id'])
+
+        self.assertEqual(order[:5].count('a'), 4)
+
+    def test_order_keeps_order_within_project(self):
+        f = FairShare({}, {})
+        jobs = [dict(job('a'), id=i) for i in range(3)]
+        self.assertEqual([j['id'] for j in f.order(jobs)], [0, 1, 2])
+
+    def test_within_quota(self):
+        f = FairShare({'a': project(quota_cpu=2, quota_memory=2048, quota_jobs=2)}, {})
+
+        self.assertTrue(f.within_quota(job('a')))
+        f.add(job('a'))
+        self.assertTrue(f.within_quota(job('a')))
+        f.add(job('a'))
+        self.assertFalse(f.within_quota(job('a')))
+
+        # projects without quota
+        self.assertTrue(f.within_quota(job('b', cpu=100)))
+
+    def test_within_quota_memory(self):
+        f = FairShare({'a': project(quota_memory=1024)}, {})
+        self.assertTrue(f.within_quota(job('a', memory=1024)))
+        self.assertFalse(f.within_quota(job('a', memory=1025)))
+
+    def test_exceeds_quota(self):
+        f = FairShare({
+            'a': project(quota_cpu=2, quota_memory=2048),
+            'b': project(quota_jobs=0)
+        }, {'a': {'cpu': 2, 'memory': 2048, 'jobs': 2}})
+
+        # has to wait, but fits once the other jobs finished
+        self.assertFalse(f.exceeds_quota(job('a')))
+        self.assertFalse(f.within_quota(job('a')))
+
+        self.assertTrue(f.exceeds_quota(job('a', cpu=3)))
+        self.assertTrue(f.exceeds_quota(job('a', memory=4096)))
+        self.assertTrue(f.exceeds_quota(job('b')))
+        self.assertFalse(f.exceeds_quota(job('c', cpu=100)))